@@ -40,6 +40,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Measures the whole request, see /metrics
+    'todolist.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,7 +55,8 @@ ROOT_URLCONF = 'assessment_app.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django templates, with their renders timed for the request metrics
+        'BACKEND': 'todolist.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -85,6 +88,20 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Shared by all the workers when backed by the database or Redis, e.g.
+# CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache with CACHE_LOCATION=cache_table
+# Local memory of each process otherwise
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -127,8 +144,67 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Number of tasks on a page of the Task list
+TASKS_PAGE_SIZE = int(os.getenv('TASKS_PAGE_SIZE', default=50))
+# Number of rendered rows of the Task list each process keeps in memory, and for how many seconds at most
+# Rows are rendered again once their task or weather rating changes, whatever the TTL
+TASK_ROW_CACHE_SIZE = int(os.getenv('TASK_ROW_CACHE_SIZE', default=5000))
+TASK_ROW_CACHE_TTL = int(os.getenv('TASK_ROW_CACHE_TTL', default=3600))
+
+# Maximum number of changes on a page of the task sync feed
+TASKS_SYNC_PAGE_SIZE = int(os.getenv('TASKS_SYNC_PAGE_SIZE', default=500))
+# Seconds changes are held back from the sync feed, giving transactions that saved them before the latest
+# changes time to commit, so a cursor never skips them
+TASKS_SYNC_DELAY = float(os.getenv('TASKS_SYNC_DELAY', default=2))
+# Days deleted tasks are kept in the sync feed, run `manage.py prune_task_deletions` daily to apply it
+# Clients that haven't synced for longer must sync again without a cursor
+TASKS_SYNC_RETENTION_DAYS = int(os.getenv('TASKS_SYNC_RETENTION_DAYS', default=30))
+
+# Number of rows per statement and transaction when working through whole tables
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', default=1000))
+
 # Weather API
 WEATHER_API = os.getenv('WEATHER_API')
 WEATHER_API_ONECALL = os.getenv('WEATHER_API_ONECALL')
-WEATHER_API_DIRECT = os.getenv('WEATHER_API_DIRECT')
+WEATHER_API_DIRECT = os.getenv('WEATHER_API_DIRECT', default='geo/1.0/direct?')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
+# Seconds to wait for a connection to, and for a response from, the Weather API
+WEATHER_API_CONNECT_TIMEOUT = float(os.getenv('WEATHER_API_CONNECT_TIMEOUT', default=3))
+WEATHER_API_READ_TIMEOUT = float(os.getenv('WEATHER_API_READ_TIMEOUT', default=5))
+# How many times a failed Weather API call is retried, and the backoff factor in seconds between the retries
+WEATHER_API_RETRIES = int(os.getenv('WEATHER_API_RETRIES', default=2))
+WEATHER_API_BACKOFF = float(os.getenv('WEATHER_API_BACKOFF', default=0.5))
+
+# Seconds a stored weather read is used before it is fetched again from the Weather API
+WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', default=600))
+# Seconds an expired weather read is still served while it is refreshed in the background
+# Past that age requests wait for a new read
+WEATHER_CACHE_HARD_TTL = int(os.getenv('WEATHER_CACHE_HARD_TTL', default=3600))
+# Size in degrees of the grid cells sharing a weather read, 0.01 is about a kilometer
+# Run `manage.py regrid_locations` after changing it
+WEATHER_GRID_SIZE = float(os.getenv('WEATHER_GRID_SIZE', default=0.01))
+# Number of weather reads each process keeps in memory, and for how many seconds at most
+# Reads changed by another process can be served from memory for that long
+WEATHER_LOCAL_CACHE_SIZE = int(os.getenv('WEATHER_LOCAL_CACHE_SIZE', default=1000))
+WEATHER_LOCAL_CACHE_TTL = int(os.getenv('WEATHER_LOCAL_CACHE_TTL', default=60))
+# Whether views fetch expired weather reads from the Weather API themselves
+# Turn off when the `refresh_weather` worker runs, views then serve stored reads only
+WEATHER_FETCH_INLINE = bool(int(os.getenv('WEATHER_FETCH_INLINE', default=1)))
+# Maximum number of Weather API calls per minute, across all processes, and how many calls can be made at once
+# Past the limit views serve the stored reads, however old, and the `refresh_weather` worker waits
+WEATHER_API_RATE_LIMIT = float(os.getenv('WEATHER_API_RATE_LIMIT', default=60))
+WEATHER_API_BURST = int(os.getenv('WEATHER_API_BURST', default=20))
+# Number of failed Weather API calls in a row after which each process stops calling it, and for how many seconds
+# The stored reads, however old, are served meanwhile
+WEATHER_BREAKER_FAILURES = int(os.getenv('WEATHER_BREAKER_FAILURES', default=5))
+WEATHER_BREAKER_RESET = float(os.getenv('WEATHER_BREAKER_RESET', default=30))
+# Number of concurrent Weather API calls a single page render can make
+WEATHER_FETCH_WORKERS = int(os.getenv('WEATHER_FETCH_WORKERS', default=8))
+# Seconds a page render waits for Weather API reads before rendering without them
+WEATHER_FETCH_DEADLINE = float(os.getenv('WEATHER_FETCH_DEADLINE', default=5))
+# Days weather observations are kept as they are, then rolled up by the hour
+# Days hourly rollups are kept, then rolled up by the day, and days daily rollups are kept
+# Run `manage.py rollup_weather_history` daily to apply them
+WEATHER_HISTORY_RAW_DAYS = int(os.getenv('WEATHER_HISTORY_RAW_DAYS', default=7))
+WEATHER_HISTORY_HOURLY_DAYS = int(os.getenv('WEATHER_HISTORY_HOURLY_DAYS', default=90))
+WEATHER_HISTORY_DAILY_DAYS = int(os.getenv('WEATHER_HISTORY_DAILY_DAYS', default=730))
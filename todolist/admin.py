@@ -1,6 +1,14 @@
 from django.contrib import admin
-from .models import Task, Location, Weather
+from .forms import LocationForm
+from .models import Task, Location, Weather, GeocodingResult
+
+
+# Locations can be added by name alone, their coordinates are looked up then
+class LocationAdmin(admin.ModelAdmin):
+    form = LocationForm
+
 
 admin.site.register(Task)
-admin.site.register(Location)
+admin.site.register(Location, LocationAdmin)
 admin.site.register(Weather)
+admin.site.register(GeocodingResult)
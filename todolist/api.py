@@ -0,0 +1,220 @@
+import calendar
+import functools
+import io
+import json
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
+
+from todolist.forms import TaskAPIForm, TaskFilterForm
+from todolist.imports import IMPORT_FORMATS, import_locations, import_tasks, read_rows
+from todolist.models import Task, TaskDeletion
+from todolist.pagination import paginate_tasks
+from todolist.sync import decode_sync_cursor, task_changes
+
+
+# JSON API for Tasks
+# Responses carry an ETag and a Last-Modified header derived from Task.modified_at, so polling clients can ask
+# for changes only with If-None-Match or If-Modified-Since and get a 304 when nothing changed.
+# Updates honour If-Match, answering 412 when the task changed since the client read it.
+# The task endpoints are exempt from the CSRF token checks of the site's forms, see json_only.
+
+
+# Methods of requests changing data with a body
+# DELETE has none, and browsers never send it cross-site without asking the API first (CORS preflight)
+BODY_METHODS = ('POST', 'PUT', 'PATCH')
+
+
+# Exempt the view from CSRF token checks, API clients have no CSRF cookie, requiring JSON bodies instead
+# Requests changing data must be sent with Content-Type: application/json, which neither a cross-site form
+# nor a cross-site script can send without the browser asking the API first, so they can't be forged
+def json_only(view):
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if request.method in BODY_METHODS and request.content_type != 'application/json':
+            return JsonResponse({'errors': {'__all__': ['Content-Type must be application/json']}}, status=415)
+        return view(request, *args, **kwargs)
+
+    return csrf_exempt(wrapped)
+
+
+# Endpoint for listing tasks a page at a time, filtered like the Task list, and for creating tasks
+@json_only
+@require_http_methods(['GET', 'HEAD', 'POST'])
+def tasks(request):
+    if request.method == 'POST':
+        return save_task(request, status=201)
+
+    filters = TaskFilterForm(request.GET)
+    if not filters.is_valid():
+        return JsonResponse({'errors': filters.errors}, status=400)
+    # Any change to the tasks changes the latest modification time, or the count and the latest deletion time when
+    # tasks are deleted, so two aggregates tell whether the list changed without loading a row
+    version = Task.objects.aggregate(modified_at=Max('modified_at'), count=Count('id'))
+    deleted_at = TaskDeletion.objects.aggregate(deleted_at=Max('deleted_at'))['deleted_at']
+    modified_at = max(filter(None, (version['modified_at'], deleted_at)), default=None)
+    etag = quote_etag('%s-%d' % (modified_at and modified_at.isoformat(), version['count']))
+    conditional = conditional_response(request, etag, modified_at)
+    if conditional:
+        return conditional
+
+    page = paginate_tasks(
+        filters.filter_tasks(Task.objects.all()),
+        settings.TASKS_PAGE_SIZE,
+        after=filters.cleaned_data['after'],
+        before=filters.cleaned_data['before'],
+    )
+    response = JsonResponse({
+        'tasks': [task_data(task) for task in page.tasks],
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+    })
+    return with_validators(response, etag, modified_at)
+
+
+# Endpoint for reading, updating and deleting a task
+# PUT replaces the name, date and location of the task, PATCH only the ones given
+@json_only
+@require_http_methods(['GET', 'HEAD', 'PUT', 'PATCH', 'DELETE'])
+def task(request, task_id):
+    task = get_object_or_404(Task, pk=task_id)
+    conditional = conditional_response(request, task_etag(task), task.modified_at)
+    if conditional:
+        return conditional
+
+    if request.method == 'DELETE':
+        task.delete()
+        return HttpResponse(status=204)
+    if request.method in ('PUT', 'PATCH'):
+        return save_task(request, instance=task, partial=request.method == 'PATCH')
+
+    return task_response(task)
+
+
+# Endpoint for marking a task as done, saving its last weather read like the Task list does
+@json_only
+@require_POST
+def complete(request, task_id):
+    task = get_object_or_404(Task, pk=task_id)
+    conditional = conditional_response(request, task_etag(task), task.modified_at)
+    if conditional:
+        return conditional
+
+    Task.objects.filter(pk=task.pk).complete()
+    task.refresh_from_db()
+    return task_response(task)
+
+
+# Endpoint for the sync feed, e.g. /api/tasks/changes?cursor=...
+# Responds with the tasks changed and the ids of the tasks deleted since the cursor, along with the cursor to ask
+# with next time. Without a cursor every task counts as changed. While `more` is true, there are more changes to
+# get right away.
+@require_GET
+def changes(request):
+    cursor = request.GET.get('cursor')
+    try:
+        position = decode_sync_cursor(cursor) if cursor else None
+    except ValueError:
+        return JsonResponse({'errors': {'cursor': ['Invalid cursor']}}, status=400)
+
+    changes = task_changes(position, settings.TASKS_SYNC_PAGE_SIZE, settings.TASKS_SYNC_DELAY)
+    return JsonResponse({
+        'tasks': [task_data(task) for task in changes.tasks],
+        'deleted': changes.deleted,
+        'cursor': changes.cursor,
+        'more': changes.more,
+    })
+
+
+# Endpoint for importing tasks or locations from an uploaded CSV, JSON or NDJSON `file`
+# The format is taken from the `format` parameter or else the file extension. Valid rows are imported, invalid ones
+# are skipped and reported by their row number.
+# Uploads are multipart forms, which cross-site forms can send too, so they carry a CSRF token like the site's forms.
+@require_POST
+def import_file(request, kind):
+    upload = request.FILES.get('file')
+    if upload is None:
+        return JsonResponse({'errors': {'file': ['This field is required.']}}, status=400)
+    file_format = request.POST.get('format') or upload.name.rpartition('.')[2].lower()
+    if file_format not in IMPORT_FORMATS:
+        return JsonResponse(
+            {'errors': {'format': ['Format must be one of: %s' % ', '.join(IMPORT_FORMATS)]}}, status=400
+        )
+
+    import_rows = import_tasks if kind == 'tasks' else import_locations
+    try:
+        result = import_rows(
+            read_rows(io.TextIOWrapper(upload, encoding='utf-8-sig', newline=''), file_format), settings.BULK_BATCH_SIZE
+        )
+    except UnicodeDecodeError:
+        return JsonResponse({'errors': {'file': ['File must be UTF-8 encoded text']}}, status=400)
+    return JsonResponse(result.as_dict())
+
+
+# Validate the JSON body of the request like the Task form does and save the task, responding with the saved task
+# or with the form errors
+def save_task(request, instance=None, partial=False, status=200):
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'errors': {'__all__': ['Invalid JSON']}}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({'errors': {'__all__': ['Expected a JSON object']}}, status=400)
+    if partial:
+        data = dict(TaskAPIForm(instance=instance).initial, **data)
+
+    form = TaskAPIForm(data, instance=instance)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    return task_response(form.save(), status=status)
+
+
+# Respond with the task along with its validators
+def task_response(task, status=200):
+    return with_validators(JsonResponse(task_data(task), status=status), task_etag(task), task.modified_at)
+
+
+# Task as served by the API
+def task_data(task):
+    return {
+        'id': task.id,
+        'name': task.name,
+        'date': task.date.isoformat(),
+        'done': task.done,
+        'location': task.location_id,
+        'created_at': task.created_at.isoformat(),
+        'modified_at': task.modified_at.isoformat(),
+    }
+
+
+# ETag of a single task, it changes along with the task's modification time
+def task_etag(task):
+    return quote_etag('%d-%s' % (task.id, task.modified_at.isoformat()))
+
+
+# The 304 or 412 response the request's preconditions call for, None when the request should go ahead
+def conditional_response(request, etag, modified_at):
+    response = get_conditional_response(request, etag=etag, last_modified=modified_at and timestamp(modified_at))
+    # A 304 still carries the validators, for the client to keep using
+    if response is not None and response.status_code == 304:
+        with_validators(response, etag, modified_at)
+    return response
+
+
+# Set the ETag and Last-Modified headers of the response
+def with_validators(response, etag, modified_at):
+    response.headers['ETag'] = etag
+    if modified_at:
+        response.headers['Last-Modified'] = http_date(timestamp(modified_at))
+    return response
+
+
+# Seconds since the epoch of a stored time, stored times are naive UTC since USE_TZ is off and TIME_ZONE is UTC
+def timestamp(modified_at):
+    return calendar.timegm(modified_at.utctimetuple())
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class TodolistConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'todolist'
+
+    def ready(self):
+        # Connect the signal receivers
+        from todolist import signals  # noqa: F401
@@ -0,0 +1,31 @@
+import concurrent.futures
+import threading
+
+
+# Thread pool for work done after the response, keeping track of the work submitted and not done yet
+# so it can be waited for, e.g. by the benchmark before counting the Weather API calls it caused
+class BackgroundPool(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, max_workers, thread_name_prefix):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        future = super().submit(function, *args, **kwargs)
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+
+    # Wait for the work submitted so far to be done, along with any work submitted meanwhile
+    def drain(self):
+        while True:
+            with self._pending_lock:
+                pending = list(self._pending)
+            if not pending:
+                return
+            concurrent.futures.wait(pending)
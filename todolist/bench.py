@@ -0,0 +1,204 @@
+import datetime
+import json
+import math
+import time
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from todolist.grid import grid_key
+from todolist.history import history_executor
+from todolist.models import Location, Task
+from todolist.task_rows import row_cache
+from todolist.weather import revalidation_executor
+
+# Benchmark of the task list and weather endpoints, see `manage.py bench`
+# Each scenario drives an endpoint with requests picked at random from synthetic data, seeded for reproducible runs.
+# Every request is timed, along with the database queries it makes and the Weather API calls made meanwhile.
+
+# Tasks are dated around this day, so runs with the same seed make the same data whenever they run
+BASE_DATE = datetime.datetime(2024, 6, 1)
+# Percentiles of the latencies in the report
+PERCENTILES = (50, 95, 99)
+
+
+# Synthetic tasks and locations, along with the ids the scenarios pick from
+class BenchData:
+    def __init__(self, location_ids, pending_ids, done_ids):
+        self.location_ids = location_ids
+        self.pending_ids = pending_ids
+        self.done_ids = done_ids
+
+    # Take up to `count` pending tasks at random to complete them, they are done afterwards
+    def take_pending(self, rng, count):
+        taken = set(rng.sample(self.pending_ids, min(count, len(self.pending_ids))))
+        self.pending_ids = [task_id for task_id in self.pending_ids if task_id not in taken]
+        self.done_ids.extend(sorted(taken))
+        return sorted(taken)
+
+    # Take up to `count` tasks at random, they are gone afterwards
+    def take_any(self, rng, count):
+        task_ids = self.pending_ids + self.done_ids
+        taken = set(rng.sample(task_ids, min(count, len(task_ids))))
+        self.pending_ids = [task_id for task_id in self.pending_ids if task_id not in taken]
+        self.done_ids = [task_id for task_id in self.done_ids if task_id not in taken]
+        return sorted(taken)
+
+
+# Create `locations` locations spread over a region and `tasks` tasks among them, `done_ratio` of them done
+# A tenth of the tasks have no location, like tasks added without one
+def generate_data(tasks, locations, done_ratio, rng, batch_size=1000):
+    new_locations = []
+    for number in range(locations):
+        lat, lon = round(rng.uniform(43, 51), 4), round(rng.uniform(-4, 8), 4)
+        # bulk_create skips save(), where the grid key is set otherwise
+        new_locations.append(Location(name='Location %d' % number, lat=lat, lon=lon, grid_key=grid_key(lat, lon)))
+    location_ids = [location.id for location in Location.objects.bulk_create(new_locations, batch_size=batch_size)]
+
+    new_tasks = [
+        Task(
+            name='Task %d' % number,
+            date=BASE_DATE + datetime.timedelta(minutes=rng.randrange(-60 * 24 * 30, 60 * 24 * 30)),
+            done=rng.random() < done_ratio,
+            location_id=rng.choice(location_ids) if location_ids and rng.random() >= 0.1 else None,
+        )
+        for number in range(tasks)
+    ]
+    new_tasks = Task.objects.bulk_create(new_tasks, batch_size=batch_size)
+    return BenchData(
+        location_ids,
+        [task.id for task in new_tasks if not task.done],
+        [task.id for task in new_tasks if task.done],
+    )
+
+
+# Scenarios, each giving the method, path and data of its next request, or None once it ran out of tasks
+# Destructive scenarios come last, so the others see all the data
+def index_request(data, rng, batch_size):
+    return 'get', reverse('todolist:index'), {}
+
+
+# Task list with no rendered rows cached, every row rendered again as before rows were cached
+def cold_index_request(data, rng, batch_size):
+    row_cache.clear()
+    return 'get', reverse('todolist:index'), {}
+
+
+def pending_index_request(data, rng, batch_size):
+    return 'get', reverse('todolist:index'), {'status': 'pending'}
+
+
+def details_request(data, rng, batch_size):
+    task_ids = data.pending_ids + data.done_ids
+    return task_ids and ('get', reverse('todolist:details', args=[rng.choice(task_ids)]), {})
+
+
+def get_weather_request(data, rng, batch_size):
+    return data.location_ids and ('get', reverse('todolist:get_weather', args=[rng.choice(data.location_ids)]), {})
+
+
+def complete_request(data, rng, batch_size):
+    task_ids = data.take_pending(rng, 1)
+    return task_ids and ('post', reverse('todolist:complete', args=task_ids), {})
+
+
+def bulk_complete_request(data, rng, batch_size):
+    task_ids = data.take_pending(rng, batch_size)
+    return task_ids and ('post', reverse('todolist:bulk_complete'), {'task': task_ids})
+
+
+def bulk_delete_request(data, rng, batch_size):
+    task_ids = data.take_any(rng, batch_size)
+    return task_ids and ('post', reverse('todolist:bulk_delete'), {'task': task_ids})
+
+
+SCENARIOS = {
+    'index': index_request,
+    'index_cold': cold_index_request,
+    'index_pending': pending_index_request,
+    'details': details_request,
+    'get_weather': get_weather_request,
+    'complete': complete_request,
+    'bulk_complete': bulk_complete_request,
+    'bulk_delete': bulk_delete_request,
+}
+
+
+# Run the scenarios `requests` times each against the current database, with the Weather API stubbed by `stub`
+# Bulk scenarios work on `batch_size` tasks per request
+# Returns the report of each scenario by name
+def run_benchmark(data, stub, scenarios, requests, batch_size, rng):
+    client = Client()
+    report = {}
+    for name in scenarios:
+        latencies, queries, errors = [], [], 0
+        upstream_calls = stub.calls
+        for _ in range(requests):
+            request = SCENARIOS[name](data, rng, batch_size)
+            if not request:
+                break
+            method, path, params = request
+            with CaptureQueriesContext(connection) as captured:
+                started_at = time.perf_counter()
+                response = getattr(client, method)(path, params)
+                latencies.append(time.perf_counter() - started_at)
+            queries.append(len(captured))
+            errors += response.status_code >= 400
+        # Calls made by background refreshes are waited for, and counted for the scenario that caused them
+        wait_for_background_work()
+        report[name] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'latency_ms': summarize([latency * 1000 for latency in latencies]),
+            'queries': {'mean': round(sum(queries) / len(queries), 2) if queries else 0, 'max': max(queries, default=0)},
+            'upstream_calls': stub.calls - upstream_calls,
+        }
+    return report
+
+
+# Mean and percentiles of the samples, by nearest rank
+def summarize(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    summary = {'mean': round(sum(samples) / len(samples), 3)}
+    for percentile in PERCENTILES:
+        summary['p%d' % percentile] = round(samples[math.ceil(percentile / 100 * len(samples)) - 1], 3)
+    return summary
+
+
+# Wait for the background refreshes and history writes scheduled so far to finish
+# Refreshes schedule history writes, so they are waited for first
+def wait_for_background_work():
+    for executor in (revalidation_executor, history_executor):
+        executor.drain()
+
+
+# Regressions of a report against a baseline report, as a list of messages
+# Query and Weather API call counts must not grow, p95 latencies must not grow by more than `tolerance`, e.g. 0.2
+def compare_reports(baseline, report, tolerance):
+    regressions = []
+    for name, scenario in report.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if scenario['queries']['max'] > expected['queries']['max']:
+            regressions.append('%s: up to %d queries per request, was %d' % (
+                name, scenario['queries']['max'], expected['queries']['max']
+            ))
+        if scenario['upstream_calls'] > expected['upstream_calls']:
+            regressions.append('%s: %d Weather API calls, was %d' % (
+                name, scenario['upstream_calls'], expected['upstream_calls']
+            ))
+        p95, expected_p95 = scenario['latency_ms'].get('p95'), expected['latency_ms'].get('p95')
+        if p95 is not None and expected_p95 is not None and p95 > expected_p95 * (1 + tolerance):
+            regressions.append('%s: p95 latency %.1fms, was %.1fms' % (name, p95, expected_p95))
+    return regressions
+
+
+# Load a report saved with `manage.py bench --save`
+def load_report(path):
+    with open(path) as baseline:
+        return json.load(baseline)['scenarios']
@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+# Circuit breaker for calls to an unreliable service, within the process
+# Opens after `failure_threshold` failures in a row, calls are rejected while open instead of piling up on the
+# service. After `reset_timeout` seconds a single trial call is let through, half open, its success closes the
+# breaker again and its failure keeps it open for another `reset_timeout` seconds.
+class CircuitBreaker:
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    # Whether a call may be made, the caller must then record its success or failure
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() >= self.opened_at + self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            # Open, or half open with the trial call in flight
+            return False
+
+    # Whether calls are rejected, without letting a trial call through
+    def is_open(self):
+        with self._lock:
+            return self.state == self.OPEN and self.clock() < self.opened_at + self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
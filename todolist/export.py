@@ -0,0 +1,69 @@
+import csv
+import datetime
+import json
+
+from todolist.models import Task
+
+# Columns of the task export, along with the lookups they are read from
+EXPORT_COLUMNS = [
+    ('id', 'id'),
+    ('name', 'name'),
+    ('date', 'date'),
+    ('done', 'done'),
+    ('created_at', 'created_at'),
+    ('modified_at', 'modified_at'),
+    ('location_id', 'location_id'),
+    ('location_name', 'location__name'),
+    ('lat', 'location__lat'),
+    ('lon', 'location__lon'),
+    ('weather_temperature', 'location__weather__temperature'),
+    ('weather_status', 'location__weather__status'),
+    ('weather_modified_at', 'location__weather__modified_at'),
+    ('last_weather_read_temperature', 'last_weather_read__temperature'),
+    ('last_weather_read_status', 'last_weather_read__status'),
+]
+
+
+# Rows of the task export in id order, as tuples of values
+# Reads the rows `chunk_size` at a time from a single joined query, so memory use doesn't grow with the table
+def export_rows(chunk_size):
+    return (
+        Task.objects.order_by('id')
+        .values_list(*(lookup for _, lookup in EXPORT_COLUMNS))
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+# Lines of the task export as CSV, starting with a header line
+def export_csv(chunk_size):
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow([column for column, _ in EXPORT_COLUMNS])
+    for row in export_rows(chunk_size):
+        yield writer.writerow([export_value(value) for value in row])
+
+
+# Lines of the task export as newline delimited JSON, an object per task
+def export_ndjson(chunk_size):
+    columns = [column for column, _ in EXPORT_COLUMNS]
+    for row in export_rows(chunk_size):
+        yield json.dumps(dict(zip(columns, row)), default=export_value) + '\n'
+
+
+# Value as exported, with times in ISO 8601
+def export_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+# Export formats by name, with the line generator and content type of each
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+}
+
+
+# File-like object for csv.writer handing written lines back instead of keeping them
+class LineBuffer:
+    def write(self, line):
+        return line
@@ -1,5 +1,10 @@
+from urllib.parse import urlencode
+
 from django import forms
+from .geocoding import geocode, normalize_query
+from .grid import grid_key
 from .models import Task, Location
+from .pagination import decode_cursor
 
 
 # Form for Task
@@ -23,3 +28,129 @@ class TaskForm(forms.ModelForm):
     class Meta:
         model = Task
         fields = ['name', 'date', 'location']
+
+
+# Form for Task in the JSON API, taking the date as a single ISO 8601 value and the location as an id
+class TaskAPIForm(TaskForm):
+    date = forms.DateTimeField()
+    location = forms.ModelChoiceField(queryset=Location.objects.all(), required=False)
+
+
+# Form for Task rows of bulk imports, validated like the Task form
+# Locations are given as ids and checked against the known ones, instead of a query per row
+class TaskImportForm(forms.ModelForm):
+    date = forms.DateTimeField()
+    location = forms.IntegerField(required=False)
+    done = forms.BooleanField(required=False)
+
+    class Meta:
+        model = Task
+        fields = ['name', 'date', 'done']
+
+    def __init__(self, *args, location_ids, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.location_ids = location_ids
+
+    def clean_location(self):
+        location_id = self.cleaned_data['location']
+        if location_id is not None and location_id not in self.location_ids:
+            raise forms.ValidationError('Unknown location')
+        return location_id
+
+    # The task ready to be created along with others, without saving it
+    def task(self):
+        task = self.save(commit=False)
+        task.location_id = self.cleaned_data['location']
+        return task
+
+
+# Form for Location, looking up the coordinates by the name when both are left out
+class LocationForm(forms.ModelForm):
+    lat = forms.FloatField(required=False, help_text='Leave the coordinates out to look them up by the name')
+    lon = forms.FloatField(required=False)
+
+    class Meta:
+        model = Location
+        fields = ['name', 'lat', 'lon']
+
+    def clean(self):
+        cleaned_data = super().clean()
+        lat, lon = cleaned_data.get('lat'), cleaned_data.get('lon')
+        if lat is None and lon is None and cleaned_data.get('name'):
+            result = self.geocode(cleaned_data['name'])
+            if result is None:
+                raise forms.ValidationError('The place could not be looked up right now, enter its coordinates')
+            if not result.found:
+                self.add_error('name', 'No place found by this name, enter its coordinates')
+            else:
+                cleaned_data['lat'], cleaned_data['lon'] = result.lat, result.lon
+        else:
+            for field in ('lat', 'lon'):
+                if cleaned_data.get(field) is None and field not in self.errors:
+                    self.add_error(field, 'This field is required.')
+        return cleaned_data
+
+    # Look up the place by name, see todolist.geocoding.geocode
+    def geocode(self, name):
+        return geocode(name)
+
+
+# Form for Location rows of bulk imports, validated with the coordinate validators of the model
+# Places to look up by name are looked up beforehand for many rows at once, and given as `geocoded`
+class LocationImportForm(LocationForm):
+
+    def __init__(self, *args, geocoded, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.geocoded = geocoded
+
+    def geocode(self, name):
+        return self.geocoded.get(normalize_query(name))
+
+    # The location ready to be created along with others, without saving it
+    # Creating them in bulk skips Location.save(), so the grid cell is set here
+    def location(self):
+        location = self.save(commit=False)
+        location.grid_key = grid_key(location.lat, location.lon)
+        return location
+
+
+# Form for filtering and paging the Task list
+class TaskFilterForm(forms.Form):
+    status = forms.ChoiceField(choices=[('pending', 'Pending'), ('done', 'Done')], required=False)
+    location = forms.IntegerField(required=False)
+    after = forms.CharField(required=False)
+    before = forms.CharField(required=False)
+
+    def clean_after(self):
+        return self.clean_cursor('after')
+
+    def clean_before(self):
+        return self.clean_cursor('before')
+
+    # Decode a cursor field, empty cursors stay None
+    def clean_cursor(self, name):
+        cursor = self.cleaned_data[name]
+        if not cursor:
+            return None
+        try:
+            return decode_cursor(cursor)
+        except ValueError:
+            raise forms.ValidationError('Invalid cursor')
+
+    # Narrow down the tasks to the filtered ones, invalid filters are ignored
+    def filter_tasks(self, tasks):
+        self.is_valid()
+        status = self.cleaned_data.get('status')
+        if status:
+            tasks = tasks.filter(done=status == 'done')
+        location = self.cleaned_data.get('location')
+        if location is not None:
+            tasks = tasks.filter(location=location)
+        return tasks
+
+    # Query string for the task list with the current filters and the given changes applied
+    def query_string(self, **changes):
+        self.is_valid()
+        params = {name: self.cleaned_data.get(name) for name in ('status', 'location')}
+        params.update(changes)
+        return urlencode({name: value for name, value in params.items() if value is not None and value != ''})
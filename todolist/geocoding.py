@@ -0,0 +1,83 @@
+import concurrent.futures
+import logging
+import re
+
+from django.conf import settings
+
+from todolist.metrics import weather_api_shed
+from todolist.models import GeocodingResult
+from todolist.weather import breaker, take_weather_api_tokens
+from todolist.weather_client import get_client
+
+logger = logging.getLogger(__name__)
+
+
+# Normalize a place query, so queries differing in case or spacing share their cached result
+# e.g. ' paris , FR' and 'Paris,fr' both become 'paris,fr'
+def normalize_query(query):
+    return re.sub(r'\s*,\s*', ',', ' '.join(query.split())).casefold()
+
+
+# Look up the coordinates of a place, e.g. 'Paris,FR'
+# Returns None when the geocoding API couldn't be reached, see geocode_many
+def geocode(query):
+    return geocode_many([query]).get(normalize_query(query))
+
+
+# Look up the coordinates of many places, returns a dict of GeocodingResult by normalized query
+# Cached results are loaded in a single query, the rest are looked up with up to `workers` concurrent API calls
+# and cached for good.
+# The calls share the Weather API rate limit and circuit breaker. Without a `limiter` places past the rate limit
+# aren't looked up, with one each call first waits for a token from it, for commands that can afford to wait.
+# Places the API couldn't be asked about are left out, places it doesn't know have a result without coordinates.
+def geocode_many(queries, workers=None, limiter=None):
+    queries = {normalize_query(query) for query in queries} - {''}
+    results = GeocodingResult.objects.in_bulk(queries)
+    misses = sorted(queries - set(results))
+    if limiter is None:
+        misses = sorted(take_weather_api_tokens(misses))
+    allowed = []
+    for query in misses:
+        if not breaker.allow():
+            weather_api_shed.inc(len(misses) - len(allowed), reason='circuit_open')
+            break
+        allowed.append(query)
+    misses = allowed
+    if not misses:
+        return results
+
+    # Only the API calls run in the pool, the database is touched from the calling thread alone
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(workers or settings.WEATHER_FETCH_WORKERS, len(misses)), thread_name_prefix='geocoding'
+    ) as executor:
+        futures = {}
+        for query in misses:
+            if limiter is not None:
+                limiter.acquire()
+            futures[executor.submit(request_geocode, query)] = query
+    new_results = []
+    for future, query in futures.items():
+        try:
+            place = future.result()
+        except Exception:
+            breaker.record_failure()
+            logger.warning('Geocoding %r failed', query, exc_info=True)
+            continue
+        breaker.record_success()
+        if place is None:
+            new_results.append(GeocodingResult(query=query))
+        else:
+            new_results.append(GeocodingResult(query=query, name=place['name'], lat=place['lat'], lon=place['lon']))
+    # Another caller may have cached the same places meanwhile
+    GeocodingResult.objects.bulk_create(new_results, ignore_conflicts=True)
+    results.update((result.query, result) for result in new_results)
+
+    return results
+
+
+# Look up the best match for the query with the geocoding API, None when there is none
+def request_geocode(query):
+    places = get_client().geocode(query)
+    if not places:
+        return None
+    return {'name': places[0]['name'], 'lat': places[0]['lat'], 'lon': places[0]['lon']}
@@ -0,0 +1,19 @@
+import math
+
+from django.conf import settings
+
+
+# Key of the WEATHER_GRID_SIZE degrees wide grid cell the coordinates fall in
+# Locations in the same cell share their weather reads
+def grid_key(lat, lon):
+    size = settings.WEATHER_GRID_SIZE
+    # Rounding first keeps float noise, e.g. 0.29 / 0.01 = 28.999999999999996, from moving points to the next cell
+    return '%d:%d' % (math.floor(round(lat / size, 6)), math.floor(round(lon / size, 6)))
+
+
+# Group locations by the grid cell they fall in
+def group_by_cell(locations):
+    cells = {}
+    for location in locations:
+        cells.setdefault(location.grid_key, []).append(location)
+    return cells
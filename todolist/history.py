@@ -0,0 +1,198 @@
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour
+
+from todolist.background import BackgroundPool
+from todolist.models import WeatherObservation, WeatherRollup
+from todolist.ratings import rate_observations
+from todolist.weather import RATINGS, run_in_background
+
+# Weather history
+# Every stored weather read is appended to the observations, off the request thread. Observations past
+# WEATHER_HISTORY_RAW_DAYS are rolled up by the hour, hourly rollups past WEATHER_HISTORY_HOURLY_DAYS by the day,
+# and daily rollups past WEATHER_HISTORY_DAILY_DAYS are dropped, see rollup_history.
+
+# Pool writing observations in the background, a single thread keeps the writes in order
+history_executor = BackgroundPool(max_workers=1, thread_name_prefix='weather-history')
+
+# Rolled up values, along with how rollups of shorter periods combine into rollups of longer ones,
+# in the database and in Python
+ROLLUP_AGGREGATES = {
+    'count': (Sum, sum),
+    'temperature_min': (Min, min),
+    'temperature_max': (Max, max),
+    'temperature_sum': (Sum, sum),
+    'bad_count': (Sum, sum),
+    'average_count': (Sum, sum),
+    'good_count': (Sum, sum),
+}
+
+
+# Append new weather reads, given as a dict of reads by location, to the observations
+# The observations are written in the background once the current transaction commits, so requests don't wait on it
+def schedule_observations(weather_reads):
+    now = datetime.datetime.now()
+    observations = [
+        WeatherObservation(
+            location_id=location.id,
+            observed_at=data.get('observed_at') or now,
+            temperature=round(data['temp'] * 10),
+            status=RATINGS.index(data['weather']),
+            condition_id=data.get('condition_id'),
+            daytime=data.get('daytime'),
+        )
+        for location, data in weather_reads.items()
+    ]
+    transaction.on_commit(lambda: history_executor.submit(run_in_background, record_observations, observations))
+
+
+# Write the observations, the ones already known from an earlier read of the same observation are skipped
+def record_observations(observations):
+    WeatherObservation.objects.bulk_create(observations, ignore_conflicts=True)
+
+
+# Apply the retention policy, rolling up and dropping what is past it
+# Works through the history a day at a time, each day in its own transaction
+# Returns the number of rolled up observations and hourly rollups, and the number of dropped daily rollups
+def rollup_history(now=None):
+    now = now or datetime.datetime.now()
+    raw_cutoff = (now - datetime.timedelta(days=settings.WEATHER_HISTORY_RAW_DAYS)).replace(
+        minute=0, second=0, microsecond=0
+    )
+    hourly_cutoff = (now - datetime.timedelta(days=settings.WEATHER_HISTORY_HOURLY_DAYS)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    daily_cutoff = now - datetime.timedelta(days=settings.WEATHER_HISTORY_DAILY_DAYS)
+
+    observations = 0
+    for start, end in day_windows(WeatherObservation.objects.all(), 'observed_at', raw_cutoff):
+        with transaction.atomic():
+            rows = WeatherObservation.objects.filter(observed_at__gte=start, observed_at__lt=end)
+            save_rollups(WeatherRollup.HOUR, start, end, (
+                rows.annotate(bucket=TruncHour('observed_at'))
+                .values('location_id', 'bucket')
+                .annotate(
+                    count=Count('id'),
+                    temperature_min=Min('temperature'),
+                    temperature_max=Max('temperature'),
+                    temperature_sum=Sum('temperature'),
+                    **{
+                        rating + '_count': Count('id', filter=Q(status=status))
+                        for status, rating in enumerate(RATINGS)
+                    },
+                )
+            ))
+            observations += rows.delete()[0]
+
+    hours = 0
+    hourly = WeatherRollup.objects.filter(period=WeatherRollup.HOUR)
+    for start, end in day_windows(hourly, 'start', hourly_cutoff):
+        with transaction.atomic():
+            rows = hourly.filter(start__gte=start, start__lt=end)
+            save_rollups(WeatherRollup.DAY, start, end, (
+                rows.annotate(bucket=TruncDay('start'))
+                .values('location_id', 'bucket')
+                .annotate(**{field: aggregate(field) for field, (aggregate, _) in ROLLUP_AGGREGATES.items()})
+            ))
+            hours += rows.delete()[0]
+
+    days = WeatherRollup.objects.filter(period=WeatherRollup.DAY, start__lt=daily_cutoff).delete()[0]
+
+    return observations, hours, days
+
+
+# Rate the observations again, needed after the way weather is rated changes, e.g. its temperature thresholds
+# Observations are rated a batch at a time from the condition and daytime they keep, the ones that didn't come with
+# them and the rollups, which only keep counts of ratings, stay as they are
+# Returns the number of observations whose rating changed
+def rerate_history(batch_size):
+    rerated = 0
+    last_id = 0
+    while True:
+        batch = list(
+            WeatherObservation.objects.filter(id__gt=last_id, condition_id__isnull=False, daytime__isnull=False)
+            .order_by('id').only('temperature', 'status', 'condition_id', 'daytime')[:batch_size]
+        )
+        if not batch:
+            return rerated
+        changed = []
+        for observation, status in zip(batch, rate_observations(batch)):
+            if observation.status != status:
+                observation.status = status
+                changed.append(observation)
+        WeatherObservation.objects.bulk_update(changed, ['status'])
+        rerated += len(changed)
+        last_id = batch[-1].id
+
+
+# Windows of a day at most, from the day of the oldest row up to the cutoff
+# Rows are expected to be gone from a window once it has been worked through
+def day_windows(rows, field, cutoff):
+    while True:
+        oldest = rows.filter(**{field + '__lt': cutoff}).aggregate(oldest=Min(field))['oldest']
+        if oldest is None:
+            return
+        start = oldest.replace(hour=0, minute=0, second=0, microsecond=0)
+        yield start, min(start + datetime.timedelta(days=1), cutoff)
+
+
+# Upsert the rollups of the period from the aggregated buckets between `start` and `end`
+# Rollups already made for the same buckets, e.g. before observations were stored late, are merged in
+def save_rollups(period, start, end, buckets):
+    existing = {
+        (rollup.location_id, rollup.start): rollup
+        for rollup in WeatherRollup.objects.filter(period=period, start__gte=start, start__lt=end)
+    }
+    rollups = []
+    for bucket in buckets:
+        rollup = WeatherRollup(
+            location_id=bucket['location_id'],
+            period=period,
+            start=bucket['bucket'],
+            **{field: bucket[field] for field in ROLLUP_AGGREGATES},
+        )
+        earlier = existing.get((rollup.location_id, rollup.start))
+        if earlier is not None:
+            for field, (_, combine) in ROLLUP_AGGREGATES.items():
+                setattr(rollup, field, combine((getattr(earlier, field), getattr(rollup, field))))
+        rollups.append(rollup)
+    WeatherRollup.objects.bulk_create(
+        rollups,
+        update_conflicts=True,
+        unique_fields=['location', 'period', 'start'],
+        update_fields=list(ROLLUP_AGGREGATES),
+    )
+
+
+# The weather at the location around a moment, e.g. when a task was scheduled, as a dict of temp and weather
+# Taken from the closest observation within an hour, or else from the rollup of the hour or of the day,
+# None when nothing is known
+def weather_at(location, moment):
+    observations = WeatherObservation.objects.filter(location=location)
+    closest = [
+        observations.filter(observed_at__lte=moment).order_by('-observed_at').first(),
+        observations.filter(observed_at__gt=moment).order_by('observed_at').first(),
+    ]
+    closest = [observation for observation in closest if observation is not None]
+    if closest:
+        observation = min(closest, key=lambda observation: abs(observation.observed_at - moment))
+        if abs(observation.observed_at - moment) <= datetime.timedelta(hours=1):
+            return {'temp': observation.temperature / 10, 'weather': RATINGS[observation.status]}
+
+    for period, start in (
+        (WeatherRollup.HOUR, moment.replace(minute=0, second=0, microsecond=0)),
+        (WeatherRollup.DAY, moment.replace(hour=0, minute=0, second=0, microsecond=0)),
+    ):
+        rollup = WeatherRollup.objects.filter(location=location, period=period, start=start).first()
+        if rollup is not None:
+            # The most common rating, the worse one on a tie
+            counts = [rollup.bad_count, rollup.average_count, rollup.good_count]
+            return {
+                'temp': round(rollup.temperature_sum / rollup.count) / 10,
+                'weather': RATINGS[counts.index(max(counts))],
+            }
+
+    return None
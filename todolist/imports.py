@@ -0,0 +1,138 @@
+import csv
+import functools
+import itertools
+import json
+
+from django.db import transaction
+
+from todolist.forms import LocationImportForm, TaskImportForm
+from todolist.geocoding import geocode_many
+from todolist.models import Location, Task
+
+# Formats files can be imported from
+IMPORT_FORMATS = ['csv', 'json', 'ndjson']
+# Number of failed rows reported in detail, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+# Outcome of an import, with the errors of the failed rows by row number
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, row_number, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row_number, 'errors': errors})
+
+    def as_dict(self):
+        return {'created': self.created, 'failed': self.failed, 'errors': self.errors}
+
+
+# Read the rows of a text file as dicts, one per line after the header for CSV, one per line for NDJSON,
+# or from a single array for JSON
+# Rows that can't be read are given as UnreadableRow, so the rows after them are still read
+def read_rows(file, file_format):
+    if file_format == 'csv':
+        return read_csv(file)
+    if file_format == 'ndjson':
+        return read_ndjson(file)
+    return read_json(file)
+
+
+def read_csv(file):
+    reader = csv.DictReader(file)
+    while True:
+        try:
+            yield next(reader)
+        except StopIteration:
+            return
+        except csv.Error as error:
+            yield UnreadableRow(error)
+
+
+def read_ndjson(file):
+    for line in file:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                yield UnreadableRow(error)
+
+
+def read_json(file):
+    try:
+        rows = json.load(file)
+    except ValueError as error:
+        yield UnreadableRow(error)
+        return
+    if not isinstance(rows, list):
+        yield UnreadableRow('Expected an array')
+        return
+    yield from rows
+
+
+# Row that could not be read, standing in for it in the rows
+class UnreadableRow:
+    def __init__(self, error):
+        self.error = str(error)
+
+
+# Import tasks from the rows, validated like the Task form
+def import_tasks(rows, batch_size):
+    location_ids = set(Location.objects.values_list('id', flat=True))
+    return import_rows(
+        rows, Task, lambda chunk: functools.partial(TaskImportForm, location_ids=location_ids), TaskImportForm.task,
+        batch_size
+    )
+
+
+# Import locations from the rows, validated with the coordinate validators of Location
+# Locations without coordinates are looked up by name, for a batch of rows at once
+# Names past the Weather API rate limit are reported as not looked up, unless a `limiter` is given to wait on,
+# see geocode_many. Requests don't wait, so workers aren't held up by large imports.
+def import_locations(rows, batch_size, limiter=None):
+    def make_forms(chunk):
+        names = [
+            row['name'] for row in chunk
+            if isinstance(row, dict) and isinstance(row.get('name'), str)
+            and row.get('lat') in (None, '') and row.get('lon') in (None, '')
+        ]
+        return functools.partial(LocationImportForm, geocoded=geocode_many(names, limiter=limiter) if names else {})
+
+    return import_rows(rows, Location, make_forms, LocationImportForm.location, batch_size)
+
+
+# Validate each row with a form and create the valid ones `batch_size` at a time, each batch in its own transaction
+# The forms for a batch of rows come from `make_forms`, given the rows of the batch
+# Invalid rows are skipped and reported by their number, counting from 1 after any CSV header
+def import_rows(rows, model, make_forms, make_object, batch_size):
+    result = ImportResult()
+    rows = enumerate(rows, start=1)
+    while chunk := list(itertools.islice(rows, batch_size)):
+        make_form = make_forms([row for _, row in chunk])
+        batch = []
+        for row_number, row in chunk:
+            if isinstance(row, UnreadableRow):
+                result.add_error(row_number, {'__all__': [row.error]})
+                continue
+            if not isinstance(row, dict):
+                result.add_error(row_number, {'__all__': ['Expected an object']})
+                continue
+            form = make_form(row)
+            if not form.is_valid():
+                result.add_error(row_number, {field: list(messages) for field, messages in form.errors.items()})
+                continue
+            batch.append(make_object(form))
+        if batch:
+            result.created += create_batch(model, batch)
+
+    return result
+
+
+# Create the objects in a single statement and transaction, returns how many were created
+def create_batch(model, objects):
+    with transaction.atomic():
+        return len(model.objects.bulk_create(objects))
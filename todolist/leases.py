@@ -0,0 +1,33 @@
+import time
+import uuid
+
+from todolist.models import Lease
+
+# Leases shared by all the processes through database rows, one per key
+# Each batch of leases is claimed with a single conditional UPDATE, so concurrent callers can't both claim a key,
+# and nothing stays locked while the leases are held. A lease not released in time expires, e.g. when its holder
+# died. Expiry goes by the wall clock, the clocks of the hosts are expected to be in sync.
+
+
+# Claim the leases of the keys nobody holds for `seconds`, returns the id of the holder and the keys claimed
+def claim_leases(keys, seconds, clock=time.time):
+    keys = set(keys)
+    if not keys:
+        return None, set()
+    holder = uuid.uuid4().hex
+    now = clock()
+    # The first claim of a key creates its lease, expired
+    Lease.objects.bulk_create([Lease(key=key, holder='', expires_at=0) for key in keys], ignore_conflicts=True)
+    Lease.objects.filter(key__in=keys, expires_at__lte=now).update(holder=holder, expires_at=now + seconds)
+    return holder, set(Lease.objects.filter(key__in=keys, holder=holder).values_list('key', flat=True))
+
+
+# Release the leases of the keys claimed by `holder`, before they expire
+def release_leases(holder, keys):
+    if keys:
+        Lease.objects.filter(key__in=keys, holder=holder).update(expires_at=0)
+
+
+# Keys among the keys whose leases are held
+def held_leases(keys, clock=time.time):
+    return set(Lease.objects.filter(key__in=keys, expires_at__gt=clock()).values_list('key', flat=True))
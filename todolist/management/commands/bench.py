@@ -0,0 +1,79 @@
+import json
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from todolist.bench import SCENARIOS, compare_reports, generate_data, load_report, run_benchmark
+from todolist.task_rows import row_cache
+from todolist.weather import local_cache
+from todolist.weather_stub import StubWeatherServer
+
+
+# Benchmark the task list and weather endpoints on synthetic data, reporting latencies, queries and API calls as JSON
+# Runs in a throwaway database, with a local cache and a local stand-in for the Weather API,
+# so it never touches real data or calls the real API
+class Command(BaseCommand):
+    help = 'Benchmark the task list and weather endpoints on synthetic data and report the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=10000, help='Number of tasks to generate')
+        parser.add_argument('--locations', type=int, default=200, help='Number of locations to generate')
+        parser.add_argument('--done-ratio', type=float, default=0.3, help='Share of the tasks generated done')
+        parser.add_argument('--requests', type=int, default=100, help='Number of requests per scenario')
+        parser.add_argument('--batch-size', type=int, default=50, help='Number of tasks per bulk request')
+        parser.add_argument(
+            '--scenario', action='append', choices=list(SCENARIOS), dest='scenarios',
+            help='Scenario to run, can be repeated, all of them if left out'
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the generated data and requests')
+        parser.add_argument(
+            '--api-delay', type=float, default=0.05, help='Seconds the stubbed Weather API takes to answer'
+        )
+        parser.add_argument('--save', help='File to save the report to, as a baseline for later runs')
+        parser.add_argument('--compare', help='Baseline report to fail on regressions against')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2, help='Allowed growth of p95 latencies over the baseline'
+        )
+
+    def handle(self, *args, **options):
+        config = {
+            option: options[option]
+            for option in ('tasks', 'locations', 'done_ratio', 'requests', 'batch_size', 'seed', 'api_delay')
+        }
+        config['scenarios'] = options['scenarios'] or list(SCENARIOS)
+        rng = random.Random(options['seed'])
+
+        setup_test_environment()
+        database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with StubWeatherServer(delay=options['api_delay']) as stub, override_settings(
+                WEATHER_API=stub.url,
+                WEATHER_API_ONECALL='data/2.5/weather?',
+                WEATHER_API_DIRECT='geo/1.0/direct?',
+                WEATHER_API_KEY='bench',
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            ):
+                local_cache.clear()
+                row_cache.clear()
+                data = generate_data(options['tasks'], options['locations'], options['done_ratio'], rng)
+                report = run_benchmark(
+                    data, stub, config['scenarios'], options['requests'], options['batch_size'], rng
+                )
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            teardown_test_environment()
+
+        results = json.dumps({'config': config, 'scenarios': report}, indent=2)
+        self.stdout.write(results)
+        if options['save']:
+            with open(options['save'], 'w') as baseline:
+                baseline.write(results + '\n')
+        if options['compare']:
+            regressions = compare_reports(load_report(options['compare']), report, options['tolerance'])
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError('%d regressions against %s' % (len(regressions), options['compare']))
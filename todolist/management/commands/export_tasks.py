@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from todolist.export import EXPORT_FORMATS
+
+
+# Export all tasks along with their locations and weather reads, e.g. for nightly reports
+class Command(BaseCommand):
+    help = 'Export all tasks along with their locations and weather reads as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv', help='Format of the export')
+        parser.add_argument('--output', help='File to write the export to, standard output if left out')
+        parser.add_argument(
+            '--chunk-size', type=int, default=settings.BULK_BATCH_SIZE, help='Number of tasks read at a time'
+        )
+
+    def handle(self, *args, **options):
+        export_lines = EXPORT_FORMATS[options['format']][0]
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(export_lines(options['chunk_size']))
+        else:
+            for line in export_lines(options['chunk_size']):
+                self.stdout.write(line, ending='')
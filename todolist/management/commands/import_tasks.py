@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from todolist.imports import IMPORT_FORMATS, import_tasks, read_rows
+
+
+# Import tasks from a CSV, JSON or NDJSON file, skipping and reporting invalid rows
+class Command(BaseCommand):
+    help = 'Import tasks from a CSV, JSON or NDJSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='File to import')
+        parser.add_argument(
+            '--format', choices=IMPORT_FORMATS, help='Format of the file, taken from its extension if left out'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.BULK_BATCH_SIZE, help='Number of tasks created at a time'
+        )
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or options['file'].rpartition('.')[2].lower()
+        if file_format not in IMPORT_FORMATS:
+            raise CommandError('Format must be one of: %s' % ', '.join(IMPORT_FORMATS))
+        with open(options['file'], encoding='utf-8-sig', newline='') as file:
+            result = import_tasks(read_rows(file, file_format), options['batch_size'])
+        for error in result.errors:
+            messages = '; '.join(
+                '%s: %s' % (field, ' '.join(field_messages)) for field, field_messages in error['errors'].items()
+            )
+            self.stderr.write('Row %d: %s' % (error['row'], messages))
+        self.stdout.write('Imported %d tasks, %d rows failed' % (result.created, result.failed))
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from todolist.sync import prune_deletions
+
+
+# Forget deleted tasks past the sync feed retention, meant to run daily
+class Command(BaseCommand):
+    help = 'Delete the deleted tasks logged for the sync feed more than TASKS_SYNC_RETENTION_DAYS ago'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.BULK_BATCH_SIZE, help='Number of log entries deleted at a time'
+        )
+
+    def handle(self, *args, **options):
+        pruned = prune_deletions(options['batch_size'])
+        self.stdout.write('Pruned %d deleted tasks from the sync feed' % pruned)
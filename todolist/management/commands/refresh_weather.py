@@ -0,0 +1,85 @@
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models import Exists, F, OuterRef, Q
+
+from todolist.grid import group_by_cell
+from todolist.models import Location, Task
+from todolist.weather import refresh_weather, weather_api_limiter
+
+logger = logging.getLogger(__name__)
+
+
+# Worker keeping the weather reads of locations with open tasks fresh
+# Refreshes reads shortly before they expire, so views can serve them from the database alone.
+# Reads are refreshed a batch of grid cells at a time, claiming their leases like the views do, so the views and
+# other workers wait for these reads rather than fetching them too.
+class Command(BaseCommand):
+    help = 'Refresh weather reads of locations with open tasks before they expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run a single refresh pass and exit')
+        parser.add_argument(
+            '--interval', type=float, default=30, help='Seconds between refresh passes'
+        )
+        parser.add_argument(
+            '--lead', type=float, default=60, help='Seconds before a read expires to refresh it'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.WEATHER_FETCH_WORKERS,
+            help='Maximum number of concurrent Weather API calls'
+        )
+        parser.add_argument(
+            '--rate', type=float, default=settings.WEATHER_API_RATE_LIMIT,
+            help='Maximum number of Weather API calls per minute, shared with the other processes'
+        )
+
+    def handle(self, *args, **options):
+        limiter = weather_api_limiter(options['rate'])
+        while True:
+            try:
+                self.refresh(options, limiter)
+            except Exception:
+                logger.exception('Refreshing weather reads failed')
+            if options['once']:
+                break
+            # A long-lived worker must not hold on to broken or timed out connections between passes
+            close_old_connections()
+            time.sleep(options['interval'])
+
+    # Refresh the due reads, `concurrency` grid cells at a time
+    def refresh(self, options, limiter):
+        due_before = self.due_before(options['lead'])
+        locations = self.due_locations(due_before)
+        cells = list(group_by_cell(locations).values())
+        rate = (options['rate'] or settings.WEATHER_API_RATE_LIMIT) / 60
+        refreshed = 0
+        for start in range(0, len(cells), options['concurrency']):
+            batch = cells[start:start + options['concurrency']]
+            # Long enough to wait for a token for each cell and then make the calls
+            deadline = len(batch) / rate + settings.WEATHER_FETCH_DEADLINE
+            weather_reads = refresh_weather(
+                [location for cell in batch for location in cell], deadline,
+                fresh_after=due_before, workers=options['concurrency'], limiter=limiter,
+            )
+            refreshed += sum(
+                1 for data in weather_reads.values() if data['age'] < settings.WEATHER_CACHE_TTL - options['lead']
+            )
+        self.stdout.write('Refreshed %d of %d due locations' % (refreshed, len(locations)))
+
+    # Time before which reads are due, expiring within `lead` seconds
+    def due_before(self, lead):
+        return datetime.datetime.now() - datetime.timedelta(seconds=settings.WEATHER_CACHE_TTL - lead)
+
+    # Locations with open tasks whose weather read is missing or from before `due_before`, oldest read first
+    def due_locations(self, due_before):
+        return list(
+            Location.objects
+            .filter(Exists(Task.objects.filter(location=OuterRef('pk'), done=False)))
+            .filter(Q(weather__isnull=True) | Q(weather__modified_at__lt=due_before))
+            .order_by(F('weather__modified_at').asc(nulls_first=True))
+        )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from todolist.grid import grid_key
+from todolist.models import Location
+
+
+# Recompute the weather grid cells of all locations, needed after WEATHER_GRID_SIZE changes
+class Command(BaseCommand):
+    help = 'Recompute the weather grid cells of all locations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of locations updated at a time')
+
+    def handle(self, *args, **options):
+        changed = []
+        for location in Location.objects.only('lat', 'lon', 'grid_key').iterator(chunk_size=options['batch_size']):
+            key = grid_key(location.lat, location.lon)
+            if location.grid_key != key:
+                location.grid_key = key
+                changed.append(location)
+        Location.objects.bulk_update(changed, ['grid_key'], batch_size=options['batch_size'])
+        self.stdout.write('Moved %d locations to new grid cells' % len(changed))
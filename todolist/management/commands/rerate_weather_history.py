@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from todolist.history import rerate_history
+
+
+# Rate the weather observations again, needed after the way weather is rated changes
+class Command(BaseCommand):
+    help = 'Rate the kept weather observations again from their condition, temperature and daytime'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.BULK_BATCH_SIZE, help='Number of observations rated at a time'
+        )
+
+    def handle(self, *args, **options):
+        rerated = rerate_history(options['batch_size'])
+        self.stdout.write('Changed the rating of %d weather observations' % rerated)
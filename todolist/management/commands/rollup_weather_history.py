@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from todolist.history import rollup_history
+
+
+# Apply the weather history retention policy, meant to run daily
+class Command(BaseCommand):
+    help = 'Roll up weather observations and hourly rollups past their retention, and drop expired daily rollups'
+
+    def handle(self, *args, **options):
+        observations, hours, days = rollup_history()
+        self.stdout.write(
+            'Rolled up %d observations and %d hourly rollups, dropped %d daily rollups' % (observations, hours, days)
+        )
@@ -0,0 +1,327 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+# Metrics of this process, served in the Prometheus text format by the /metrics endpoint
+# Requests are measured by RequestMetricsMiddleware, the weather module and the template backend below add
+# what they measure to the request being served, if any, see current_request.
+
+
+# Counter of events by label values
+# A counter without labels can read its count from a function whenever the metrics are rendered instead, for events
+# already counted elsewhere
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.function = None
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set_function(self, function):
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    # Lines of the counter in the Prometheus text format
+    def samples(self):
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                logger.warning('Reading counter %s failed', self.name, exc_info=True)
+                return
+            yield '%s %s' % (self.name, format_value(value))
+            return
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '%s%s %s' % (self.name, format_labels(zip(self.labelnames, key)), format_value(value))
+
+
+# Gauge of a single value, either set or read from a function whenever the metrics are rendered
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.function = None
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def value(self):
+        return self.function() if self.function is not None else self._value
+
+    def clear(self):
+        self._value = 0
+
+    # Line of the gauge in the Prometheus text format, none when its value can't be read
+    def samples(self):
+        try:
+            value = self.value()
+        except Exception:
+            logger.warning('Reading gauge %s failed', self.name, exc_info=True)
+            return
+        if value is not None:
+            yield '%s %s' % (self.name, format_value(value))
+
+
+# Histogram of observed values by label values, counting the values up to each of the `buckets` upper bounds
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # Bucket counts, not cumulated, sum and count by label values
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    # Number of observed values
+    def count(self, **labels):
+        with self._lock:
+            values = self._values.get(tuple(labels[name] for name in self.labelnames))
+            return values[2] if values else 0
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    # Lines of the histogram in the Prometheus text format
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulated = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulated += bucket_count
+                yield '%s_bucket%s %d' % (
+                    self.name, format_labels(labels + [('le', format_value(bound))]), cumulated
+                )
+            yield '%s_sum%s %s' % (self.name, format_labels(labels), format_value(total))
+            yield '%s_count%s %d' % (self.name, format_labels(labels), count)
+
+
+def format_labels(labels):
+    labels = list(labels)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Upper bounds in seconds of request and Weather API call durations
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the number of database queries of a request
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+request_duration = Histogram(
+    'todolist_request_duration_seconds', 'Time spent serving requests', ('view',), DURATION_BUCKETS
+)
+request_queries = Histogram(
+    'todolist_request_queries', 'Database queries made by requests', ('view',), QUERY_COUNT_BUCKETS
+)
+request_query_duration = Histogram(
+    'todolist_request_query_duration_seconds', 'Time requests spent in database queries', ('view',), DURATION_BUCKETS
+)
+request_weather_duration = Histogram(
+    'todolist_request_weather_duration_seconds', 'Time requests spent waiting on Weather API calls', ('view',),
+    DURATION_BUCKETS,
+)
+request_render_duration = Histogram(
+    'todolist_request_render_duration_seconds', 'Time requests spent rendering templates', ('view',), DURATION_BUCKETS
+)
+weather_api_calls = Histogram(
+    'todolist_weather_api_call_duration_seconds', 'Duration of Weather API calls by outcome', ('outcome',),
+    DURATION_BUCKETS,
+)
+weather_cache_lookups = Counter(
+    'todolist_weather_cache_lookups_total',
+    'Weather reads looked up by where they were found, local memory, shared cache or database, or missing',
+    ('result',),
+)
+task_row_cache_lookups = Counter(
+    'todolist_task_row_cache_lookups_total', 'Rendered rows of the task list looked up, by result, hit or miss',
+    ('result',),
+)
+weather_local_cache_size = Gauge(
+    'todolist_weather_local_cache_size', 'Weather reads held in the local cache of this process'
+)
+weather_local_cache_hits = Counter(
+    'todolist_weather_local_cache_hits_total', 'Weather reads found in the local cache of this process'
+)
+weather_local_cache_misses = Counter(
+    'todolist_weather_local_cache_misses_total', 'Weather reads missing or expired in the local cache of this process'
+)
+weather_local_cache_evictions = Counter(
+    'todolist_weather_local_cache_evictions_total', 'Weather reads evicted from the full local cache of this process'
+)
+weather_api_shed = Counter(
+    'todolist_weather_api_shed_total',
+    'Weather API calls skipped to shed load, by reason, rate_limit or circuit_open',
+    ('reason',),
+)
+weather_api_tokens = Gauge(
+    'todolist_weather_api_tokens', 'Tokens left in the Weather API rate limit bucket shared by all processes'
+)
+weather_breaker_state = Gauge(
+    'todolist_weather_breaker_state', 'State of the Weather API circuit breaker, 0 closed, 1 half open, 2 open'
+)
+
+REGISTRY = [
+    request_duration,
+    request_queries,
+    request_query_duration,
+    request_weather_duration,
+    request_render_duration,
+    weather_api_calls,
+    weather_cache_lookups,
+    weather_local_cache_size,
+    weather_local_cache_hits,
+    weather_local_cache_misses,
+    weather_local_cache_evictions,
+    task_row_cache_lookups,
+    weather_api_shed,
+    weather_api_tokens,
+    weather_breaker_state,
+]
+
+
+# All the metrics in the Prometheus text format
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+# Measurements of the request being served
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.weather_calls = 0
+        self.weather_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.render_time = 0.0
+
+    # Database execute wrapper timing the queries
+    def time_query(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_time += time.perf_counter() - started_at
+            self.queries += 1
+
+    # Value of the Server-Timing header, durations in milliseconds
+    def server_timing(self, total):
+        return ', '.join([
+            'db;dur=%.1f;desc="%d queries"' % (self.query_time * 1000, self.queries),
+            'weather;dur=%.1f;desc="%d calls"' % (self.weather_time * 1000, self.weather_calls),
+            'cache;desc="%d hits / %d misses"' % (self.cache_hits, self.cache_misses),
+            'render;dur=%.1f' % (self.render_time * 1000),
+            'total;dur=%.1f' % (total * 1000),
+        ])
+
+
+# Measurements of the request being served by the current thread or task, None outside of requests
+current_request = contextvars.ContextVar('current_request_metrics', default=None)
+
+
+# Record `calls` Weather API calls, waited on for `seconds` by the current request
+def record_weather_calls(calls, seconds):
+    request_metrics = current_request.get()
+    if request_metrics is not None:
+        request_metrics.weather_calls += calls
+        request_metrics.weather_time += seconds
+
+
+# Record weather reads looked up, by where they were found, e.g. {'local': 2, 'database': 1, 'miss': 1}
+def record_weather_lookups(results):
+    for result, count in results.items():
+        if count:
+            weather_cache_lookups.inc(count, result=result)
+    request_metrics = current_request.get()
+    if request_metrics is not None:
+        request_metrics.cache_misses += results.get('miss', 0)
+        request_metrics.cache_hits += sum(results.values()) - results.get('miss', 0)
+
+
+# Template backend timing template renders for the current request
+# Used in place of django.template.backends.django.DjangoTemplates in the TEMPLATES setting
+class TimedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        request_metrics = current_request.get()
+        if request_metrics is None:
+            return self.template.render(context, request)
+        started_at = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            request_metrics.render_time += time.perf_counter() - started_at
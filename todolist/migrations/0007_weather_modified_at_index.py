@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todolist', '0006_lastweatherread'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='weather',
+            name='modified_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todolist', '0007_weather_modified_at_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['date', 'id'], name='task_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['done', 'date', 'id'], name='task_done_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['location', 'date', 'id'], name='task_location_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:12
+
+import math
+
+from django.db import migrations, models
+
+# Grid size in degrees the keys are computed with, the default of WEATHER_GRID_SIZE when the grid was introduced
+# Run `manage.py regrid_locations` to apply another one
+GRID_SIZE = 0.01
+
+
+# Same computation as todolist.grid.grid_key at the time, kept here so later changes to it don't change this migration
+def grid_key(lat, lon):
+    return '%d:%d' % (math.floor(round(lat / GRID_SIZE, 6)), math.floor(round(lon / GRID_SIZE, 6)))
+
+
+def set_grid_keys(apps, schema_editor):
+    Location = apps.get_model('todolist', 'Location')
+    locations = list(Location.objects.all())
+    for location in locations:
+        location.grid_key = grid_key(location.lat, location.lon)
+    Location.objects.bulk_update(locations, ['grid_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todolist', '0008_task_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='grid_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=50),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_grid_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todolist', '0010_task_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodingResult',
+            fields=[
+                ('query', models.CharField(max_length=500, primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, max_length=500)),
+                ('lat', models.FloatField(null=True)),
+                ('lon', models.FloatField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todolist', '0011_geocodingresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeatherObservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('observed_at', models.DateTimeField()),
+                ('temperature', models.SmallIntegerField()),
+                ('status', models.SmallIntegerField()),
+                ('condition_id', models.SmallIntegerField(null=True)),
+                ('daytime', models.BooleanField(null=True)),
+                ('location', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='observations', to='todolist.location'
+                )),
+            ],
+            options={
+                'indexes': [models.Index(fields=['observed_at'], name='observation_observed_at_idx')],
+                'constraints': [
+                    models.UniqueConstraint(
+                        fields=('location', 'observed_at'), name='observation_location_observed_at_uniq'
+                    ),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name='WeatherRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('temperature_min', models.SmallIntegerField()),
+                ('temperature_max', models.SmallIntegerField()),
+                ('temperature_sum', models.IntegerField()),
+                ('bad_count', models.PositiveIntegerField()),
+                ('average_count', models.PositiveIntegerField()),
+                ('good_count', models.PositiveIntegerField()),
+                ('location', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='todolist.location'
+                )),
+            ],
+            options={
+                'indexes': [models.Index(fields=['period', 'start'], name='rollup_period_start_idx')],
+                'constraints': [
+                    models.UniqueConstraint(
+                        fields=('location', 'period', 'start'), name='rollup_location_period_start_uniq'
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todolist', '0013_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('key', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('holder', models.CharField(max_length=32)),
+                ('expires_at', models.FloatField()),
+            ],
+        ),
+    ]
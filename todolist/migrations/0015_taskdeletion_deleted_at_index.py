@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todolist', '0014_lease'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='taskdeletion',
+            index=models.Index(fields=['deleted_at', 'id'], name='taskdeletion_deleted_at_id_idx'),
+        ),
+    ]
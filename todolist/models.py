@@ -1,5 +1,54 @@
+import datetime
+
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery
+
+from todolist.grid import grid_key
+
+
+# Set-based operations on many tasks at once
+class TaskQuerySet(models.QuerySet):
+
+    # Mark the tasks as done, saving the last weather read of each task's location along
+    # Runs a few statements however many tasks there are, tasks already done are left as they are
+    def complete(self):
+        with transaction.atomic():
+            tasks = self.filter(done=False)
+            # Snapshot the weather reads in a single query, they won't be fetching weather updates anymore
+            # Locations share the latest read of their grid cell, whichever location of the cell it was stored for
+            latest = Weather.objects.filter(location__grid_key=OuterRef('location__grid_key')).order_by('-modified_at')
+            snapshots = tasks.annotate(
+                snapshot_temperature=Subquery(latest.values('temperature')[:1]),
+                snapshot_status=Subquery(latest.values('status')[:1]),
+            ).filter(snapshot_status__isnull=False).values_list('id', 'snapshot_temperature', 'snapshot_status')
+            LastWeatherRead.objects.bulk_create(
+                [
+                    LastWeatherRead(task_id=task_id, temperature=temperature, status=status)
+                    for task_id, temperature, status in snapshots
+                ],
+                ignore_conflicts=True,
+            )
+            # update() skips auto_now, so modified_at is set explicitly
+            return tasks.update(done=True, modified_at=datetime.datetime.now())
+
+    # Delete the tasks, logging them for the sync feed
+    def delete(self):
+        with transaction.atomic():
+            TaskDeletion.objects.bulk_create([TaskDeletion(task_id=pk) for pk in self.values_list('pk', flat=True)])
+            return super().delete()
+
+    # Delete the tasks `batch_size` at a time, each batch in its own transaction
+    # Keeps memory use and lock times bounded however many tasks there are, returns the number of deleted tasks
+    def delete_in_batches(self, batch_size):
+        deleted = 0
+        while True:
+            batch = list(self.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                return deleted
+            with transaction.atomic():
+                # The last weather reads of the batch go along in a single statement
+                deleted += Task.objects.filter(pk__in=batch).delete()[1].get(Task._meta.label, 0)
 
 
 # Model for todolist item
@@ -13,20 +62,73 @@ class Task(models.Model):
         'Location', on_delete=models.SET_NULL, null=True, blank=True
     )
 
+    objects = TaskQuerySet.as_manager()
+
+    class Meta:
+        # Indexes for paging through the Task list in (date, id) order, unfiltered and filtered
+        indexes = [
+            models.Index(fields=['date', 'id'], name='task_date_id_idx'),
+            models.Index(fields=['done', 'date', 'id'], name='task_done_date_id_idx'),
+            models.Index(fields=['location', 'date', 'id'], name='task_location_date_id_idx'),
+            # Index for the sync feed, walking through changed tasks in (modified_at, id) order
+            models.Index(fields=['modified_at', 'id'], name='task_modified_at_id_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
+    # Delete the task, logging it for the sync feed
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            TaskDeletion.objects.create(task_id=self.pk)
+            return super().delete(*args, **kwargs)
+
+
+# Log of deleted tasks, serving as tombstones in the sync feed
+class TaskDeletion(models.Model):
+    # Not a foreign key, the task is gone
+    task_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class Meta:
+        # Index for the cursor of first syncs and for pruning the log by age
+        indexes = [models.Index(fields=['deleted_at', 'id'], name='taskdeletion_deleted_at_id_idx')]
+
 
 # Model for Location
 class Location(models.Model):
     name = models.CharField(max_length=500)
     lat = models.FloatField(validators=[MinValueValidator(-90), MaxValueValidator(90)])
     lon = models.FloatField(validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    # Weather grid cell of the location, locations in the same cell share their weather reads
+    grid_key = models.CharField(max_length=50, db_index=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.grid_key = grid_key(self.lat, self.lon)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
 
 
+# Model for cached geocoding results, so looking up the same place again doesn't call the geocoding API
+# Places that weren't found are kept too, without coordinates
+class GeocodingResult(models.Model):
+    # Normalized query, see todolist.geocoding.normalize_query
+    query = models.CharField(max_length=500, primary_key=True)
+    name = models.CharField(max_length=500, blank=True)
+    lat = models.FloatField(null=True)
+    lon = models.FloatField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    @property
+    def found(self):
+        return self.lat is not None
+
+    def __str__(self):
+        return self.query
+
+
 # Model for Weather
 class Weather(models.Model):
     # When the location for the weather read is deleted, the read is obsolete and should be deleted along
@@ -35,12 +137,83 @@ class Weather(models.Model):
     )
     temperature = models.FloatField()
     status = models.CharField(max_length=500)
-    modified_at = models.DateTimeField(auto_now=True, editable=False)
+    # Indexed for finding expired reads
+    modified_at = models.DateTimeField(auto_now=True, editable=False, db_index=True)
 
     def __str__(self):
         return self.status + ', ' + str(self.temperature)
 
 
+# Model for the history of weather observations, appended to on every read and never changed
+# Kept compact, temperatures in tenths of a degree and ratings as codes, see todolist.history
+class WeatherObservation(models.Model):
+    location = models.ForeignKey('Location', on_delete=models.CASCADE, related_name='observations')
+    # When the Weather API observed the weather
+    observed_at = models.DateTimeField()
+    temperature = models.SmallIntegerField()
+    status = models.SmallIntegerField()
+    # Most severe condition id and whether it was daytime, enough to rate the observation again, unknown for
+    # observations that didn't come with them
+    condition_id = models.SmallIntegerField(null=True)
+    daytime = models.BooleanField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['location', 'observed_at'], name='observation_location_observed_at_uniq'),
+        ]
+        # Index for rolling up and expiring observations by time across all locations
+        indexes = [models.Index(fields=['observed_at'], name='observation_observed_at_idx')]
+
+
+# Model for weather observations rolled up by the hour or by the day, once they are past their retention
+class WeatherRollup(models.Model):
+    HOUR = 'hour'
+    DAY = 'day'
+
+    location = models.ForeignKey('Location', on_delete=models.CASCADE, related_name='rollups')
+    period = models.CharField(max_length=4, choices=[(HOUR, 'Hour'), (DAY, 'Day')])
+    start = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    # Temperatures in tenths of a degree, the sum along with the count gives the mean
+    temperature_min = models.SmallIntegerField()
+    temperature_max = models.SmallIntegerField()
+    temperature_sum = models.IntegerField()
+    # Number of observations of each rating
+    bad_count = models.PositiveIntegerField()
+    average_count = models.PositiveIntegerField()
+    good_count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['location', 'period', 'start'], name='rollup_location_period_start_uniq'),
+        ]
+        # Index for rolling up and expiring rollups by time across all locations
+        indexes = [models.Index(fields=['period', 'start'], name='rollup_period_start_idx')]
+
+
+# Model for token buckets shared by all the processes, see todolist.rate_limit.SharedTokenBucket
+class RateLimitBucket(models.Model):
+    name = models.CharField(max_length=100, primary_key=True)
+    tokens = models.FloatField()
+    # Seconds since the epoch of the last refill, comparable between hosts
+    updated_at = models.FloatField()
+
+    def __str__(self):
+        return self.name
+
+
+# Model for leases on work held by one caller at a time across all the processes, see todolist.leases
+class Lease(models.Model):
+    key = models.CharField(max_length=100, primary_key=True)
+    # Random id of the caller holding the lease
+    holder = models.CharField(max_length=32)
+    # Seconds since the epoch the lease is held until, comparable between hosts
+    expires_at = models.FloatField()
+
+    def __str__(self):
+        return self.key
+
+
 # Model for last weather reads of Done Tasks
 class LastWeatherRead(models.Model):
     task = models.OneToOneField(
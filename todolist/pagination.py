@@ -0,0 +1,57 @@
+import base64
+import binascii
+import datetime
+
+from django.db.models import Q
+
+
+# Encode a cursor pointing at the task's position in the (date, id) ordering of the Task list
+def encode_cursor(task):
+    position = '%s|%d' % (task.date.isoformat(), task.id)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+# Decode a cursor into the (date, id) position it points at, raises ValueError for malformed cursors
+def decode_cursor(cursor):
+    try:
+        date, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(date), int(task_id)
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError('Malformed cursor')
+
+
+# Page of tasks with cursors for the neighbouring pages, a cursor is None when there is no such page
+class TaskPage:
+    def __init__(self, tasks, next_cursor, previous_cursor):
+        self.tasks = tasks
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+
+# Get a page of tasks in (date, id) order, starting right after the `after` cursor or ending right before `before`
+# Seeks through the (date, id) index instead of counting rows with OFFSET, so every page costs the same
+def paginate_tasks(tasks, size, after=None, before=None):
+    if before is not None:
+        date, task_id = before
+        # Walk backwards from the cursor, one extra row tells whether there is an earlier page
+        page = list(
+            tasks.filter(Q(date__lte=date) & (Q(date__lt=date) | Q(id__lt=task_id))).order_by('-date', '-id')[:size + 1]
+        )
+        has_previous = len(page) > size
+        page = page[:size][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            date, task_id = after
+            tasks = tasks.filter(Q(date__gte=date) & (Q(date__gt=date) | Q(id__gt=task_id)))
+        # One extra row tells whether there is a later page
+        page = list(tasks.order_by('date', 'id')[:size + 1])
+        has_next = len(page) > size
+        page = page[:size]
+        has_previous = after is not None
+
+    return TaskPage(
+        page,
+        encode_cursor(page[-1]) if page and has_next else None,
+        encode_cursor(page[0]) if page and has_previous else None,
+    )
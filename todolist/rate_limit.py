@@ -0,0 +1,94 @@
+import threading
+import time
+
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Greatest, Least
+
+from todolist.models import RateLimitBucket
+
+
+# Token bucket rate limiter
+# Lets through `rate` calls per second on average, with bursts of up to `capacity` calls
+class TokenBucket:
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    # Take a token if one is available, returns the seconds to wait for the next token otherwise
+    def try_acquire(self):
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    # Take a token, waiting for one if needed
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait:
+            self.sleep(wait)
+            wait = self.try_acquire()
+
+
+# Token bucket shared by all the processes through a database row, named `name`
+# Each token is taken with a single conditional UPDATE, so concurrent takers can't overdraw the bucket.
+# The row stays locked until the transaction taking a token ends, so tokens are best taken outside of transactions.
+# Refills go by the wall clock, the clocks of the hosts are expected to be in sync.
+class SharedTokenBucket(TokenBucket):
+    def __init__(self, name, rate, capacity=1, clock=time.time, sleep=time.sleep):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+
+    # Take `count` tokens at once if they are available, returns the seconds to wait for them otherwise
+    def try_acquire(self, count=1):
+        while True:
+            now = self.clock()
+            # A clock behind the one that last refilled the bucket doesn't take tokens away
+            refill = Greatest(Value(now) - F('updated_at'), Value(0.0)) * Value(float(self.rate))
+            taken = RateLimitBucket.objects.filter(name=self.name, tokens__gte=Value(float(count)) - refill).update(
+                tokens=(
+                    Least(F('tokens') + refill, Value(float(self.capacity)), output_field=FloatField())
+                    - Value(float(count))
+                ),
+                updated_at=Greatest(F('updated_at'), Value(now)),
+            )
+            if taken:
+                return 0
+            tokens = self.tokens(now)
+            if tokens is None:
+                # The first taker creates the bucket full
+                RateLimitBucket.objects.bulk_create(
+                    [RateLimitBucket(name=self.name, tokens=self.capacity, updated_at=now)], ignore_conflicts=True
+                )
+            elif tokens < count:
+                return (count - tokens) / self.rate
+            # Otherwise another taker created or refilled the bucket meanwhile, take the tokens from it
+
+    # Take up to `count` tokens without waiting, as many as are available, returns how many were taken
+    # Takes them in a single statement when they all are available
+    def take(self, count):
+        while count >= 1:
+            if self.try_acquire(count) == 0:
+                return count
+            count = min(count - 1, int(self.tokens() or 0))
+        return 0
+
+    # Tokens left in the bucket, None when nobody took any yet
+    def tokens(self, now=None):
+        now = self.clock() if now is None else now
+        bucket = RateLimitBucket.objects.filter(name=self.name).values_list('tokens', 'updated_at').first()
+        if bucket is None:
+            return None
+        tokens, updated_at = bucket
+        return min(self.capacity, tokens + max(0, now - updated_at) * self.rate)
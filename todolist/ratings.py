@@ -0,0 +1,118 @@
+import bisect
+import functools
+import itertools
+import operator
+from array import array
+
+from todolist.weather import COLD_BELOW, RATINGS, WARM_BELOW, condition_severity, parse_weather, rate_weather
+
+# Batch counterpart of parse_weather, parse_temp, is_daytime and rate_weather in todolist.weather
+# Rates many observations at once from columns of values, giving the same ratings as the scalar functions.
+# Every step works on a whole column and keeps its results as small integer codes in arrays, the ratings
+# are looked up from a table of all the code combinations in the end.
+
+PARTICLES = ('clear', 'cloudy', 'rain')
+TEMPERATURES = ('cold', 'warm', 'hot')
+
+
+# Rating codes by particles, temperature and daytime codes, built with the scalar rate_weather itself
+# so the two can't drift apart
+def build_rating_table():
+    return array('b', [
+        RATINGS.index(rate_weather(particles, temperature, daytime))
+        for particles in PARTICLES
+        for temperature in TEMPERATURES
+        for daytime in (False, True)
+    ])
+
+
+RATING_TABLE = build_rating_table()
+# Ratings by index into the rating table, sparing a second lookup per observation
+RATINGS_BY_INDEX = [RATINGS[code] for code in RATING_TABLE]
+
+
+# Severities of the condition ids the Weather API uses, an observation is rated by its most severe condition
+CONDITION_SEVERITIES = {condition_id: condition_severity(condition_id) for condition_id in range(1000)}
+# Particles codes by severity, built with the scalar parse_weather from a condition of each severity
+PARTICLES_BY_SEVERITY = array('b', [
+    PARTICLES.index(parse_weather(reads)) for reads in ([{'id': 800}], [{'id': 801}], [{'id': 500}])
+])
+
+
+# Particles codes of the observations, given as a flat column of condition ids along with the offsets
+# where the ids of each observation start, e.g. ids [800, 500, 801] and offsets [0, 1] for [[800], [500, 801]]
+def particles_codes(condition_ids, offsets):
+    severities = list(map(CONDITION_SEVERITIES.get, condition_ids))
+    if None in severities:
+        severities = [condition_severity(condition_id) for condition_id in condition_ids]
+    if len(offsets) == len(severities) and offsets == array(offsets.typecode, range(len(offsets))):
+        # A condition per observation, as the Weather API mostly reports
+        observation_severities = severities
+    else:
+        ends = list(offsets[1:]) + [len(severities)]
+        observation_severities = [max(severities[start:end], default=0) for start, end in zip(offsets, ends)]
+    return array('b', map(PARTICLES_BY_SEVERITY.__getitem__, observation_severities))
+
+
+# Temperature codes of a column of temperatures
+# Bisecting compares the way parse_temp does, so values like NaN end up the same
+def temperature_codes(temps):
+    return array('b', map(functools.partial(bisect.bisect_right, (COLD_BELOW, WARM_BELOW)), temps))
+
+
+# Daytime flags of columns of read, sunrise and sunset times
+def daytime_flags(read_times, sunrises, sunsets):
+    return array('b', map(
+        operator.and_, map(operator.le, sunrises, read_times), map(operator.le, read_times, sunsets)
+    ))
+
+
+# Rate the observations given as columns, returns the list of ratings
+def rate_weather_batch(condition_ids, offsets, temps, read_times, sunrises, sunsets):
+    return rate_codes(
+        particles_codes(condition_ids, offsets), temperature_codes(temps), daytime_flags(read_times, sunrises, sunsets)
+    )
+
+
+# Ratings of the observations given as columns of particles and temperature codes and daytime flags
+def rate_codes(particles, temperatures, daytime):
+    # Index into the rating table, particles * 6 + temperature * 2 + daytime
+    indexes = map(
+        operator.add,
+        map(
+            operator.add,
+            map(operator.mul, particles, itertools.repeat(6)),
+            map(operator.mul, temperatures, itertools.repeat(2)),
+        ),
+        daytime,
+    )
+    return list(map(RATINGS_BY_INDEX.__getitem__, indexes))
+
+
+# Rate observations given as Weather API payloads in one pass, returns the list of ratings
+def rate_payloads(payloads):
+    condition_ids = array('l')
+    offsets = array('l')
+    for payload in payloads:
+        offsets.append(len(condition_ids))
+        condition_ids.extend(read['id'] for read in payload['weather'])
+    return rate_weather_batch(
+        condition_ids,
+        offsets,
+        array('d', (payload['main']['temp'] for payload in payloads)),
+        array('q', (payload['dt'] for payload in payloads)),
+        array('q', (payload['sys']['sunrise'] for payload in payloads)),
+        array('q', (payload['sys']['sunset'] for payload in payloads)),
+    )
+
+
+# Rate stored weather observations again from the condition, temperature and daytime they keep, returns the list of
+# rating codes as stored in their status
+# The observations must know their condition and daytime, temperatures are kept in tenths of a degree
+def rate_observations(observations):
+    particles = particles_codes(
+        array('l', (observation.condition_id for observation in observations)), array('l', range(len(observations)))
+    )
+    temperatures = temperature_codes([observation.temperature / 10 for observation in observations])
+    daytime = array('b', (observation.daytime for observation in observations))
+    return list(map(RATINGS.index, rate_codes(particles, temperatures, daytime)))
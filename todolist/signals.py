@@ -0,0 +1,70 @@
+import datetime
+
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from todolist.models import Location, Task, Weather
+from todolist.history import schedule_observations
+from todolist.task_rows import row_cache
+from todolist.weather import breaker, delete_shared_weather, local_cache, weather_stored
+
+
+# Drop a weather read from the caches when it is changed or deleted outside of the weather module,
+# e.g. in the admin
+@receiver(post_save, sender=Weather)
+@receiver(post_delete, sender=Weather)
+def invalidate_cached_weather(instance, **kwargs):
+    local_cache.delete(instance.location_id)
+    try:
+        location = instance.location
+    except Location.DoesNotExist:
+        # The read goes along with its location, nobody will ask for it again
+        return
+    delete_shared_weather([location])
+
+
+# Deleting a location clears it from its tasks without saving them, so they are marked as modified here
+# for the sync feed to pick them up
+@receiver(pre_delete, sender=Location)
+def touch_location_tasks(instance, **kwargs):
+    Task.objects.filter(location=instance).update(modified_at=datetime.datetime.now())
+
+
+# Append every stored weather read to the weather history
+@receiver(weather_stored)
+def record_weather_history(weather_reads, **kwargs):
+    schedule_observations(weather_reads)
+
+
+# Apply changed local cache settings and drop the cached reads when any weather setting changes
+@receiver(setting_changed)
+def reset_local_cache(setting, value, **kwargs):
+    if setting == 'WEATHER_LOCAL_CACHE_SIZE':
+        local_cache.maxsize = value
+    elif setting == 'WEATHER_LOCAL_CACHE_TTL':
+        local_cache.ttl = value
+    if setting.startswith('WEATHER_'):
+        local_cache.clear()
+
+
+# Apply changed task row cache settings and drop the cached rows
+@receiver(setting_changed)
+def reset_row_cache(setting, value, **kwargs):
+    if setting == 'TASK_ROW_CACHE_SIZE':
+        row_cache.maxsize = value
+    elif setting == 'TASK_ROW_CACHE_TTL':
+        row_cache.ttl = value
+    if setting.startswith('TASK_ROW_CACHE_'):
+        row_cache.clear()
+
+
+# Apply changed circuit breaker settings, starting over closed
+@receiver(setting_changed)
+def reset_breaker(setting, value, **kwargs):
+    if setting == 'WEATHER_BREAKER_FAILURES':
+        breaker.failure_threshold = value
+    elif setting == 'WEATHER_BREAKER_RESET':
+        breaker.reset_timeout = value
+    if setting.startswith('WEATHER_'):
+        breaker.reset()
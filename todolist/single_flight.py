@@ -0,0 +1,28 @@
+import concurrent.futures
+import threading
+
+
+# Coalesces concurrent calls for the same keys within the process
+# The first caller to claim a key becomes its leader and does the work, later callers wait on the leader's result
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    # Claim the keys, returns the futures the caller leads and the futures it should wait on, both by key
+    def claim(self, keys):
+        led = {}
+        waiting = {}
+        with self._lock:
+            for key in keys:
+                if key in self._flights:
+                    waiting[key] = self._flights[key]
+                else:
+                    led[key] = self._flights[key] = concurrent.futures.Future()
+        return led, waiting
+
+    # Hand the result of a led key over to the waiting callers and release the key
+    def resolve(self, key, result):
+        with self._lock:
+            future = self._flights.pop(key)
+        future.set_result(result)
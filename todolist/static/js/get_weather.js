@@ -1,16 +1,25 @@
-// Call the API to fetch weather data on the location
-function getWeatherForLocation(location_id) {
-    if (!location_id) {
-        return;
-    }
-
-    const options = {
+// Options for the fetch API calls
+const options = {
     method: 'GET',
     headers: {
         'Content-Type': 'application/json'
     },
     credentials: "same-origin",
-    };
+};
+
+// Weather reads prefetched for the locations in the form, by location id
+const weatherReads = {};
+
+// Call the API to fetch weather data on the location
+function getWeatherForLocation(location_id) {
+    if (!location_id) {
+        return;
+    }
+    // Use the prefetched read if there is one
+    if (weatherReads[location_id] && weatherReads[location_id].temp !== null) {
+        updateWeather(weatherReads[location_id]);
+        return;
+    }
 
     // Make the fetch request with the provided options
     fetch(window.location.origin + '/' + location_id + '/get_weather', options)
@@ -33,14 +42,50 @@ function getWeatherForLocation(location_id) {
         });
 }
 
+// Most locations the API serves in a single call, MAX_WEATHER_BATCH on the server
+const maxWeatherBatch = 100;
+
+// Call the API to prefetch the stored weather data on every location in the form, a batch of locations at a time
+// Locations without a stored read are fetched when they are picked
+function prefetchWeather() {
+    const location_ids = Array.from(document.querySelectorAll('select[name="location"] option'))
+        .map(option => option.value)
+        .filter(location_id => location_id);
+
+    for (let start = 0; start < location_ids.length; start += maxWeatherBatch) {
+        const params = new URLSearchParams(
+            location_ids.slice(start, start + maxWeatherBatch).map(location_id => ['location', location_id])
+        );
+        params.append('stored', '1');
+
+        fetch(window.location.origin + '/get_weather?' + params, options)
+            .then(response => {
+                if (!response.ok) {
+                  throw new Error('Network response was not ok');
+                }
+                return response.json();
+            })
+            .then(data => {
+                Object.assign(weatherReads, data);
+            })
+            .catch(error => {
+                console.error('Fetch error:', error);
+            });
+    }
+}
+
 // Update colors to match weather
 function updateWeather(data)
 {
     const temp = document.querySelector(".temp_read");
+    const age = document.querySelector(".read_age");
     const background = document.querySelector(".background");
 
-    temp.textContent = `${data.temp}`;
+    temp.textContent = data.temp === null ? '--' : `${data.temp}`;
+    age.textContent = data.age ? `(read ${data.age}s ago)` : '';
     background.classList.remove(...background.classList);
     background.classList.add('background');
     background.classList.add(data.weather);
 }
+
+prefetchWeather();
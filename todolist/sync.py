@@ -0,0 +1,94 @@
+import base64
+import binascii
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+from todolist.models import Task, TaskDeletion
+
+
+# Encode a sync cursor, pointing at the last task change by (modified_at, id) and the last logged deletion
+def encode_sync_cursor(modified_at, task_id, deletion_id):
+    position = '%s|%d|%d' % (modified_at.isoformat(), task_id, deletion_id)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+# Decode a sync cursor into its (modified_at, task id, deletion id) position, raises ValueError for malformed cursors
+def decode_sync_cursor(cursor):
+    try:
+        modified_at, task_id, deletion_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(modified_at), int(task_id), int(deletion_id)
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError('Malformed cursor')
+
+
+# Delete the deletions logged more than TASKS_SYNC_RETENTION_DAYS ago, `batch_size` at a time
+# Clients whose cursor is older than that miss them and must sync again from scratch, returns the number deleted
+def prune_deletions(batch_size):
+    pruned_before = datetime.datetime.now() - datetime.timedelta(days=settings.TASKS_SYNC_RETENTION_DAYS)
+    pruned = 0
+    while True:
+        batch = list(
+            TaskDeletion.objects.filter(deleted_at__lt=pruned_before).order_by('deleted_at', 'id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not batch:
+            return pruned
+        pruned += TaskDeletion.objects.filter(pk__in=batch).delete()[0]
+
+
+# Page of the sync feed, with the cursor to continue from and whether more changes are waiting right away
+class TaskChanges:
+    def __init__(self, tasks, deleted, cursor, more):
+        self.tasks = tasks
+        self.deleted = deleted
+        self.cursor = cursor
+        self.more = more
+
+
+# Get the tasks changed and the ids of the tasks deleted after the cursor, at most `size` of each
+# Without a cursor every task is a change, and deletions from before are left out since the tasks are gone already.
+# Seeks through the (modified_at, id) index and the deletion log, so a page costs the same however long the list is.
+# Changes from the last `delay` seconds are held back until transactions that saved earlier changes had time to commit.
+def task_changes(cursor, size, delay):
+    settled_at = datetime.datetime.now() - datetime.timedelta(seconds=delay)
+    if cursor is None:
+        modified_at, task_id = datetime.datetime.min, 0
+        # The latest settled deletion, read off the end of the (deleted_at, id) index
+        deletion_id = (
+            TaskDeletion.objects.filter(deleted_at__lte=settled_at)
+            .order_by('-deleted_at', '-id')
+            .values_list('id', flat=True)
+            .first()
+        ) or 0
+    else:
+        modified_at, task_id, deletion_id = cursor
+
+    # One extra row tells whether there are more changes
+    tasks = list(
+        Task.objects
+        .filter(Q(modified_at__gte=modified_at) & (Q(modified_at__gt=modified_at) | Q(id__gt=task_id)))
+        .filter(modified_at__lte=settled_at)
+        .order_by('modified_at', 'id')[:size + 1]
+    )
+    deletions = list(
+        TaskDeletion.objects
+        .filter(id__gt=deletion_id, deleted_at__lte=settled_at)
+        .order_by('id')
+        .values_list('id', 'task_id')[:size + 1]
+    )
+    more = len(tasks) > size or len(deletions) > size
+    tasks = tasks[:size]
+    deletions = deletions[:size]
+    if tasks:
+        modified_at, task_id = tasks[-1].modified_at, tasks[-1].id
+    if deletions:
+        deletion_id = deletions[-1][0]
+
+    return TaskChanges(
+        tasks,
+        [deleted_task_id for _, deleted_task_id in deletions],
+        encode_sync_cursor(modified_at, task_id, deletion_id),
+        more,
+    )
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from todolist.lru_cache import LRUCache
+from todolist.metrics import task_row_cache_lookups
+
+# Rendered rows of the task list of this process, keyed by what they show, see row_key
+# Rows hold no CSRF token or anything else specific to a request, so they are shared by all requests.
+# Changed tasks and weather make new keys, older rows are left to be evicted.
+row_cache = LRUCache(settings.TASK_ROW_CACHE_SIZE, settings.TASK_ROW_CACHE_TTL)
+
+
+# Key of the rendered row of a task, changing whenever the task or the weather it shows changes
+# The row shows the weather rating only, so a refreshed read with the same rating keeps the row
+def row_key(task):
+    weather = getattr(task, 'weather', None)
+    return task.id, task.modified_at, weather and weather['weather']
+
+
+# Set the rendered row of each task as `row`, rendering only the rows missing from the cache
+def render_task_rows(tasks):
+    template = None
+    results = {'hit': 0, 'miss': 0}
+    for task in tasks:
+        key = row_key(task)
+        row = row_cache.get(key)
+        if row is None:
+            template = template or get_template('tasks/task_row.html')
+            row = template.render({'task': task})
+            row_cache.set(key, row)
+            results['miss'] += 1
+        else:
+            results['hit'] += 1
+        task.row = mark_safe(row)
+    for result, count in results.items():
+        if count:
+            task_row_cache_lookups.inc(count, result=result)
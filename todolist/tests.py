@@ -1,7 +1,52 @@
-from django.test import TestCase
+import concurrent.futures
+import csv
+import datetime
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from array import array
+from unittest import mock
 
-from .forms import TaskForm
-from .models import Task, Location, Weather
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, SimpleTestCase, TransactionTestCase, override_settings
+
+from .background import BackgroundPool
+from .bench import SCENARIOS, compare_reports, generate_data, run_benchmark, summarize
+from .circuit_breaker import CircuitBreaker
+from .forms import LocationForm, TaskForm
+from .geocoding import geocode, geocode_many, normalize_query
+from .history import rerate_history, rollup_history, weather_at
+from .models import (
+    Task, Location, Weather, LastWeatherRead, GeocodingResult, RateLimitBucket, TaskDeletion, WeatherObservation,
+    WeatherRollup,
+)
+from .grid import grid_key
+from .imports import import_locations, import_tasks
+from .leases import claim_leases, held_leases, release_leases
+from .lru_cache import LRUCache
+from .metrics import (
+    REGISTRY, Histogram, request_duration, request_weather_duration, weather_api_calls, weather_api_shed,
+    task_row_cache_lookups, weather_cache_lookups,
+)
+from .rate_limit import SharedTokenBucket, TokenBucket
+from .ratings import PARTICLES, RATING_TABLE, TEMPERATURES, rate_payloads, rate_weather_batch
+from .task_rows import row_cache
+from .weather import (
+    RATINGS, WEATHER_API_BUCKET, breaker, fetch_weather, flights, is_daytime, local_cache, parse_temp, parse_weather,
+    pending_revalidations, rate_weather, request_weather, revalidate_weather, shared_cache_key,
+)
+from .weather_client import WeatherAPIError, WeatherClient
+from .weather_stub import StubWeatherServer
 from django.urls import reverse
 
 
@@ -10,6 +55,39 @@ def create_task(name, date):
     return Task.objects.create(name=name, date=date)
 
 
+# Helper for storing a weather read of the location, `age` seconds old
+# The read isn't cached on the location, so it is looked up like a read stored by another request
+def create_weather(location, age=0, temperature=26, status='average'):
+    weather = Weather.objects.create(location_id=location.id, temperature=temperature, status=status)
+    weather.modified_at = datetime.datetime.now() - datetime.timedelta(seconds=age)
+    Weather.objects.filter(pk=weather.pk).update(modified_at=weather.modified_at)
+    return weather
+
+
+# Mixin for tests reading weather, the caches outlive the database rollback between tests so they are cleared too
+class ClearCachesMixin:
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        local_cache.clear()
+        row_cache.clear()
+        breaker.reset()
+        pending_revalidations.clear()
+
+
+# Mixin for tests reading weather with the Weather API calls mocked as self.request_weather, answering a good read
+class MockWeatherAPIMixin(ClearCachesMixin):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('todolist.weather.request_weather', return_value={'temp': 30.0, 'weather': 'good'})
+        self.request_weather = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # Helper for creating the Weather API rate limit bucket, as it is once the first call created it
+    def create_rate_limit_bucket(self):
+        RateLimitBucket.objects.create(name=WEATHER_API_BUCKET, tokens=20, updated_at=time.time())
+
+
 # Test of Task model
 class TaskModelTest(TestCase):
 
@@ -42,7 +120,7 @@ class TaskFormTest(TestCase):
 
 
 # Tests for endpoints
-class ProjectTests(TestCase):
+class ProjectTests(ClearCachesMixin, TestCase):
 
     # Tests index returns current Tasks
     def test_index(self):
@@ -207,12 +285,15 @@ class ProjectTests(TestCase):
             response.content,
             {
                 'temp': recent_weather_read1.temperature,
-                'weather': recent_weather_read1.status
+                'weather': recent_weather_read1.status,
+                'age': 0
             }
         )
 
     # Tests forcing a weather check updates the weather information and provides a newer weather read on the Task list
-    def test_weather_refresh(self):
+    @override_settings(WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=3600)
+    @mock.patch('todolist.weather.request_weather', return_value={'temp': 30.0, 'weather': 'good'})
+    def test_weather_refresh(self, request_weather):
         location1 = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
         task1 = Task.objects.create(name='Play basketball', date='2024-05-26T10:00:00Z', location=location1)
         recent_weather_read1 = Weather.objects.create(temperature=26, status='good', location=location1)
@@ -220,8 +301,13 @@ class ProjectTests(TestCase):
         old_weather_modified_time = recent_weather_read1.modified_at
         # Force refresh
         response = self.client.post(reverse('todolist:force_weather_refresh'))
-        # Go to task list
-        response = self.client.get(reverse('todolist:index'))
+        # Go to task list, the expired read is served and refreshed afterwards
+        with mock.patch('todolist.weather.revalidation_executor') as executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(reverse('todolist:index'))
+        self.assertEqual(response.context['tasks'][0].weather['temp'], 26)
+        function, *args = executor.submit.call_args.args[1:]
+        function(*args)
         # Note the time of the current weather read for this location
         new_weather_modified_time = Weather.objects.get(location=location1).modified_at
         # The new weather read should be newer than the previous one
@@ -246,3 +332,1855 @@ class ProjectTests(TestCase):
         # Check that the updated task has the old weather read regardless of the forced refresh
         self.assertEqual(task1_updated.last_weather_read.temperature, recent_weather_read1.temperature)
         self.assertEqual(task1_updated.last_weather_read.status, recent_weather_read1.status)
+
+
+# Tests for fetching weather reads of many locations at once
+@override_settings(WEATHER_FETCH_WORKERS=8, WEATHER_FETCH_DEADLINE=5)
+class WeatherFanOutTests(ClearCachesMixin, TestCase):
+
+    # Helper for creating locations with an open task each
+    def create_locations(self, count):
+        locations = []
+        for i in range(count):
+            location = Location.objects.create(name='City %d' % i, lat=10.0 + i, lon=20.0)
+            Task.objects.create(name='Task %d' % i, date='2024-05-26T10:00:00Z', location=location)
+            locations.append(location)
+        return locations
+
+    # Helper for pointing the Weather API at the stub server
+    def weather_api(self, stub):
+        return self.settings(WEATHER_API=stub.url, WEATHER_API_ONECALL='data/2.5/weather?', WEATHER_API_KEY='key')
+
+    # Helper for rendering the task list, returns the response and the render time
+    def render_index(self):
+        start = time.perf_counter()
+        response = self.client.get(reverse('todolist:index'))
+        elapsed = time.perf_counter() - start
+        self.assertEqual(response.status_code, 200)
+        return response, elapsed
+
+    # Benchmarks a cold task list render with serial and concurrent weather fetching
+    def test_concurrent_render_faster_than_serial(self):
+        self.create_locations(8)
+        with StubWeatherServer(delay=0.1) as stub, self.weather_api(stub):
+            with self.settings(WEATHER_FETCH_WORKERS=1):
+                response, serial = self.render_index()
+            Weather.objects.all().delete()
+            response, concurrent = self.render_index()
+        self.assertEqual(stub.calls, 16)
+        self.assertLess(concurrent, serial / 2, 'serial %.3fs, concurrent %.3fs' % (serial, concurrent))
+
+    # Tests a slow Weather API call doesn't stall the task list past the deadline
+    def test_deadline(self):
+        slow, fast = self.create_locations(2)
+        with (
+            StubWeatherServer(delays={str(slow.lat): 1}) as stub,
+            self.weather_api(stub),
+            self.settings(WEATHER_FETCH_DEADLINE=0.3)
+        ):
+            response, elapsed = self.render_index()
+        self.assertLess(elapsed, 1)
+        weather = {task.location_id: task.weather for task in response.context['tasks']}
+        self.assertIsNone(weather[slow.id])
+        self.assertEqual(weather[fast.id], {'temp': 20.0, 'weather': 'average', 'age': 0})
+        self.assertFalse(Weather.objects.filter(location=slow).exists())
+
+
+# Tests for the Weather API client
+class WeatherClientTests(SimpleTestCase):
+
+    # Helper for creating a client for the stub server
+    def create_client(self, stub, **kwargs):
+        return WeatherClient(stub.url, 'data/2.5/weather?', 'key', **kwargs)
+
+    # Tests consecutive calls reuse a single keep-alive connection
+    def test_keep_alive(self):
+        with StubWeatherServer() as stub:
+            client = self.create_client(stub)
+            for i in range(3):
+                self.assertEqual(client.current_weather(10.0, 20.0)['main']['temp'], 20.0)
+            client.close()
+        self.assertEqual(stub.calls, 3)
+        self.assertEqual(stub.connections, 1)
+
+    # Tests failed calls are retried
+    def test_retries(self):
+        with StubWeatherServer(failures=2) as stub:
+            client = self.create_client(stub, retries=2, backoff=0)
+            self.assertEqual(client.current_weather(10.0, 20.0)['main']['temp'], 20.0)
+            client.close()
+        self.assertEqual(stub.calls, 3)
+
+    # Tests a call fails once the retries are used up
+    def test_retries_exhausted(self):
+        with StubWeatherServer(failures=5) as stub:
+            client = self.create_client(stub, retries=1, backoff=0)
+            with self.assertRaises(requests.HTTPError):
+                client.current_weather(10.0, 20.0)
+            client.close()
+        self.assertEqual(stub.calls, 2)
+
+    # Tests a hung call is cut off by the read timeout
+    def test_read_timeout(self):
+        with StubWeatherServer(delay=1) as stub:
+            client = self.create_client(stub, read_timeout=0.2, retries=0)
+            start = time.perf_counter()
+            with self.assertRaises(requests.RequestException):
+                client.current_weather(10.0, 20.0)
+            self.assertLess(time.perf_counter() - start, 1)
+            client.close()
+
+
+# Tests for the stored weather reads working as a read-through cache of the Weather API
+@override_settings(WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=600)
+class WeatherCacheTests(MockWeatherAPIMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        self.create_rate_limit_bucket()
+
+    # Tests a recent read is served with a single query and no API call
+    def test_hit(self):
+        create_weather(self.location, age=60)
+        with self.assertNumQueries(1):
+            data = fetch_weather(self.location)
+        self.assertEqual(data, {'temp': 26, 'weather': 'average', 'age': 60})
+        self.request_weather.assert_not_called()
+
+    # Tests a read loaded along with the location is served without any query
+    def test_hit_loaded(self):
+        create_weather(self.location, age=60)
+        location = Location.objects.select_related('weather').get(pk=self.location.pk)
+        with self.assertNumQueries(0):
+            data = fetch_weather(location)
+        self.assertEqual(data, {'temp': 26, 'weather': 'average', 'age': 60})
+
+    # Tests the first read for a location is fetched once and stored
+    def test_miss(self):
+        # Lookup, lease claim, re-check, Weather API token, upsert within a savepoint, then lease release
+        with self.assertNumQueries(10):
+            data = fetch_weather(self.location)
+        self.assertEqual(data, {'temp': 30.0, 'weather': 'good', 'age': 0})
+        self.assertEqual(self.request_weather.call_count, 1)
+        fetch_weather(self.location)
+        self.assertEqual(self.request_weather.call_count, 1)
+
+    # Tests an expired read is fetched once and stored, later calls are served from the stored read
+    def test_expired(self):
+        create_weather(self.location, age=700)
+        expired_at = Weather.objects.get(location=self.location).modified_at
+        with self.assertNumQueries(10):
+            data = fetch_weather(self.location)
+        self.assertEqual(data, {'temp': 30.0, 'weather': 'good', 'age': 0})
+        weather = Weather.objects.get(location=self.location)
+        self.assertEqual(weather.temperature, 30.0)
+        self.assertEqual(weather.status, 'good')
+        self.assertGreater(weather.modified_at, expired_at)
+        for i in range(3):
+            fetch_weather(self.location)
+        self.assertEqual(self.request_weather.call_count, 1)
+
+    # Tests the cache TTL is configurable
+    def test_ttl_setting(self):
+        create_weather(self.location, age=60)
+        with self.settings(WEATHER_CACHE_TTL=30, WEATHER_CACHE_HARD_TTL=30):
+            fetch_weather(self.location)
+        self.assertEqual(self.request_weather.call_count, 1)
+
+
+# Tests the task list is built in a constant number of queries
+@override_settings(TASKS_PAGE_SIZE=200)
+class IndexQueriesTests(ClearCachesMixin, TestCase):
+
+    # Helper for creating tasks spread over locations with recent weather reads, every other task done
+    def create_tasks(self, count):
+        locations = []
+        for i in range(5):
+            location = Location.objects.create(name='City %d' % i, lat=10.0 + i, lon=20.0)
+            Weather.objects.create(location=location, temperature=20, status='average')
+            locations.append(location)
+        for i in range(count):
+            task = Task.objects.create(
+                name='Task %d' % i, date='2024-05-26T10:00:00Z', location=locations[i % 5], done=i % 2 == 0
+            )
+            if task.done:
+                LastWeatherRead.objects.create(task=task, temperature=15, status='bad')
+
+    # Tests the number of queries doesn't grow with the number of tasks
+    def test_index_queries(self):
+        for count in (10, 100):
+            Task.objects.all().delete()
+            Location.objects.all().delete()
+            self.create_tasks(count)
+            with self.assertNumQueries(1):
+                response = self.client.get(reverse('todolist:index'))
+            self.assertEqual(len(response.context['tasks']), count)
+            for task in response.context['tasks']:
+                expected = 'bad' if task.done else 'average'
+                self.assertEqual(task.weather['weather'], expected)
+
+
+# Tests for completing and deleting many tasks at once
+class BulkTaskTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        self.weather = Weather.objects.create(location=self.location, temperature=26, status='good')
+        self.nowhere = Location.objects.create(name='Nowhere', lat=10.0, lon=20.0)
+
+    # Helper for creating tasks alternating between a location with a weather read, one without and no location
+    def create_tasks(self, count):
+        locations = [self.location, self.nowhere, None]
+        Task.objects.bulk_create([
+            Task(name='Task %d' % i, date='2024-05-26T10:00:00Z', location=locations[i % 3])
+            for i in range(count)
+        ])
+        return list(Task.objects.order_by('id').values_list('id', flat=True))
+
+    # Tests completing saves the weather read of the task location as the last weather read of the task
+    def test_complete(self):
+        task_ids = self.create_tasks(3)
+        response = self.client.post(reverse('todolist:bulk_complete'), {'task': task_ids})
+        self.assertRedirects(response, '/')
+        self.assertEqual(Task.objects.filter(done=True).count(), 3)
+        read = LastWeatherRead.objects.get()
+        self.assertEqual(read.task_id, task_ids[0])
+        self.assertEqual((read.temperature, read.status), (26, 'good'))
+
+    # Tests completing saves the weather read shared by the grid cell when the location has none of its own
+    def test_complete_shared_read(self):
+        neighbour = Location.objects.create(name='Paris too', lat=48.864717, lon=2.349015)
+        self.assertEqual(neighbour.grid_key, self.location.grid_key)
+        task = Task.objects.create(name='Task', date='2024-05-26T10:00:00Z', location=neighbour)
+        Task.objects.filter(pk=task.pk).complete()
+        read = LastWeatherRead.objects.get(task=task)
+        self.assertEqual((read.temperature, read.status), (26, 'good'))
+
+    # Tests completing updates the modification time of the tasks
+    def test_complete_modified_at(self):
+        task_ids = self.create_tasks(1)
+        before = Task.objects.get(pk=task_ids[0]).modified_at
+        Task.objects.filter(pk__in=task_ids).complete()
+        self.assertGreater(Task.objects.get(pk=task_ids[0]).modified_at, before)
+
+    # Tests completing done tasks again keeps their original last weather read
+    def test_complete_done(self):
+        task_ids = self.create_tasks(1)
+        Task.objects.filter(pk__in=task_ids).complete()
+        Weather.objects.filter(location=self.location).update(temperature=5, status='bad')
+        self.assertEqual(Task.objects.filter(pk__in=task_ids).complete(), 0)
+        self.assertEqual(LastWeatherRead.objects.get().status, 'good')
+
+    # Tests the number of queries doesn't grow with the number of tasks
+    def test_complete_queries(self):
+        for count in (10, 200):
+            Task.objects.all().delete()
+            task_ids = self.create_tasks(count)
+            with self.assertNumQueries(5):
+                self.client.post(reverse('todolist:bulk_complete'), {'task': task_ids})
+            self.assertEqual(Task.objects.filter(done=True).count(), count)
+
+    # Tests deleting only removes the selected tasks
+    def test_delete(self):
+        task_ids = self.create_tasks(4)
+        response = self.client.post(reverse('todolist:bulk_delete'), {'task': task_ids[:3]})
+        self.assertRedirects(response, '/')
+        self.assertQuerySetEqual(Task.objects.values_list('id', flat=True), task_ids[3:])
+
+    # Tests the task ids must be numbers
+    def test_invalid_ids(self):
+        for name in ('bulk_complete', 'bulk_delete'):
+            response = self.client.post(reverse('todolist:' + name), {'task': ['1', 'x']})
+            self.assertEqual(response.status_code, 400)
+
+    # Tests nothing happens on a GET request
+    def test_GET(self):
+        task_ids = self.create_tasks(1)
+        for name in ('bulk_complete', 'bulk_delete'):
+            response = self.client.get(reverse('todolist:' + name), {'task': task_ids})
+            self.assertRedirects(response, '/')
+        self.assertFalse(Task.objects.get().done)
+
+
+# Tests for clearing the task list and expiring the weather reads a batch at a time
+@override_settings(BULK_BATCH_SIZE=3, WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=3600)
+class BatchedClearTests(ClearCachesMixin, TestCase):
+
+    # Tests every task goes along with its last weather read, a batch per transaction
+    def test_clear(self):
+        Task.objects.bulk_create([Task(name='Task %d' % i, date='2024-05-26T10:00:00Z', done=True) for i in range(7)])
+        LastWeatherRead.objects.bulk_create(
+            [LastWeatherRead(task=task, temperature=15, status='bad') for task in Task.objects.all()]
+        )
+        self.assertEqual(Task.objects.all().delete_in_batches(3), 7)
+        self.assertFalse(Task.objects.exists())
+        self.assertFalse(LastWeatherRead.objects.exists())
+
+    # Tests only the tasks of the queryset are deleted
+    def test_delete_in_batches_filtered(self):
+        Task.objects.bulk_create(
+            [Task(name='Task %d' % i, date='2024-05-26T10:00:00Z', done=i % 2 == 0) for i in range(7)]
+        )
+        self.assertEqual(Task.objects.filter(done=True).delete_in_batches(3), 4)
+        self.assertEqual(Task.objects.filter(done=False).count(), 3)
+
+    # Tests forcing a weather refresh expires the reads instead of deleting them, and drops their cached copies
+    def test_expire_weather(self):
+        locations = [
+            Location.objects.create(name='City %d' % i, lat=10.0 + i, lon=20.0) for i in range(5)
+        ]
+        for location in locations:
+            Weather.objects.create(location=location, temperature=20, status='average')
+        fetch_weather(locations[0])
+        old = datetime.datetime.now() - datetime.timedelta(seconds=2000)
+        Weather.objects.filter(location=locations[4]).update(modified_at=old)
+        response = self.client.post(reverse('todolist:force_weather_refresh'))
+        self.assertRedirects(response, '/')
+        self.assertEqual(Weather.objects.count(), 5)
+        self.assertIsNone(local_cache.get(locations[0].id))
+        self.assertIsNone(cache.get(shared_cache_key(locations[0])))
+        # The expired reads are still served, while the older one keeps its age
+        with mock.patch('todolist.weather.revalidation_executor'):
+            for location in locations[:4]:
+                self.assertGreaterEqual(fetch_weather(Location.objects.get(pk=location.pk))['age'], 600)
+            self.assertGreaterEqual(fetch_weather(Location.objects.get(pk=locations[4].pk))['age'], 2000)
+
+
+# Tests for the JSON API for tasks
+class TaskAPITests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        self.task = Task.objects.create(name='Eat chips', date='2024-05-26T10:00:00', location=self.location)
+
+    # Helper for sending JSON to the API
+    def send(self, method, url, data, **headers):
+        return getattr(self.client, method)(url, json.dumps(data), content_type='application/json', headers=headers)
+
+    # Tests reading a task, again with its ETag or modification time gets a 304 without a body
+    def test_detail(self):
+        url = reverse('todolist:api_task', args=[self.task.id])
+        response = self.client.get(url)
+        self.assertEqual(response.json()['name'], 'Eat chips')
+        self.assertEqual(response.json()['location'], self.location.id)
+        response = self.client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertIn('ETag', response)
+        response = self.client.get(url, headers={'If-Modified-Since': response['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+    # Tests a changed task is served in full again
+    def test_detail_modified(self):
+        url = reverse('todolist:api_task', args=[self.task.id])
+        etag = self.client.get(url)['ETag']
+        self.task.save()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_detail_invalid(self):
+        response = self.client.get(reverse('todolist:api_task', args=[self.task.id + 1]))
+        self.assertEqual(response.status_code, 404)
+
+    # Tests an unchanged list is answered from the aggregate queries alone
+    def test_list(self):
+        url = reverse('todolist:api_tasks')
+        response = self.client.get(url)
+        self.assertEqual([task['id'] for task in response.json()['tasks']], [self.task.id])
+        with self.assertNumQueries(2):
+            not_modified = self.client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+
+    # Tests creating, changing and deleting tasks changes the ETag of the list
+    def test_list_modified(self):
+        url = reverse('todolist:api_tasks')
+        etags = [self.client.get(url)['ETag']]
+        other = Task.objects.create(name='Drink cola', date='2024-05-30T12:00:00')
+        etags.append(self.client.get(url)['ETag'])
+        self.task.save()
+        etags.append(self.client.get(url)['ETag'])
+        other.delete()
+        etags.append(self.client.get(url)['ETag'])
+        self.assertEqual(len(set(etags)), 4)
+
+    # Tests deleting a task other than the latest modified one changes the modification time of the list
+    def test_list_deleted(self):
+        url = reverse('todolist:api_tasks')
+        Task.objects.create(name='Drink cola', date='2024-05-30T12:00:00')
+        Task.objects.update(modified_at=datetime.datetime.now() - datetime.timedelta(minutes=5))
+        last_modified = self.client.get(url)['Last-Modified']
+        self.task.delete()
+        response = self.client.get(url, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['Last-Modified'], last_modified)
+        response = self.client.get(url, headers={'If-Modified-Since': response['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_list_filters(self):
+        Task.objects.create(name='Drink cola', date='2024-05-30T12:00:00', done=True)
+        response = self.client.get(reverse('todolist:api_tasks'), {'status': 'done'})
+        self.assertEqual([task['name'] for task in response.json()['tasks']], ['Drink cola'])
+        response = self.client.get(reverse('todolist:api_tasks'), {'status': 'later'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_create(self):
+        response = self.send('post', reverse('todolist:api_tasks'), {'name': 'Swim', 'date': '2024-06-01T08:00:00'})
+        self.assertEqual(response.status_code, 201)
+        task = Task.objects.get(pk=response.json()['id'])
+        self.assertEqual(task.name, 'Swim')
+        self.assertEqual(task.date, datetime.datetime(2024, 6, 1, 8))
+        self.assertIsNone(task.location)
+
+    def test_create_invalid(self):
+        response = self.send('post', reverse('todolist:api_tasks'), {'name': 'Swim', 'location': 0})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']), {'date', 'location'})
+        response = self.client.post(reverse('todolist:api_tasks'), 'nope', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    # Tests PATCH keeps the fields it isn't given, PUT doesn't
+    def test_update(self):
+        url = reverse('todolist:api_task', args=[self.task.id])
+        response = self.send('patch', url, {'name': 'Eat fries'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['location'], self.location.id)
+        response = self.send('put', url, {'name': 'Eat fries', 'date': '2024-05-26T10:00:00'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(Task.objects.get(pk=self.task.id).location)
+
+    # Tests an update based on an outdated read is refused
+    def test_update_if_match(self):
+        url = reverse('todolist:api_task', args=[self.task.id])
+        etag = self.client.get(url)['ETag']
+        self.send('patch', url, {'name': 'Eat fries'}, **{'If-Match': etag})
+        response = self.send('patch', url, {'name': 'Eat crisps'}, **{'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(Task.objects.get(pk=self.task.id).name, 'Eat fries')
+
+    def test_delete(self):
+        response = self.client.delete(reverse('todolist:api_task', args=[self.task.id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Task.objects.exists())
+
+    # Tests requests changing tasks can't be sent like a cross-site form would, without a JSON body
+    def test_json_only(self):
+        client = Client(enforce_csrf_checks=True)
+        url = reverse('todolist:api_complete', args=[self.task.id])
+        for content_type in ('text/plain', 'application/x-www-form-urlencoded'):
+            response = client.post(url, 'name=Swim', content_type=content_type)
+            self.assertEqual(response.status_code, 415)
+        response = client.patch(reverse('todolist:api_task', args=[self.task.id]), 'name=Swim')
+        self.assertEqual(response.status_code, 415)
+        self.assertFalse(Task.objects.get(pk=self.task.id).done)
+        response = client.post(url, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    # Tests uploads are checked for a CSRF token like the site's forms
+    def test_import_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        upload = SimpleUploadedFile('tasks.csv', b'name,date\nSwim,2024-06-01T08:00:00\n')
+        response = client.post(reverse('todolist:api_import_tasks'), {'file': upload})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Task.objects.filter(name='Swim').exists())
+
+    # Tests completing saves the last weather read
+    def test_complete(self):
+        Weather.objects.create(location=self.location, temperature=26, status='good')
+        response = self.client.post(reverse('todolist:api_complete', args=[self.task.id]), content_type='application/json')
+        self.assertTrue(response.json()['done'])
+        self.assertEqual(Task.objects.get(pk=self.task.id).last_weather_read.status, 'good')
+        response = self.client.get(reverse('todolist:api_complete', args=[self.task.id]))
+        self.assertEqual(response.status_code, 405)
+
+
+# Tests for the sync feed of changed and deleted tasks
+@override_settings(TASKS_SYNC_PAGE_SIZE=2, TASKS_SYNC_DELAY=0)
+class TaskSyncTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tasks = [Task.objects.create(name='Task %d' % i, date='2024-05-26T10:00:00') for i in range(3)]
+
+    # Helper for getting every change since the cursor, a page at a time
+    def sync(self, cursor=None):
+        tasks, deleted = [], []
+        while True:
+            response = self.client.get(reverse('todolist:api_task_changes'), {'cursor': cursor} if cursor else {})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            tasks += [task['name'] for task in data['tasks']]
+            deleted += data['deleted']
+            cursor = data['cursor']
+            if not data['more']:
+                return tasks, deleted, cursor
+
+    # Tests the first sync gets every task and none of the earlier deletions
+    def test_initial(self):
+        Task.objects.create(name='Gone', date='2024-05-26T10:00:00').delete()
+        tasks, deleted, cursor = self.sync()
+        self.assertEqual(tasks, ['Task 0', 'Task 1', 'Task 2'])
+        self.assertEqual(deleted, [])
+        self.assertEqual(self.sync(cursor)[:2], ([], []))
+
+    # Tests changes and deletions through every way of making them show up once
+    def test_changes(self):
+        cursor = self.sync()[2]
+        self.client.post(reverse('todolist:complete', args=[self.tasks[1].id]))
+        self.client.post(reverse('todolist:delete', args=[self.tasks[0].id]))
+        new = Task.objects.create(name='Task 3', date='2024-05-26T10:00:00')
+        tasks, deleted, cursor = self.sync(cursor)
+        self.assertEqual(tasks, ['Task 1', 'Task 3'])
+        self.assertEqual(deleted, [self.tasks[0].id])
+        self.client.post(reverse('todolist:bulk_delete'), {'task': [self.tasks[1].id]})
+        self.client.delete(reverse('todolist:api_task', args=[new.id]))
+        self.client.post(reverse('todolist:clear'))
+        tasks, deleted, cursor = self.sync(cursor)
+        self.assertEqual(tasks, [])
+        self.assertEqual(sorted(deleted), [self.tasks[1].id, self.tasks[2].id, new.id])
+
+    # Tests tasks of a deleted location show up as changed
+    def test_location_deleted(self):
+        location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        Task.objects.filter(pk=self.tasks[2].pk).update(location=location)
+        cursor = self.sync()[2]
+        location.delete()
+        self.assertEqual(self.sync(cursor)[0], ['Task 2'])
+
+    # Tests the most recent changes are held back for the delay
+    @override_settings(TASKS_SYNC_DELAY=60)
+    def test_delay(self):
+        self.assertEqual(self.sync()[0], [])
+
+    # Tests every page costs the same number of queries
+    def test_page_queries(self):
+        response = self.client.get(reverse('todolist:api_task_changes'))
+        with self.assertNumQueries(2):
+            self.client.get(reverse('todolist:api_task_changes'), {'cursor': response.json()['cursor']})
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('todolist:api_task_changes'), {'cursor': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    # Tests deletions past the retention are pruned, a batch at a time, and recent ones kept
+    @override_settings(TASKS_SYNC_RETENTION_DAYS=30)
+    def test_prune(self):
+        cursor = self.sync()[2]
+        Task.objects.all().delete()
+        TaskDeletion.objects.exclude(task_id=self.tasks[2].id).update(
+            deleted_at=datetime.datetime.now() - datetime.timedelta(days=31)
+        )
+        out = io.StringIO()
+        call_command('prune_task_deletions', batch_size=1, stdout=out)
+        self.assertIn('Pruned 2 deleted tasks', out.getvalue())
+        self.assertEqual(self.sync(cursor)[1], [self.tasks[2].id])
+
+
+# Tests for exporting the tasks along with their locations and weather reads
+class ExportTasksTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        Weather.objects.create(location=location, temperature=26, status='good')
+        Task.objects.create(name='Play basketball', date='2024-05-26T10:00:00', location=location)
+        done = Task.objects.create(name='Eat, chips', date='2024-05-27T10:00:00', done=True)
+        LastWeatherRead.objects.create(task=done, temperature=15, status='bad')
+
+    # Helper for downloading the export
+    def download(self, **params):
+        response = self.client.get(reverse('todolist:export_tasks'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.download())))
+        self.assertEqual([row['name'] for row in rows], ['Play basketball', 'Eat, chips'])
+        self.assertEqual(rows[0]['location_name'], 'Paris')
+        self.assertEqual(rows[0]['weather_status'], 'good')
+        self.assertEqual(rows[0]['date'], '2024-05-26T10:00:00')
+        self.assertEqual(rows[1]['last_weather_read_status'], 'bad')
+        self.assertEqual(rows[1]['location_id'], '')
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.download(format='ndjson').splitlines()]
+        self.assertEqual(rows[0]['lat'], 48.864716)
+        self.assertEqual(rows[0]['weather_temperature'], 26)
+        self.assertIsNone(rows[1]['weather_temperature'])
+        self.assertEqual(rows[1]['last_weather_read_temperature'], 15)
+        self.assertTrue(rows[1]['done'])
+
+    def test_invalid_format(self):
+        response = self.client.get(reverse('todolist:export_tasks'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    # Tests the command exports the same rows as the endpoint
+    def test_command(self):
+        out = io.StringIO()
+        call_command('export_tasks', format='ndjson', chunk_size=1, stdout=out)
+        self.assertEqual(out.getvalue(), self.download(format='ndjson'))
+
+
+# Tests for importing tasks and locations in bulk
+@override_settings(BULK_BATCH_SIZE=2)
+class ImportTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+
+    # Helper for uploading a file to an import endpoint
+    def upload(self, name, filename, content, **data):
+        upload = SimpleUploadedFile(filename, content.encode())
+        return self.client.post(reverse('todolist:' + name), dict(data, file=upload))
+
+    # Tests valid rows are imported and invalid ones reported by their row number
+    def test_import_tasks_csv(self):
+        content = (
+            'name,date,location,done\n'
+            'Eat chips,2024-05-26T10:00:00,%d,\n'
+            ',2024-05-26T10:00:00,,\n'
+            'Drink cola,2024-05-27 12:00,,True\n'
+            'Swim,tomorrow,0,\n'
+            'Run,2024-05-28T08:00:00,,\n'
+        ) % self.location.id
+        response = self.upload('api_import_tasks', 'tasks.csv', content)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['created'], data['failed']), (3, 2))
+        self.assertEqual([error['row'] for error in data['errors']], [2, 4])
+        self.assertEqual(set(data['errors'][1]['errors']), {'date', 'location'})
+        tasks = Task.objects.order_by('id')
+        self.assertEqual([task.name for task in tasks], ['Eat chips', 'Drink cola', 'Run'])
+        self.assertEqual(tasks[0].location, self.location)
+        self.assertTrue(tasks[1].done)
+
+    # Tests the rows are validated in a constant number of queries, and created a batch at a time
+    def test_import_tasks_queries(self):
+        rows = [{'name': 'Task %d' % i, 'date': '2024-05-26T10:00:00', 'location': self.location.id} for i in range(5)]
+        with self.assertNumQueries(1 + 3 * 3):
+            result = import_tasks(rows, 2)
+        self.assertEqual(result.created, 5)
+
+    # Tests locations are validated with the coordinate validators and get their grid cell
+    def test_import_locations_ndjson(self):
+        content = '\n'.join([
+            json.dumps({'name': 'Lyon', 'lat': 45.764043, 'lon': 4.835659}),
+            json.dumps({'name': 'Nowhere', 'lat': 95, 'lon': 4}),
+            '{not json',
+            '',
+            json.dumps(['Nice']),
+        ])
+        data = self.upload('api_import_locations', 'locations.ndjson', content).json()
+        self.assertEqual((data['created'], data['failed']), (1, 3))
+        self.assertEqual(data['errors'][0]['errors'], {'lat': ['Ensure this value is less than or equal to 90.']})
+        lyon = Location.objects.get(name='Lyon')
+        self.assertEqual(lyon.grid_key, grid_key(45.764043, 4.835659))
+
+    def test_import_json(self):
+        content = json.dumps([{'name': 'Lyon', 'lat': 45.764043, 'lon': 4.835659}])
+        data = self.upload('api_import_locations', 'upload', content, format='json').json()
+        self.assertEqual(data['created'], 1)
+        data = self.upload('api_import_locations', 'upload', '{"name": "Lyon"}', format='json').json()
+        self.assertEqual(data['errors'], [{'row': 1, 'errors': {'__all__': ['Expected an array']}}])
+
+    def test_import_invalid_upload(self):
+        response = self.upload('api_import_tasks', 'tasks.xml', '<tasks/>')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('todolist:api_import_tasks'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'locations.csv')
+            with open(path, 'w') as file:
+                file.write('name,lat,lon\nLyon,45.764043,4.835659\nNowhere,95,4\n')
+            out, err = io.StringIO(), io.StringIO()
+            call_command('import_locations', path, stdout=out, stderr=err)
+            self.assertIn('Imported 1 locations, 1 rows failed', out.getvalue())
+            self.assertIn('Row 2: lat: Ensure this value is less than or equal to 90.', err.getvalue())
+            path = os.path.join(directory, 'tasks')
+            with open(path, 'w') as file:
+                file.write(json.dumps([{'name': 'Eat chips', 'date': '2024-05-26T10:00:00'}]))
+            call_command('import_tasks', path, format='json', stdout=out, stderr=err)
+            self.assertIn('Imported 1 tasks, 0 rows failed', out.getvalue())
+        self.assertTrue(Task.objects.filter(name='Eat chips').exists())
+
+
+# Tests for looking up places with the geocoding API
+class GeocodingTests(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.places = {'paris,fr': {'name': 'Paris', 'lat': 48.8566, 'lon': 2.3522}}
+        patcher = mock.patch('todolist.geocoding.request_geocode', side_effect=self.places.get)
+        self.request_geocode = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query('  Paris ,  FR '), 'paris,fr')
+        self.assertEqual(normalize_query('New   York'), 'new york')
+
+    # Tests results are cached by normalized query, places that weren't found as well
+    def test_cache(self):
+        self.assertEqual(geocode('Paris, FR').lat, 48.8566)
+        self.assertFalse(geocode('Atlantis').found)
+        with self.assertNumQueries(1):
+            results = geocode_many(['PARIS,fr', 'atlantis'])
+        self.assertEqual(results['paris,fr'].name, 'Paris')
+        self.assertFalse(results['atlantis'].found)
+        self.assertEqual(self.request_geocode.call_count, 2)
+
+    # Tests failed lookups are left out and not cached
+    def test_failure(self):
+        self.request_geocode.side_effect = requests.ConnectionError
+        self.assertIsNone(geocode('Paris,FR'))
+        self.assertFalse(GeocodingResult.objects.exists())
+
+    # Tests lookups run concurrently, but never more than the number of workers at a time
+    def test_bounded_concurrency(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def request_geocode(query):
+            with lock:
+                running.append(query)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(query)
+            return {'name': query, 'lat': 1.0, 'lon': 2.0}
+
+        self.request_geocode.side_effect = request_geocode
+        results = geocode_many(['Place %d' % i for i in range(12)], workers=3)
+        self.assertEqual(len(results), 12)
+        self.assertEqual(max(peak), 3)
+
+    # Tests locations get the coordinates of their name when they are left out
+    def test_location_form(self):
+        form = LocationForm({'name': 'Paris,FR'})
+        self.assertTrue(form.is_valid())
+        location = form.save()
+        self.assertEqual((location.lat, location.lon), (48.8566, 2.3522))
+        self.assertEqual(location.grid_key, grid_key(48.8566, 2.3522))
+        form = LocationForm({'name': 'Atlantis'})
+        self.assertEqual(form.errors, {'name': ['No place found by this name, enter its coordinates']})
+        form = LocationForm({'name': 'Atlantis', 'lat': 10})
+        self.assertEqual(form.errors, {'lon': ['This field is required.']})
+        form = LocationForm({'name': 'Atlantis', 'lat': 100, 'lon': 10})
+        self.assertIn('lat', form.errors)
+
+    def test_location_form_unavailable(self):
+        self.request_geocode.side_effect = requests.ConnectionError
+        form = LocationForm({'name': 'Paris,FR'})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(list(form.errors), ['__all__'])
+
+    # Tests imported locations without coordinates are looked up once per place
+    def test_import(self):
+        rows = [{'name': 'Paris,FR'}, {'name': 'paris, fr', 'lat': '', 'lon': ''}, {'name': 'Atlantis'}]
+        result = import_locations(rows, 10)
+        self.assertEqual((result.created, result.failed), (2, 1))
+        self.assertEqual(self.request_geocode.call_count, 2)
+        self.assertEqual(set(Location.objects.values_list('lat', flat=True)), {48.8566})
+
+    # Tests places past the shared rate limit aren't looked up, unless waiting for tokens, and none while the
+    # circuit breaker is open
+    @override_settings(WEATHER_API_BURST=2)
+    def test_load_shedding(self):
+        self.assertEqual(len(geocode_many(['Place %d' % i for i in range(3)])), 2)
+        self.assertEqual(self.request_geocode.call_count, 2)
+        limiter = mock.Mock()
+        self.assertEqual(len(geocode_many(['Place %d' % i for i in range(3)], limiter=limiter)), 3)
+        self.assertEqual(limiter.acquire.call_count, 1)
+
+        for _ in range(settings.WEATHER_BREAKER_FAILURES):
+            breaker.record_failure()
+        with mock.patch.object(weather_api_shed, 'inc') as shed:
+            self.assertIsNone(geocode('Lyon'))
+        shed.assert_called_once_with(1, reason='circuit_open')
+        self.assertEqual(self.request_geocode.call_count, 3)
+
+    # Tests imported names past the rate limit are reported as not looked up, instead of waited for
+    @override_settings(WEATHER_API_BURST=1)
+    def test_import_rate_limited(self):
+        self.places['lyon'] = {'name': 'Lyon', 'lat': 45.764, 'lon': 4.8357}
+        result = import_locations([{'name': 'Paris,FR'}, {'name': 'Lyon'}], 10)
+        self.assertEqual((result.created, result.failed), (1, 1))
+        self.assertEqual(
+            result.errors[0]['errors'], {'__all__': ['The place could not be looked up right now, enter its coordinates']}
+        )
+
+    # Tests the client asks the geocoding endpoint
+    def test_client(self):
+        with StubWeatherServer(places={'Paris,FR': (48.8566, 2.3522)}) as stub:
+            client = WeatherClient(stub.url, 'data/2.5/weather?', 'key', geocoding_endpoint='geo/1.0/direct?')
+            self.assertEqual(client.geocode('Paris,FR'), [{'name': 'Paris', 'lat': 48.8566, 'lon': 2.3522}])
+            self.assertEqual(client.geocode('Atlantis'), [])
+            client.close()
+
+
+# Tests for the weather observation history and its rollups
+@override_settings(WEATHER_HISTORY_RAW_DAYS=7, WEATHER_HISTORY_HOURLY_DAYS=90, WEATHER_HISTORY_DAILY_DAYS=730)
+class WeatherHistoryTests(ClearCachesMixin, TestCase):
+    now = datetime.datetime(2024, 6, 1, 12, 30)
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.8566, lon=2.3522)
+
+    def observe(self, observed_at, temperature, status):
+        return WeatherObservation.objects.create(
+            location=self.location, observed_at=observed_at, temperature=temperature, status=status
+        )
+
+    # Tests a fetched read is appended to the history in the background, after the request committed
+    def test_recorded_on_fetch(self):
+        read = {'temp': 21.5, 'weather': 'average', 'observed_at': self.now, 'condition_id': 801, 'daytime': True}
+        with mock.patch('todolist.weather.request_weather', return_value=read), \
+                mock.patch('todolist.history.history_executor') as executor, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(fetch_weather(self.location), {'temp': 21.5, 'weather': 'average', 'age': 0})
+            self.assertFalse(WeatherObservation.objects.exists())
+        function, observations = executor.submit.call_args.args[1:]
+        function(observations)
+        # Reading the same observation again doesn't duplicate it
+        function(observations)
+        observation = WeatherObservation.objects.get()
+        self.assertEqual(observation.location, self.location)
+        self.assertEqual(observation.observed_at, self.now)
+        self.assertEqual((observation.temperature, observation.status), (215, 1))
+        self.assertEqual((observation.condition_id, observation.daytime), (801, True))
+
+    # Tests observations are rated again like the scalar functions rate them, the ones not knowing their condition
+    # and daytime are left as they are
+    def test_rerate(self):
+        cases = [(800, True, 300), (800, False, 300), (801, True, 300), (500, True, 300), (800, True, 169),
+                 (800, True, 170), (800, True, 249), (800, True, 250)]
+        observations = [
+            WeatherObservation.objects.create(
+                location=self.location, observed_at=self.now - datetime.timedelta(minutes=i), temperature=temperature,
+                status=0, condition_id=condition_id, daytime=daytime,
+            )
+            for i, (condition_id, daytime, temperature) in enumerate(cases)
+        ]
+        unknown = self.observe(self.now - datetime.timedelta(hours=1), 300, 0)
+        expected = [
+            RATINGS.index(rate_weather(parse_weather([{'id': condition_id}]), parse_temp(temperature / 10), daytime))
+            for condition_id, daytime, temperature in cases
+        ]
+
+        self.assertEqual(rerate_history(batch_size=3), len([status for status in expected if status != 0]))
+        self.assertEqual(
+            [WeatherObservation.objects.get(pk=observation.pk).status for observation in observations], expected
+        )
+        self.assertEqual(WeatherObservation.objects.get(pk=unknown.pk).status, 0)
+        self.assertEqual(rerate_history(batch_size=3), 0)
+
+    # Tests observations past the retention are rolled up by the hour, recent ones are kept
+    def test_hourly_rollup(self):
+        day = datetime.datetime(2024, 5, 20)
+        self.observe(day.replace(hour=9, minute=5), 150, 0)
+        self.observe(day.replace(hour=9, minute=45), 210, 2)
+        self.observe(day.replace(hour=9, minute=50), 180, 2)
+        self.observe(day.replace(hour=10), 200, 1)
+        recent = self.observe(self.now - datetime.timedelta(days=1), 200, 1)
+
+        self.assertEqual(rollup_history(self.now), (4, 0, 0))
+        self.assertEqual(list(WeatherObservation.objects.all()), [recent])
+        rollup = WeatherRollup.objects.get(period=WeatherRollup.HOUR, start=day.replace(hour=9))
+        self.assertEqual(rollup.count, 3)
+        self.assertEqual((rollup.temperature_min, rollup.temperature_max, rollup.temperature_sum), (150, 210, 540))
+        self.assertEqual((rollup.bad_count, rollup.average_count, rollup.good_count), (1, 0, 2))
+        self.assertEqual(WeatherRollup.objects.get(start=day.replace(hour=10)).average_count, 1)
+        # Nothing is left to roll up
+        self.assertEqual(rollup_history(self.now), (0, 0, 0))
+
+    # Tests observations stored late are merged into the rollup of their hour
+    def test_late_observations_merged(self):
+        hour = datetime.datetime(2024, 5, 20, 9)
+        self.observe(hour, 150, 0)
+        rollup_history(self.now)
+        self.observe(hour + datetime.timedelta(minutes=30), 250, 2)
+        rollup_history(self.now)
+        rollup = WeatherRollup.objects.get()
+        self.assertEqual((rollup.count, rollup.temperature_min, rollup.temperature_max), (2, 150, 250))
+        self.assertEqual((rollup.temperature_sum, rollup.bad_count, rollup.good_count), (400, 1, 1))
+
+    # Tests hourly rollups past the retention are rolled up by the day, and old daily rollups dropped
+    def test_daily_rollup_and_retention(self):
+        day = datetime.datetime(2024, 1, 10)
+        for hour, (temperature, status) in enumerate([(100, 0), (140, 2), (120, 2)]):
+            WeatherRollup.objects.create(
+                location=self.location, period=WeatherRollup.HOUR, start=day.replace(hour=hour), count=2,
+                temperature_min=temperature, temperature_max=temperature + 10, temperature_sum=temperature * 2 + 10,
+                **{rating + '_count': 2 if index == status else 0 for index, rating in enumerate(RATINGS)},
+            )
+        WeatherRollup.objects.create(
+            location=self.location, period=WeatherRollup.DAY, start=datetime.datetime(2021, 1, 1), count=1,
+            temperature_min=0, temperature_max=0, temperature_sum=0, bad_count=1, average_count=0, good_count=0,
+        )
+
+        self.assertEqual(rollup_history(self.now), (0, 3, 1))
+        rollup = WeatherRollup.objects.get()
+        self.assertEqual((rollup.period, rollup.start, rollup.count), (WeatherRollup.DAY, day, 6))
+        self.assertEqual((rollup.temperature_min, rollup.temperature_max, rollup.temperature_sum), (100, 150, 750))
+        self.assertEqual((rollup.bad_count, rollup.average_count, rollup.good_count), (2, 0, 4))
+
+    # Tests the weather at a moment comes from the closest observation, or else from the rollups
+    def test_weather_at(self):
+        day = datetime.datetime(2024, 5, 20)
+        self.observe(day.replace(hour=9), 150, 0)
+        self.observe(day.replace(hour=10), 250, 2)
+        self.assertEqual(weather_at(self.location, day.replace(hour=9, minute=40)), {'temp': 25.0, 'weather': 'good'})
+        self.assertIsNone(weather_at(self.location, day.replace(hour=15)))
+
+        rollup_history(self.now)
+        self.assertEqual(weather_at(self.location, day.replace(hour=9, minute=40)), {'temp': 15.0, 'weather': 'bad'})
+        self.assertEqual(weather_at(self.location, day.replace(hour=10, minute=59)), {'temp': 25.0, 'weather': 'good'})
+        self.assertIsNone(weather_at(self.location, day.replace(hour=15)))
+
+    # Tests the management command applies the retention policy
+    def test_command(self):
+        self.observe(datetime.datetime.now() - datetime.timedelta(days=30), 150, 0)
+        out = io.StringIO()
+        call_command('rollup_weather_history', stdout=out)
+        self.assertIn('Rolled up 1 observations', out.getvalue())
+        self.assertEqual(WeatherRollup.objects.get().period, WeatherRollup.HOUR)
+
+
+# Tests for the benchmark and its synthetic data
+class BenchTests(ClearCachesMixin, TestCase):
+
+    # Tests the data is generated as asked, the same for the same seed
+    def test_generate_data(self):
+        data = generate_data(100, 5, 0.3, random.Random(1))
+        self.assertEqual(Location.objects.count(), 5)
+        self.assertEqual(Task.objects.count(), 100)
+        self.assertEqual(len(data.pending_ids) + len(data.done_ids), 100)
+        self.assertEqual(Task.objects.filter(done=True).count(), len(data.done_ids))
+        for location in Location.objects.all():
+            self.assertEqual(location.grid_key, grid_key(location.lat, location.lon))
+        tasks = list(Task.objects.order_by('id').values_list('date', 'done', 'location__lat'))
+        Task.objects.all().delete()
+        Location.objects.all().delete()
+        generate_data(100, 5, 0.3, random.Random(1))
+        self.assertEqual(list(Task.objects.order_by('id').values_list('date', 'done', 'location__lat')), tasks)
+
+    # Tests every scenario is run and reported, with the Weather API calls it made
+    def test_run_benchmark(self):
+        rng = random.Random(0)
+        data = generate_data(40, 3, 0.2, rng)
+        with StubWeatherServer() as stub, self.settings(WEATHER_API=stub.url):
+            report = run_benchmark(data, stub, list(SCENARIOS), 2, 5, rng)
+        self.assertEqual(list(report), list(SCENARIOS))
+        for scenario in report.values():
+            self.assertEqual((scenario['requests'], scenario['errors']), (2, 0))
+            self.assertEqual(set(scenario['latency_ms']), {'mean', 'p50', 'p95', 'p99'})
+            self.assertGreater(scenario['queries']['max'], 0)
+        self.assertGreater(report['index']['upstream_calls'], 0)
+        self.assertEqual(report['get_weather']['upstream_calls'], 0)
+        self.assertEqual(Task.objects.filter(pk__in=data.pending_ids).count(), len(data.pending_ids))
+
+    # Tests draining a pool waits for the work submitted so far, and the work it submits in turn
+    def test_drain(self):
+        pool = BackgroundPool(max_workers=2, thread_name_prefix='test')
+        self.addCleanup(pool.shutdown)
+        done = []
+
+        def work(name, then=None):
+            time.sleep(0.05)
+            if then:
+                pool.submit(work, then)
+            done.append(name)
+
+        pool.submit(work, 'first', then='second')
+        pool.drain()
+        self.assertEqual(done, ['first', 'second'])
+        pool.drain()
+
+    # Tests percentiles are taken by nearest rank
+    def test_summarize(self):
+        self.assertEqual(summarize(list(range(1, 101))), {'mean': 50.5, 'p50': 50, 'p95': 95, 'p99': 99})
+        self.assertEqual(summarize([3]), {'mean': 3, 'p50': 3, 'p95': 3, 'p99': 3})
+        self.assertEqual(summarize([]), {})
+
+    # Tests more queries or API calls are regressions, and slower requests past the tolerance
+    def test_compare_reports(self):
+        baseline = {'index': {'queries': {'max': 3}, 'upstream_calls': 2, 'latency_ms': {'p95': 10.0}}}
+        self.assertEqual(compare_reports(baseline, baseline, 0.2), [])
+        slightly_slower = {'index': dict(baseline['index'], latency_ms={'p95': 11.5})}
+        self.assertEqual(compare_reports(baseline, slightly_slower, 0.2), [])
+        report = {
+            'index': {'queries': {'max': 4}, 'upstream_calls': 3, 'latency_ms': {'p95': 12.5}},
+            'details': {'queries': {'max': 9}, 'upstream_calls': 9, 'latency_ms': {'p95': 99.0}},
+        }
+        self.assertEqual(compare_reports(baseline, report, 0.2), [
+            'index: up to 4 queries per request, was 3',
+            'index: 3 Weather API calls, was 2',
+            'index: p95 latency 12.5ms, was 10.0ms',
+        ])
+
+
+# Tests for the request metrics, the Server-Timing header and the /metrics endpoint
+class RequestMetricsTests(MockWeatherAPIMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for metric in REGISTRY:
+            metric.clear()
+        self.location = Location.objects.create(name='Paris', lat=48.8566, lon=2.3522)
+        Task.objects.create(name='Task', date='2024-05-26T10:00:00Z', location=self.location)
+
+    # Tests a response tells where the time went
+    def test_server_timing(self):
+        response = self.client.get(reverse('todolist:index'))
+        timings = dict(timing.split(';', 1) for timing in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timings), {'db', 'weather', 'cache', 'render', 'total'})
+        self.assertRegex(timings['db'], r'^dur=[0-9.]+;desc="[1-9][0-9]* queries"$')
+        self.assertRegex(timings['weather'], r'^dur=[0-9.]+;desc="1 calls"$')
+        self.assertEqual(timings['cache'], 'desc="0 hits / 1 misses"')
+        self.assertGreater(float(timings['render'][len('dur='):]), 0)
+
+        response = self.client.get(reverse('todolist:index'))
+        self.assertIn('weather;dur=0.0;desc="0 calls"', response['Server-Timing'])
+        self.assertIn('cache;desc="1 hits / 0 misses"', response['Server-Timing'])
+
+    # Tests requests are added to the metrics by view
+    def test_metrics(self):
+        self.client.get(reverse('todolist:index'))
+        self.client.get(reverse('todolist:index'))
+        self.client.get(reverse('todolist:get_weather', args=[self.location.id]))
+        self.client.get('/no/such/page')
+        self.assertEqual(request_duration.count(view='todolist:index'), 2)
+        self.assertEqual(request_duration.count(view='todolist:get_weather'), 1)
+        self.assertEqual(request_duration.count(view='unmatched'), 1)
+        self.assertEqual(request_weather_duration.count(view='todolist:index'), 1)
+        self.assertEqual(weather_cache_lookups.value(result='miss'), 1)
+        self.assertEqual(weather_cache_lookups.value(result='local'), 2)
+
+        response = self.client.get(reverse('todolist:metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE todolist_request_duration_seconds histogram', lines)
+        self.assertIn('todolist_request_duration_seconds_count{view="todolist:index"} 2', lines)
+        self.assertIn('todolist_request_duration_seconds_bucket{view="todolist:index",le="+Inf"} 2', lines)
+        self.assertIn('todolist_weather_cache_lookups_total{result="miss"} 1', lines)
+
+    # Tests Weather API calls are timed by outcome
+    def test_weather_api_calls(self):
+        self.request_weather.side_effect = request_weather
+        with StubWeatherServer(failures=3) as stub, self.settings(WEATHER_API=stub.url, WEATHER_API_BACKOFF=0):
+            self.assertIsNone(fetch_weather(self.location))
+            self.assertIsNotNone(fetch_weather(self.location))
+        self.assertEqual(weather_api_calls.count(outcome='error'), 1)
+        self.assertEqual(weather_api_calls.count(outcome='ok'), 1)
+
+    # Tests histograms count values up to each bound, in the Prometheus text format
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test', ('name',), (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value, name='a "quoted" name')
+        self.assertEqual(list(histogram.samples()), [
+            'test_seconds_bucket{name="a \\"quoted\\" name",le="0.1"} 2',
+            'test_seconds_bucket{name="a \\"quoted\\" name",le="1"} 3',
+            'test_seconds_bucket{name="a \\"quoted\\" name",le="+Inf"} 4',
+            'test_seconds_sum{name="a \\"quoted\\" name"} 5.65',
+            'test_seconds_count{name="a \\"quoted\\" name"} 4',
+        ])
+
+
+# Tests for the cache of rendered task list rows
+class TaskRowCacheTests(MockWeatherAPIMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        task_row_cache_lookups.clear()
+        self.location = Location.objects.create(name='Paris', lat=48.8566, lon=2.3522)
+        self.task = Task.objects.create(name='Task', date='2024-05-26T10:00:00Z', location=self.location)
+        self.done_task = Task.objects.create(name='Done task', date='2024-05-27T10:00:00Z', done=True)
+
+    def assertLookups(self, hits, misses):
+        self.assertEqual(
+            (task_row_cache_lookups.value(result='hit'), task_row_cache_lookups.value(result='miss')), (hits, misses)
+        )
+
+    # Tests rows are rendered once, then served from the cache
+    def test_cached(self):
+        response = self.client.get(reverse('todolist:index'))
+        self.assertLookups(0, 2)
+        self.assertContains(response, '<div class="background good">')
+        self.assertContains(response, 'formaction="%s"' % reverse('todolist:complete', args=[self.task.id]))
+        cached = self.client.get(reverse('todolist:index'))
+        self.assertLookups(2, 2)
+        self.assertEqual(cached.content.count(b'<tr>'), response.content.count(b'<tr>'))
+        self.assertContains(cached, 'Done task')
+
+    # Tests only the rows of changed tasks are rendered again
+    def test_task_changed(self):
+        self.client.get(reverse('todolist:index'))
+        self.task.name = 'Renamed task'
+        self.task.save()
+        response = self.client.get(reverse('todolist:index'))
+        self.assertLookups(1, 3)
+        self.assertContains(response, 'Renamed task')
+
+        self.client.post(reverse('todolist:complete', args=[self.task.id]))
+        response = self.client.get(reverse('todolist:index'))
+        self.assertLookups(2, 4)
+        self.assertNotContains(response, 'Mark as DONE')
+
+    # Tests rows are rendered again when their weather rating changes, and only then
+    def test_weather_changed(self):
+        self.client.get(reverse('todolist:index'))
+        weather = Weather.objects.get(location_id=self.location.id)
+        weather.temperature = 25.0
+        weather.save()
+        self.client.get(reverse('todolist:index'))
+        self.assertLookups(2, 2)
+        weather.status = 'bad'
+        weather.save()
+        response = self.client.get(reverse('todolist:index'))
+        self.assertLookups(3, 3)
+        self.assertContains(response, '<div class="background bad">')
+
+    # Tests rows hold no CSRF token, tasks are completed with the token of the bulk form
+    @override_settings(TASK_ROW_CACHE_SIZE=1)
+    def test_no_csrf_token(self):
+        response = self.client.get(reverse('todolist:index'))
+        self.assertEqual(response.content.count(b'csrfmiddlewaretoken'), 3)
+        self.assertEqual(row_cache.stats()['size'], 1)
+
+        client = Client(enforce_csrf_checks=True)
+        response = client.get(reverse('todolist:index'))
+        token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', response.content.decode()).group(1)
+        response = client.post(reverse('todolist:complete', args=[self.task.id]), {'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(Task.objects.get(pk=self.task.id).done)
+
+
+# Tests the batch rating engine rates like the scalar functions do
+class RatingBatchTests(SimpleTestCase):
+
+    # Condition ids and temperatures around every threshold, along with typical ones
+    CONDITION_IDS = [100, 199, 200, 201, 500, 699, 700, 701, 741, 799, 800, 801, 804, 900]
+    TEMPS = [-40.0, 0.0, 16.0, 16.999, 17, 17.0, 17.001, 20.5, 24.999, 25, 25.0, 25.001, 40.0, float('nan')]
+
+    # Helper for generating random Weather API payloads
+    def random_payloads(self, rng, count):
+        payloads = []
+        for i in range(count):
+            sunrise = rng.randint(0, 1000)
+            sunset = sunrise + rng.randint(-10, 1000)
+            payloads.append({
+                'weather': [{'id': rng.choice(self.CONDITION_IDS)} for _ in range(rng.randint(0, 4))],
+                'main': {'temp': rng.choice(self.TEMPS) if rng.random() < 0.5 else rng.uniform(-30, 45)},
+                'dt': rng.choice([sunrise, sunset, rng.randint(-100, 2100)]),
+                'sys': {'sunrise': sunrise, 'sunset': sunset},
+            })
+        return payloads
+
+    # Helper for rating a payload with the scalar functions
+    def rate(self, payload):
+        return rate_weather(
+            parse_weather(payload['weather']), parse_temp(payload['main']['temp']), is_daytime(payload)
+        )
+
+    # Tests random batches of observations, edge values included, get the ratings of the scalar functions
+    def test_matches_scalar(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            payloads = self.random_payloads(rng, rng.randint(0, 500))
+            self.assertEqual(rate_payloads(payloads), [self.rate(payload) for payload in payloads], seed)
+
+    # Tests every combination of the codes is rated like the scalar function rates it
+    def test_rating_table(self):
+        for p, particles in enumerate(PARTICLES):
+            for t, temperature in enumerate(TEMPERATURES):
+                for d in (0, 1):
+                    self.assertEqual(
+                        RATINGS[RATING_TABLE[p * 6 + t * 2 + d]], rate_weather(particles, temperature, bool(d))
+                    )
+
+    # Tests observations given as columns, with the condition ids of each one starting at its offset
+    def test_columns(self):
+        conditions = [[800], [500, 801], [], [801, 800], [1000]]
+        times = [5, 5, 5, 50, 5]
+        ratings = rate_weather_batch(
+            array('l', [condition_id for ids in conditions for condition_id in ids]), array('l', [0, 1, 3, 3, 5]),
+            array('d', [30] * 5), array('q', times), array('q', [0] * 5), array('q', [10] * 5),
+        )
+        self.assertEqual(ratings, [
+            self.rate({
+                'weather': [{'id': condition_id} for condition_id in ids],
+                'main': {'temp': 30},
+                'dt': read_time,
+                'sys': {'sunrise': 0, 'sunset': 10},
+            })
+            for ids, read_time in zip(conditions, times)
+        ])
+
+
+# Tests for paging through and filtering the task list
+@override_settings(TASKS_PAGE_SIZE=3)
+class TaskListPaginationTests(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        # Tasks sharing a date are ordered by id
+        self.tasks = [
+            Task.objects.create(name='Task %d' % i, date='2024-05-%02dT10:00:00Z' % (10 + i // 2), done=i % 3 == 0)
+            for i in range(8)
+        ]
+
+    # Helper for getting a page of the task list
+    def get_page(self, query=''):
+        response = self.client.get(reverse('todolist:index') + query)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    # Tests walking forwards and backwards through the pages
+    def test_pages(self):
+        response = self.get_page()
+        self.assertEqual(response.context['tasks'], self.tasks[0:3])
+        self.assertIsNone(response.context['previous_page'])
+        response = self.get_page('?' + response.context['next_page'])
+        self.assertEqual(response.context['tasks'], self.tasks[3:6])
+        response = self.get_page('?' + response.context['next_page'])
+        self.assertEqual(response.context['tasks'], self.tasks[6:8])
+        self.assertIsNone(response.context['next_page'])
+        response = self.get_page('?' + response.context['previous_page'])
+        self.assertEqual(response.context['tasks'], self.tasks[3:6])
+        response = self.get_page('?' + response.context['previous_page'])
+        self.assertEqual(response.context['tasks'], self.tasks[0:3])
+        self.assertIsNone(response.context['previous_page'])
+        self.assertContains(response, 'Next')
+
+    # Tests every page costs a single query
+    def test_page_queries(self):
+        response = self.get_page()
+        with self.assertNumQueries(1):
+            self.get_page('?' + response.context['next_page'])
+
+    # Tests filtering done and pending tasks, the filter is kept on the next page
+    def test_status_filter(self):
+        response = self.get_page('?status=done')
+        done = [task for task in self.tasks if task.done]
+        self.assertEqual(response.context['tasks'], done)
+        response = self.get_page('?status=pending')
+        pending = [task for task in self.tasks if not task.done]
+        self.assertEqual(response.context['tasks'], pending[0:3])
+        self.assertIn('status=pending', response.context['next_page'])
+        response = self.get_page('?' + response.context['next_page'])
+        self.assertEqual(response.context['tasks'], pending[3:5])
+
+    # Tests filtering tasks by location
+    def test_location_filter(self):
+        Task.objects.filter(pk=self.tasks[4].pk).update(location=self.location)
+        response = self.get_page('?location=%d' % self.location.id)
+        self.assertEqual([task.id for task in response.context['tasks']], [self.tasks[4].id])
+
+    # Tests invalid filters and cursors are ignored
+    def test_invalid_filters(self):
+        response = self.get_page('?status=maybe&location=abc&after=nonsense')
+        self.assertEqual(response.context['tasks'], self.tasks[0:3])
+
+
+# Tests for the background weather refresher
+@override_settings(WEATHER_CACHE_TTL=600)
+class RefreshWeatherCommandTests(MockWeatherAPIMixin, TestCase):
+
+    # Helper for creating a location, in a grid cell of its own, with a task and a weather read of a given age,
+    # None for no read
+    def create_location(self, name, age, done=False):
+        location = Location.objects.create(name=name, lat=10.0 + Location.objects.count(), lon=20.0)
+        Task.objects.create(name='Task', date='2024-05-26T10:00:00Z', location=location, done=done)
+        if age is not None:
+            create_weather(location, age)
+        return location
+
+    # Tests a pass refreshes missing and expiring reads of locations with open tasks only
+    def test_refresh_once(self):
+        missing = self.create_location('Missing', age=None)
+        expiring = self.create_location('Expiring', age=580)
+        self.create_location('Fresh', age=60)
+        self.create_location('Done', age=None, done=True)
+        out = io.StringIO()
+        call_command('refresh_weather', once=True, lead=60, stdout=out)
+        self.assertIn('Refreshed 2 of 2 due locations', out.getvalue())
+        self.assertCountEqual(
+            [call.args[0] for call in self.request_weather.call_args_list], [missing, expiring]
+        )
+        self.assertEqual(Weather.objects.filter(status='good').count(), 2)
+
+    # Tests cells leased by another caller are left to it
+    @override_settings(WEATHER_FETCH_DEADLINE=0)
+    def test_leased(self):
+        leased = self.create_location('Leased', age=None)
+        missing = self.create_location('Missing', age=None)
+        claim_leases({'weather:' + leased.grid_key}, 60)
+        out = io.StringIO()
+        call_command('refresh_weather', once=True, lead=60, rate=60000, stdout=out)
+        self.assertIn('Refreshed 1 of 2 due locations', out.getvalue())
+        self.assertEqual([call.args[0] for call in self.request_weather.call_args_list], [missing])
+
+    # Tests a failed pass is logged and the worker goes on with the next one
+    def test_failed_pass(self):
+        self.create_location('Missing', age=None)
+        out = io.StringIO()
+        command = 'todolist.management.commands.refresh_weather'
+        with mock.patch(command + '.refresh_weather', side_effect=[Exception('Gone'), {}]), \
+                mock.patch(command + '.close_old_connections') as close, \
+                mock.patch(command + '.time.sleep', side_effect=[None, KeyboardInterrupt]), \
+                self.assertLogs(command, 'ERROR'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('refresh_weather', stdout=out)
+        self.assertEqual(out.getvalue(), 'Refreshed 0 of 1 due locations\n')
+        self.assertEqual(close.call_count, 2)
+
+    # Tests views serve stored reads of any age without calling the API when inline fetching is off
+    @override_settings(WEATHER_FETCH_INLINE=False)
+    def test_views_read_only(self):
+        location = self.create_location('Expired', age=6000)
+        self.create_location('Missing', age=None)
+        response = self.client.get(reverse('todolist:index'))
+        self.assertEqual(
+            [task.weather for task in response.context['tasks']], [{'temp': 26, 'weather': 'average', 'age': 6000}, None]
+        )
+        response = self.client.get(reverse('todolist:get_weather', args=[location.id]))
+        self.assertJSONEqual(response.content, {'temp': 26, 'weather': 'average', 'age': 6000})
+        self.request_weather.assert_not_called()
+
+
+# Tests for the leases shared by all the processes
+class LeaseTests(TestCase):
+
+    # Tests a lease is held by a single caller until it is released or expires
+    def test_claim(self):
+        now = [1000.0]
+        holder, claimed = claim_leases({'a', 'b'}, 10, clock=lambda: now[0])
+        self.assertEqual(claimed, {'a', 'b'})
+        other, claimed = claim_leases({'b', 'c'}, 10, clock=lambda: now[0])
+        self.assertEqual(claimed, {'c'})
+        self.assertEqual(held_leases({'a', 'b', 'c', 'd'}, clock=lambda: now[0]), {'a', 'b', 'c'})
+        release_leases(holder, {'a'})
+        # Releasing leases of another holder leaves them as they are
+        release_leases(holder, {'c'})
+        self.assertEqual(held_leases({'a', 'b', 'c'}, clock=lambda: now[0]), {'b', 'c'})
+        now[0] += 10
+        self.assertEqual(claim_leases({'a', 'b', 'c'}, 10, clock=lambda: now[0])[1], {'a', 'b', 'c'})
+
+    def test_claim_nothing(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(claim_leases(set(), 10), (None, set()))
+
+
+# Tests for the token bucket rate limiter
+class TokenBucketTests(SimpleTestCase):
+
+    # Tests calls beyond the burst wait for tokens to refill
+    def test_acquire(self):
+        now = [0.0]
+        bucket = TokenBucket(rate=2, capacity=2, clock=lambda: now[0], sleep=lambda seconds: now.__setitem__(0, now[0] + seconds))
+        for i in range(6):
+            bucket.acquire()
+        # Two calls go through right away, the other four at two calls per second
+        self.assertAlmostEqual(now[0], 2.0)
+
+    # Tests a token is refused while the bucket is empty
+    def test_try_acquire(self):
+        now = [0.0]
+        bucket = TokenBucket(rate=1, capacity=1, clock=lambda: now[0])
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertAlmostEqual(bucket.try_acquire(), 1.0)
+        now[0] = 1.0
+        self.assertEqual(bucket.try_acquire(), 0)
+
+
+# Tests for the token bucket shared by all processes through the database
+class SharedTokenBucketTests(TestCase):
+
+    # Tests takers with their own bucket objects, like separate processes, share the tokens
+    def test_shared(self):
+        now = [1000.0]
+        buckets = [SharedTokenBucket('test', rate=1, capacity=2, clock=lambda: now[0]) for _ in range(2)]
+        self.assertEqual(buckets[0].try_acquire(), 0)
+        self.assertEqual(buckets[1].try_acquire(), 0)
+        self.assertAlmostEqual(buckets[0].try_acquire(), 1.0)
+        self.assertAlmostEqual(buckets[1].try_acquire(), 1.0)
+        now[0] += 0.5
+        self.assertAlmostEqual(buckets[1].try_acquire(), 0.5)
+        now[0] += 0.5
+        self.assertEqual(buckets[1].try_acquire(), 0)
+        self.assertAlmostEqual(buckets[0].tokens(), 0)
+
+    # Tests as many tokens as are available are taken at once
+    def test_take(self):
+        bucket = SharedTokenBucket('test', rate=1, capacity=5, clock=lambda: 1000.0)
+        self.assertEqual(bucket.take(3), 3)
+        self.assertEqual(bucket.take(5), 2)
+        self.assertEqual(bucket.take(1), 0)
+
+    # Tests the bucket doesn't fill up past its capacity, nor lose tokens to a clock behind the others
+    def test_capacity(self):
+        now = [1000.0]
+        bucket = SharedTokenBucket('test', rate=1, capacity=2, clock=lambda: now[0])
+        self.assertIsNone(bucket.tokens())
+        bucket.try_acquire()
+        now[0] += 3600
+        self.assertEqual(bucket.tokens(), 2)
+        bucket.try_acquire()
+        now[0] -= 10
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertAlmostEqual(bucket.try_acquire(), 1.0)
+        self.assertEqual(RateLimitBucket.objects.get(name='test').updated_at, 4600)
+
+
+# Tests for the circuit breaker
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: self.now)
+
+    # Tests the breaker opens after failures in a row, successes in between start over
+    def test_opens(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+    # Tests a single trial call is let through after the reset timeout, its outcome closes or opens the breaker
+    def test_half_open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 30
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+        self.now = 60
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+
+# Tests the weather keeps being served, from the stored reads, when the Weather API fails or is rate limited
+@override_settings(WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=3600, WEATHER_BREAKER_FAILURES=2)
+class WeatherDegradationTests(MockWeatherAPIMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for metric in REGISTRY:
+            metric.clear()
+        self.location = Location.objects.create(name='Paris', lat=48.8566, lon=2.3522)
+        self.task = Task.objects.create(name='Task', date='2024-05-26T10:00:00Z', location=self.location)
+
+    # Helper for storing a read past the hard TTL, which is only served when no new one can be had
+    def create_old_weather(self, location):
+        create_weather(location, age=5 * 3600, temperature=12, status='bad')
+
+    # Tests an error payload is reported as a Weather API error, not as a missing key
+    def test_error_payload(self):
+        client = mock.Mock()
+        client.current_weather.return_value = {'cod': 401, 'message': 'Invalid API key'}
+        self.request_weather.side_effect = request_weather
+        with mock.patch('todolist.weather.get_client', return_value=client):
+            with self.assertRaisesMessage(WeatherAPIError, 'Invalid API key'):
+                request_weather(self.location)
+            # The page is still served, with the last stored read
+            self.create_old_weather(self.location)
+            response = self.client.get(reverse('todolist:index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['tasks'][0].weather['weather'], 'bad')
+
+    # Tests the Weather API isn't called anymore after repeated failures, the stored reads are served meanwhile
+    def test_circuit_open(self):
+        self.create_old_weather(self.location)
+        self.request_weather.side_effect = requests.ConnectionError
+        for i in range(2):
+            self.assertEqual(fetch_weather(self.location)['weather'], 'bad')
+        self.assertEqual(self.request_weather.call_count, 2)
+        self.assertEqual(fetch_weather(self.location)['temp'], 12)
+        self.assertEqual(self.request_weather.call_count, 2)
+        self.assertEqual(weather_api_shed.value(reason='circuit_open'), 1)
+        lines = self.client.get(reverse('todolist:metrics')).content.decode().splitlines()
+        self.assertIn('todolist_weather_breaker_state 2', lines)
+
+        # Once the reset timeout is over a trial call closes the breaker again
+        self.request_weather.side_effect = None
+        breaker.opened_at -= settings.WEATHER_BREAKER_RESET
+        self.assertEqual(fetch_weather(self.location)['weather'], 'good')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    # Tests the Weather API calls past the shared rate limit are skipped, the stored reads are served instead
+    @override_settings(WEATHER_API_BURST=1, WEATHER_API_RATE_LIMIT=0.01)
+    def test_rate_limited(self):
+        elsewhere = Location.objects.create(name='Lyon', lat=45.764, lon=4.8357)
+        Task.objects.create(name='Task', date='2024-05-26T11:00:00Z', location=elsewhere)
+        self.create_old_weather(elsewhere)
+        response = self.client.get(reverse('todolist:index'))
+        self.assertEqual(self.request_weather.call_count, 1)
+        reads = {task.location_id: task.weather for task in response.context['tasks']}
+        self.assertEqual(reads[self.location.id]['weather'], 'good')
+        self.assertEqual(reads[elsewhere.id]['weather'], 'bad')
+        self.assertEqual(weather_api_shed.value(reason='rate_limit'), 1)
+        lines = self.client.get(reverse('todolist:metrics')).content.decode().splitlines()
+        tokens = next(line.split()[1] for line in lines if line.startswith('todolist_weather_api_tokens '))
+        self.assertLess(float(tokens), 1)
+
+
+# Tests concurrent weather misses for a location result in a single Weather API call
+@override_settings(WEATHER_CACHE_TTL=600, WEATHER_FETCH_DEADLINE=5)
+class WeatherSingleFlightTests(ClearCachesMixin, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        self.calls = 0
+        self.calls_lock = threading.Lock()
+
+    # Stand-in for the Weather API call, slow enough for all the callers to pile up
+    def request_weather(self, location):
+        with self.calls_lock:
+            self.calls += 1
+        time.sleep(0.3)
+        return {'temp': 30.0, 'weather': 'good'}
+
+    # Helper for fetching the weather from many threads at once, each with its own database connection
+    def fetch_concurrently(self, count):
+        barrier = threading.Barrier(count)
+
+        def fetch():
+            try:
+                location = Location.objects.get(pk=self.location.pk)
+                barrier.wait()
+                return fetch_weather(location)
+            finally:
+                connection.close()
+
+        with mock.patch('todolist.weather.request_weather', side_effect=self.request_weather):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=count) as executor:
+                return list(executor.map(lambda i: fetch(), range(count)))
+
+    # Tests callers within the process wait for the leading call
+    def test_thundering_herd(self):
+        results = self.fetch_concurrently(10)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'temp': 30.0, 'weather': 'good', 'age': 0}] * 10)
+        self.assertEqual(Weather.objects.count(), 1)
+
+    # Tests callers wait on each other through the lease of the cell, as callers from different processes would
+    def test_thundering_herd_across_processes(self):
+        # Every caller leads its own flight, like callers in separate processes do
+        def claim(keys):
+            return {key: concurrent.futures.Future() for key in keys}, {}
+
+        with mock.patch.object(flights, 'claim', side_effect=claim), mock.patch.object(flights, 'resolve'):
+            results = self.fetch_concurrently(5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'temp': 30.0, 'weather': 'good', 'age': 0}] * 5)
+
+    # Tests the locations can be written to while their weather is fetched, no lock is held meanwhile
+    def test_no_lock_during_call(self):
+        def request_weather(location):
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET lock_timeout = '1s'")
+                Location.objects.filter(pk=location.pk).update(name='Paris, FR')
+            finally:
+                connection.close()
+            return {'temp': 30.0, 'weather': 'good'}
+
+        with mock.patch('todolist.weather.request_weather', side_effect=request_weather):
+            self.assertEqual(fetch_weather(self.location), {'temp': 30.0, 'weather': 'good', 'age': 0})
+        self.assertEqual(Location.objects.get(pk=self.location.pk).name, 'Paris, FR')
+
+
+# Tests stale weather reads are served while they are refreshed in the background
+@override_settings(WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=3600)
+class WeatherStaleWhileRevalidateTests(MockWeatherAPIMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        self.create_rate_limit_bucket()
+
+    # Tests a stale read is served right away with its age and refreshed afterwards
+    def test_stale(self):
+        create_weather(self.location, age=660)
+        with mock.patch('todolist.weather.revalidation_executor') as executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(reverse('todolist:get_weather', args=[self.location.id]))
+        self.assertJSONEqual(response.content, {'temp': 26, 'weather': 'average', 'age': 660})
+        self.request_weather.assert_not_called()
+        executor.submit.assert_called_once()
+        # Run the scheduled refresh
+        function, *args = executor.submit.call_args.args[1:]
+        function(*args)
+        self.assertEqual(self.request_weather.call_count, 1)
+        self.assertEqual(Weather.objects.get(location=self.location).status, 'good')
+
+    # Tests a stale cell is queued for a refresh once, however many requests see it, until the refresh ran
+    def test_stale_queued_once(self):
+        create_weather(self.location, age=660)
+        neighbour = Location.objects.create(name='Paris too', lat=48.864717, lon=2.349015)
+        with mock.patch('todolist.weather.revalidation_executor') as executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                for location_id in (self.location.id, self.location.id, neighbour.id):
+                    self.client.get(reverse('todolist:get_weather', args=[location_id]))
+            executor.submit.assert_called_once()
+            function, *args = executor.submit.call_args.args[1:]
+            function(*args)
+            Weather.objects.update(modified_at=datetime.datetime.now() - datetime.timedelta(seconds=660))
+            local_cache.clear()
+            cache.clear()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.get(reverse('todolist:get_weather', args=[neighbour.id]))
+        self.assertEqual(executor.submit.call_count, 2)
+
+    # Tests a refresh is skipped when the read was refreshed in the meantime
+    def test_revalidate_fresh(self):
+        create_weather(self.location, age=60)
+        revalidate_weather([self.location.id])
+        self.request_weather.assert_not_called()
+
+    # Tests a read past the hard TTL is not served, the request waits for a new one
+    def test_expired(self):
+        create_weather(self.location, age=4000)
+        with mock.patch('todolist.weather.revalidation_executor') as executor, \
+                mock.patch('todolist.history.history_executor'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(reverse('todolist:get_weather', args=[self.location.id]))
+        self.assertJSONEqual(response.content, {'temp': 30.0, 'weather': 'good', 'age': 0})
+        self.assertEqual(self.request_weather.call_count, 1)
+        executor.submit.assert_not_called()
+
+
+# Tests for fetching weather for many locations in a single call
+@override_settings(WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=600)
+class WeatherBatchTests(MockWeatherAPIMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.locations = [
+            Location.objects.create(name='City %d' % i, lat=10.0 + i, lon=20.0) for i in range(3)
+        ]
+
+    # Helper for calling the batch endpoint
+    def get_weather(self, location_ids):
+        return self.client.get(reverse('todolist:get_weather_batch'), {'location': location_ids})
+
+    # Tests stored reads are served in a single query
+    def test_hits(self):
+        for location in self.locations:
+            Weather.objects.create(location=location, temperature=26, status='average')
+        with self.assertNumQueries(1):
+            response = self.get_weather([location.id for location in self.locations])
+        self.assertJSONEqual(
+            response.content,
+            {str(location.id): {'temp': 26, 'weather': 'average', 'age': 0} for location in self.locations}
+        )
+        self.request_weather.assert_not_called()
+
+    # Tests missing reads are fetched, unknown locations are left out
+    def test_misses(self):
+        Weather.objects.create(location=self.locations[0], temperature=26, status='average')
+        response = self.get_weather([location.id for location in self.locations] + [999])
+        self.assertJSONEqual(response.content, {
+            str(self.locations[0].id): {'temp': 26, 'weather': 'average', 'age': 0},
+            str(self.locations[1].id): {'temp': 30.0, 'weather': 'good', 'age': 0},
+            str(self.locations[2].id): {'temp': 30.0, 'weather': 'good', 'age': 0},
+        })
+        self.assertEqual(self.request_weather.call_count, 2)
+
+    # Tests prefetching serves the stored reads only, without calling the Weather API for the missing ones
+    def test_stored(self):
+        create_weather(self.locations[0])
+        create_weather(self.locations[1], age=700)
+        response = self.client.get(
+            reverse('todolist:get_weather_batch'),
+            {'location': [location.id for location in self.locations], 'stored': 1},
+        )
+        self.assertJSONEqual(response.content, {
+            str(self.locations[0].id): {'temp': 26, 'weather': 'average', 'age': 0},
+            str(self.locations[1].id): {'temp': None, 'weather': None, 'age': None},
+            str(self.locations[2].id): {'temp': None, 'weather': None, 'age': None},
+        })
+        self.request_weather.assert_not_called()
+
+    # Tests malformed and oversized calls are refused
+    def test_bad_request(self):
+        self.assertEqual(self.get_weather(['abc']).status_code, 400)
+        self.assertEqual(self.get_weather(list(range(101))).status_code, 400)
+
+
+# Tests for the in-process LRU cache
+class LRUCacheTests(SimpleTestCase):
+
+    # Tests the least recently used entry is evicted when the cache is full
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        cache.get(1)
+        cache.set(3, 'c')
+        self.assertEqual(cache.get(1), 'a')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), 'c')
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'evictions': 1, 'size': 2, 'maxsize': 2})
+
+    # Tests entries expire after the TTL
+    def test_ttl(self):
+        now = [0.0]
+        cache = LRUCache(maxsize=2, ttl=60, clock=lambda: now[0])
+        cache.set(1, 'a')
+        now[0] = 59
+        self.assertEqual(cache.get(1), 'a')
+        now[0] = 60
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+# Tests for the local cache in front of the stored weather reads
+@override_settings(WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=600)
+class WeatherLocalCacheTests(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+        Weather.objects.create(location=self.location, temperature=26, status='average')
+        self.location = Location.objects.get(pk=self.location.pk)
+
+    # Tests a read is looked up in the database once, then served from memory
+    def test_hit(self):
+        with self.assertNumQueries(1):
+            fetch_weather(self.location)
+        with self.assertNumQueries(0):
+            data = fetch_weather(self.location)
+        self.assertEqual(data, {'temp': 26, 'weather': 'average', 'age': 0})
+
+    # Tests changing a read outside of the weather module drops it from memory
+    def test_invalidate_on_save(self):
+        fetch_weather(self.location)
+        weather = Weather.objects.get(location=self.location)
+        weather.status = 'bad'
+        weather.save()
+        self.assertEqual(fetch_weather(self.location)['weather'], 'bad')
+
+    # Tests forcing a weather refresh drops the reads from memory
+    def test_invalidate_on_refresh(self):
+        fetch_weather(self.location)
+        self.client.post(reverse('todolist:force_weather_refresh'))
+        self.assertIsNone(local_cache.get(self.location.id))
+
+    # Tests the cache size, hits, misses and evictions are exposed in the metrics
+    @override_settings(WEATHER_LOCAL_CACHE_SIZE=1)
+    def test_metrics(self):
+        # The counts go on since the process started
+        stats = local_cache.stats()
+        local_cache.set(1, Weather(temperature=26, status='good'))
+        local_cache.set(2, Weather(temperature=26, status='good'))
+        local_cache.get(1)
+        local_cache.get(2)
+        lines = self.client.get(reverse('todolist:metrics')).content.decode().splitlines()
+        self.assertIn('todolist_weather_local_cache_size 1', lines)
+        self.assertIn('# TYPE todolist_weather_local_cache_hits_total counter', lines)
+        self.assertIn('todolist_weather_local_cache_hits_total %d' % (stats['hits'] + 1), lines)
+        self.assertIn('todolist_weather_local_cache_misses_total %d' % (stats['misses'] + 1), lines)
+        self.assertIn('todolist_weather_local_cache_evictions_total %d' % (stats['evictions'] + 1), lines)
+
+
+# Tests for the weather reads shared by all the workers through the cache
+@override_settings(WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=600)
+class WeatherSharedCacheTests(MockWeatherAPIMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='Paris', lat=48.864716, lon=2.349014)
+
+    # Tests a read fetched by one worker is served to another one without a query or an API call
+    def test_shared_between_workers(self):
+        fetch_weather(self.location)
+        # Another worker starts with its own empty local cache
+        local_cache.clear()
+        location = Location.objects.get(pk=self.location.pk)
+        with self.assertNumQueries(0):
+            data = fetch_weather(location)
+        self.assertEqual(data, {'temp': 30.0, 'weather': 'good', 'age': 0})
+        self.assertEqual(self.request_weather.call_count, 1)
+
+    # Tests locations at the same rounded coordinates share a read
+    def test_rounded_coordinates(self):
+        fetch_weather(self.location)
+        nearby = Location.objects.create(name='Paris Centre', lat=48.8612, lon=2.3451)
+        self.assertEqual(fetch_weather(nearby), {'temp': 30.0, 'weather': 'good', 'age': 0})
+        self.assertEqual(self.request_weather.call_count, 1)
+
+    # Tests forcing a weather refresh drops the shared reads
+    def test_invalidate_on_refresh(self):
+        fetch_weather(self.location)
+        self.client.post(reverse('todolist:force_weather_refresh'))
+        local_cache.clear()
+        fetch_weather(self.location)
+        self.assertEqual(self.request_weather.call_count, 2)
+
+    # Tests an unavailable cache falls back to the database
+    def test_unavailable(self):
+        Weather.objects.create(location=self.location, temperature=26, status='average')
+        with mock.patch('todolist.weather.cache.get_many', side_effect=ConnectionError):
+            data = fetch_weather(Location.objects.get(pk=self.location.pk))
+        self.assertEqual(data, {'temp': 26, 'weather': 'average', 'age': 0})
+
+
+# Tests nearby locations share their weather reads through the weather grid
+@override_settings(WEATHER_CACHE_TTL=600, WEATHER_CACHE_HARD_TTL=600, WEATHER_GRID_SIZE=0.01)
+class WeatherGridTests(MockWeatherAPIMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.office1 = Location.objects.create(name='Office 1', lat=48.8641, lon=2.3411)
+        self.office2 = Location.objects.create(name='Office 2', lat=48.8649, lon=2.3419)
+        self.elsewhere = Location.objects.create(name='Lyon', lat=45.764, lon=4.8357)
+        for location in (self.office1, self.office2, self.elsewhere):
+            Task.objects.create(name='Task', date='2024-05-26T10:00:00Z', location=location)
+
+    # Tests coordinates are bucketed into grid cells
+    def test_grid_key(self):
+        self.assertEqual(self.office1.grid_key, '4886:234')
+        self.assertEqual(self.office1.grid_key, self.office2.grid_key)
+        self.assertNotEqual(self.office1.grid_key, self.elsewhere.grid_key)
+        self.assertEqual(grid_key(0.29, -0.29), '29:-29')
+
+    # Tests a single API call is made per grid cell
+    def test_one_call_per_cell(self):
+        response = self.client.get(reverse('todolist:index'))
+        self.assertEqual(self.request_weather.call_count, 2)
+        for task in response.context['tasks']:
+            self.assertEqual(task.weather['weather'], 'good')
+
+    # Tests a location is served the stored read of another location in its cell
+    def test_shared_stored_read(self):
+        Weather.objects.create(location=self.office1, temperature=26, status='average')
+        local_cache.clear()
+        cache.clear()
+        self.assertEqual(fetch_weather(self.office2), {'temp': 26, 'weather': 'average', 'age': 0})
+        self.request_weather.assert_not_called()
+
+    # Tests locations are moved to new cells when the grid changes
+    def test_regrid(self):
+        with self.settings(WEATHER_GRID_SIZE=1):
+            call_command('regrid_locations', stdout=io.StringIO())
+        self.assertEqual(Location.objects.get(pk=self.office1.pk).grid_key, '48:2')
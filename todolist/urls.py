@@ -1,6 +1,6 @@
 from django.urls import path
 
-from . import views
+from . import api, views
 
 app_name = 'todolist'
 urlpatterns = [
@@ -11,6 +11,17 @@ urlpatterns = [
     path("<int:task_id>/", views.edit, name="edit"),
     path("<int:task_id>/delete", views.delete, name="delete"),
     path("<int:task_id>/complete", views.complete, name="complete"),
+    path("delete", views.bulk_delete, name="bulk_delete"),
+    path("complete", views.bulk_complete, name="bulk_complete"),
+    path("export", views.export_tasks, name="export_tasks"),
     path("<int:location_id>/get_weather", views.get_weather, name="get_weather"),
+    path("get_weather", views.get_weather_batch, name="get_weather_batch"),
     path("weather_refresh", views.force_weather_refresh, name="force_weather_refresh"),
+    path("metrics", views.metrics, name="metrics"),
+    path("api/tasks", api.tasks, name="api_tasks"),
+    path("api/tasks/changes", api.changes, name="api_task_changes"),
+    path("api/tasks/import", api.import_file, {'kind': 'tasks'}, name="api_import_tasks"),
+    path("api/locations/import", api.import_file, {'kind': 'locations'}, name="api_import_locations"),
+    path("api/tasks/<int:task_id>", api.task, name="api_task"),
+    path("api/tasks/<int:task_id>/complete", api.complete, name="api_complete"),
 ]
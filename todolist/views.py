@@ -1,20 +1,40 @@
-from django.http import HttpResponseRedirect, JsonResponse
+import datetime
+
+from django.conf import settings
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse, StreamingHttpResponse,
+)
 from django.shortcuts import render, get_object_or_404
 
-from todolist.forms import TaskForm
-from todolist.models import Task, Weather, Location, LastWeatherRead
-from todolist.weather import fetch_weather
+from todolist.export import EXPORT_FORMATS
+from todolist.forms import TaskForm, TaskFilterForm
+from todolist.metrics import render_metrics
+from todolist.models import Task, Location
+from todolist.pagination import paginate_tasks
+from todolist.task_rows import render_task_rows
+from todolist.weather import expire_weather, fetch_weather, fetch_weather_many, get_recent_weather_many
+
+# Maximum number of locations in a single batch weather call
+MAX_WEATHER_BATCH = 100
 
 
-# Endpoint for listing all tasks
+# Endpoint for listing tasks, a page at a time
 def index(request):
-    tasks = Task.objects.order_by('date')
+    filters = TaskFilterForm(request.GET)
+    # Load locations with their weather reads and the weather reads of done tasks along with the tasks
+    tasks = filters.filter_tasks(
+        Task.objects.select_related('location', 'location__weather', 'last_weather_read')
+    )
+    page = paginate_tasks(
+        tasks,
+        settings.TASKS_PAGE_SIZE,
+        after=filters.cleaned_data.get('after'),
+        before=filters.cleaned_data.get('before'),
+    )
+    tasks = page.tasks
     # Get weather data for active locations
-    active_locations = tasks.exclude(done=True).values('location').distinct()
-    locations = Location.objects.filter(id__in=active_locations)
-    weather_reads = {}
-    for location in locations:
-        weather_reads[location.id] = fetch_weather(location)
+    active_locations = {task.location_id: task.location for task in tasks if not task.done and task.location}
+    weather_reads = fetch_weather_many(list(active_locations.values()))
     # Expand tasks with weather information
     for task in tasks:
         if task.done and hasattr(task, 'last_weather_read'):
@@ -23,12 +43,22 @@ def index(request):
                 'weather': task.last_weather_read.status
             }
         elif task.location is not None:
-            task.weather = weather_reads[task.location.id]
+            task.weather = weather_reads.get(task.location.id)
+    render_task_rows(tasks)
 
     return render(
         request,
         "tasks/index.html",
-        {'tasks': tasks}
+        {
+            'tasks': tasks,
+            'filters': filters,
+            'status_links': [
+                (label, filters.query_string(status=status))
+                for status, label in (('', 'All'), ('pending', 'Pending'), ('done', 'Done'))
+            ],
+            'next_page': page.next_cursor and filters.query_string(after=page.next_cursor),
+            'previous_page': page.previous_cursor and filters.query_string(before=page.previous_cursor),
+        }
     )
 
 
@@ -66,8 +96,7 @@ def add(request):
 # Endpoint for clearing the entire list of tasks
 def clear(request):
     if request.method == "POST":
-        entries = Task.objects.all()
-        entries.delete()
+        Task.objects.all().delete_in_batches(settings.BULK_BATCH_SIZE)
 
     return HttpResponseRedirect("/")
 
@@ -105,41 +134,108 @@ def delete(request, task_id):
     return HttpResponseRedirect("/")
 
 
+# Endpoint for deleting many tasks at once, the tasks are given as a list of `task` ids
+def bulk_delete(request):
+    if request.method == "POST":
+        task_ids = get_task_ids(request)
+        if task_ids is None:
+            return HttpResponseBadRequest('Task ids must be integers')
+        Task.objects.filter(pk__in=task_ids).delete()
+
+    # redirect to index:
+    return HttpResponseRedirect("/")
+
+
 # Endpoint for marking an existing task as done
 def complete(request, task_id):
     if request.method == "POST":
         # fetch Task to be updated
         task = get_object_or_404(Task, pk=task_id)
-        # update Task
-        task.done = True
-        if hasattr(task, 'location'):
-            # Save the last weather read for the task, it won't be fetching weather updates anymore
-            last_weather_read = Weather.objects.filter(location=task.location).first()
-            if last_weather_read:
-                LastWeatherRead.objects.create(
-                    task=task,
-                    temperature=last_weather_read.temperature,
-                    status=last_weather_read.status
-                )
-
-        task.save()
+        # update Task, saving the last weather read for it
+        Task.objects.filter(pk=task.pk).complete()
+
+    # redirect to index:
+    return HttpResponseRedirect("/")
+
+
+# Endpoint for marking many tasks as done at once, the tasks are given as a list of `task` ids
+def bulk_complete(request):
+    if request.method == "POST":
+        task_ids = get_task_ids(request)
+        if task_ids is None:
+            return HttpResponseBadRequest('Task ids must be integers')
+        Task.objects.filter(pk__in=task_ids).complete()
 
     # redirect to index:
     return HttpResponseRedirect("/")
 
 
+# Get the list of `task` ids posted for bulk operations, None if any of them is not a number
+def get_task_ids(request):
+    try:
+        return [int(task_id) for task_id in request.POST.getlist('task')]
+    except ValueError:
+        return None
+
+
+# Endpoint for downloading all tasks along with their locations and weather reads, e.g. /export?format=ndjson
+# The export is streamed as it is read from the database, in CSV unless asked otherwise
+def export_tasks(request):
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest('Format must be one of: %s' % ', '.join(EXPORT_FORMATS))
+    export_lines, content_type = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(export_lines(settings.BULK_BATCH_SIZE), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="tasks.%s"' % export_format
+
+    return response
+
+
 # Endpoint for fetching weather for fetch API calls
 def get_weather(request, location_id):
     location = get_object_or_404(Location, pk=location_id)
-    data = fetch_weather(location)
+    data = fetch_weather(location) or {'temp': None, 'weather': None, 'age': None}
 
     return JsonResponse(data)
 
 
-# Endpoint for clearing all weather data to force it to be re-fetched
+# Endpoint for fetching weather for many locations in a single fetch API call, e.g. /get_weather?location=1&location=2
+# Responds with the reads by location id, unknown locations are left out
+# With `stored=1` only the reads already stored and not past the hard TTL are served, without calling the Weather API,
+# for prefetching reads that may not be looked at without spending the shared rate limit on them
+def get_weather_batch(request):
+    try:
+        location_ids = [int(location_id) for location_id in request.GET.getlist('location')]
+    except ValueError:
+        return HttpResponseBadRequest('Location ids must be integers')
+    if len(location_ids) > MAX_WEATHER_BATCH:
+        return HttpResponseBadRequest('At most %d locations at a time' % MAX_WEATHER_BATCH)
+    # Load the stored reads along with the locations
+    locations = list(Location.objects.filter(pk__in=location_ids).select_related('weather'))
+    if request.GET.get('stored'):
+        weather_reads = get_recent_weather_many(
+            locations,
+            fresh_after=datetime.datetime.now() - datetime.timedelta(seconds=settings.WEATHER_CACHE_HARD_TTL),
+        )
+    else:
+        weather_reads = fetch_weather_many(locations)
+    data = {
+        location.id: weather_reads.get(location.id, {'temp': None, 'weather': None, 'age': None})
+        for location in locations
+    }
+
+    return JsonResponse(data)
+
+
+# Endpoint for expiring all weather data to force it to be re-fetched
+# The expired reads are served until their refresh, so the next page load doesn't wait on every one of them
 def force_weather_refresh(request):
     if request.method == "POST":
-        entries = Weather.objects.all()
-        entries.delete()
+        expire_weather(settings.BULK_BATCH_SIZE)
 
     return HttpResponseRedirect("/")
+
+
+# Endpoint for scraping the request and weather metrics of this process, in the Prometheus text format
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,62 +1,545 @@
+import concurrent.futures
 import datetime
-import json
-import os
-import requests
+import logging
+import threading
+import time
 
-from todolist.models import Weather
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models import F
+from django.dispatch import Signal
+
+from todolist.background import BackgroundPool
+from todolist.grid import group_by_cell
+from todolist.leases import claim_leases, held_leases, release_leases
+from todolist.circuit_breaker import CircuitBreaker
+from todolist.lru_cache import LRUCache
+from todolist.metrics import (
+    record_weather_calls,
+    record_weather_lookups,
+    weather_api_calls,
+    weather_api_shed,
+    weather_api_tokens,
+    weather_breaker_state,
+    weather_local_cache_evictions,
+    weather_local_cache_hits,
+    weather_local_cache_misses,
+    weather_local_cache_size,
+)
+from todolist.models import Location, Weather
+from todolist.rate_limit import SharedTokenBucket
+from todolist.single_flight import SingleFlight
+from todolist.weather_client import WeatherAPIError, get_client
+
+logger = logging.getLogger(__name__)
+
+# Temperatures below these are cold and warm respectively, hot otherwise
+COLD_BELOW = 17
+WARM_BELOW = 25
+# Ratings of the weather, from worst to best
+RATINGS = ('bad', 'average', 'good')
+
+# Weather API calls in flight within this process, by grid cell
+flights = SingleFlight()
+# Recently used weather reads of this process, by location id
+local_cache = LRUCache(settings.WEATHER_LOCAL_CACHE_SIZE, settings.WEATHER_LOCAL_CACHE_TTL)
+weather_local_cache_size.set_function(lambda: local_cache.stats()['size'])
+weather_local_cache_hits.set_function(lambda: local_cache.stats()['hits'])
+weather_local_cache_misses.set_function(lambda: local_cache.stats()['misses'])
+weather_local_cache_evictions.set_function(lambda: local_cache.stats()['evictions'])
+
+# Sent with the new reads, as a dict of reads by location, whenever they are stored
+weather_stored = Signal()
+# Weather API calls of this process stop for a while after repeated failures
+breaker = CircuitBreaker(settings.WEATHER_BREAKER_FAILURES, settings.WEATHER_BREAKER_RESET)
+weather_breaker_state.set_function(
+    lambda: (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN).index(breaker.state)
+)
+# Name of the rate limit bucket of the Weather API, shared with geocoding calls
+WEATHER_API_BUCKET = 'weather-api'
+# Seconds a lease on fetching a cell's read is held past the deadline of the calls, to store the read
+LEASE_SLACK = 5
+# Seconds between checks for the reads of cells leased by other callers
+LEASE_POLL_INTERVAL = 0.05
+# Pool refreshing stale reads after they have been served
+revalidation_executor = BackgroundPool(max_workers=2, thread_name_prefix='weather-revalidate')
+# Grid cells queued for a refresh in the pool or being refreshed, they aren't queued again meanwhile
+pending_revalidations = set()
+pending_revalidations_lock = threading.Lock()
 
 
 # Fetch Weather data
 # Uses recent database data if possible, fetches from Weather API if database data is old or doesn't exist
+# Returns None when no read could be had in time
 def fetch_weather(location):
-    recent_reads = Weather.objects.filter(modified_at__gte=(datetime.datetime.now() - datetime.timedelta(minutes=10)))
-    if (
-            # The location already has a temperature read
-            hasattr(location, 'weather') and
-            # The temperature read is from the last 10 minutes
-            location.weather in recent_reads
-    ):
-        data = {
-            'temp': location.weather.temperature,
-            'weather': location.weather.status
-        }
-    else:
-        # Fetch temperature read from API
-        data = request_weather(location)
-        # Store the new read
-        if hasattr(location, 'weather'):
-            # If the location already had a temperature read
-            location.weather.temperature = data['temp']
-            location.weather.status = data['weather']
+    return fetch_weather_many([location]).get(location.id)
+
+
+# Fetch Weather data for many locations at once
+# Recent database reads are used as they are, the rest is fetched from Weather API concurrently.
+# Reads older than WEATHER_CACHE_TTL but not WEATHER_CACHE_HARD_TTL are used as well, and refreshed in the background.
+# Returns a dict of reads by location id, locations without a read in time are left out
+# With WEATHER_FETCH_INLINE off the stored reads are used whatever their age
+def fetch_weather_many(locations):
+    if not settings.WEATHER_FETCH_INLINE:
+        return get_recent_weather_many(locations, fresh_after=datetime.datetime.min)
+    # Wait for the reads until the deadline, a slow API call must not stall the whole page
+    deadline_at = time.monotonic() + settings.WEATHER_FETCH_DEADLINE
+    weather_reads = get_recent_weather_many(
+        locations, fresh_after=datetime.datetime.now() - datetime.timedelta(seconds=settings.WEATHER_CACHE_HARD_TTL)
+    )
+    stale = [
+        location for location in locations
+        if location.id in weather_reads and weather_reads[location.id]['age'] >= settings.WEATHER_CACHE_TTL
+    ]
+    if stale:
+        schedule_revalidation(stale)
+    misses = [location for location in locations if location.id not in weather_reads]
+    # Locations in the same grid cell share a read, only one call per cell is made at a time in this process,
+    # the other callers wait for its result
+    cells = group_by_cell(misses)
+    led, waiting = flights.claim(cells)
+    new_reads = {}
+    try:
+        new_reads = refresh_weather(
+            [location for cell in led for location in cells[cell]], deadline_at - time.monotonic()
+        )
+    finally:
+        resolve_flights({cell: cells[cell] for cell in led}, new_reads)
+    weather_reads.update(new_reads)
+    concurrent.futures.wait(waiting.values(), timeout=max(0, deadline_at - time.monotonic()))
+    for cell, future in waiting.items():
+        if future.done() and future.result() is not None:
+            for location in cells[cell]:
+                weather_reads[location.id] = future.result()
+
+    return weather_reads
+
+
+# Fetch and store new weather reads for the locations, returns the reads by location id
+# Claims the lease of each grid cell meanwhile, so callers in other processes wait for these reads instead of
+# fetching them too. No transaction is open during the Weather API calls, only while storing the reads.
+# Cells past the Weather API rate limit, or all of them while the circuit breaker is open, aren't fetched,
+# and neither are the ones whose call fails. Their last stored reads are returned, however old.
+# Reads from after `fresh_after`, WEATHER_CACHE_TTL seconds ago by default, aren't fetched again. With a `limiter`
+# the calls wait for its tokens until the deadline rather than skipping the cells past the rate limit.
+def refresh_weather(locations, deadline, fresh_after=None, workers=None, limiter=None):
+    if not locations:
+        return {}
+    deadline = max(0, deadline)
+    deadline_at = time.monotonic() + deadline
+    holder, claimed = claim_leases({lease_key(location) for location in locations}, deadline + LEASE_SLACK)
+    try:
+        # Another caller may have stored the reads while this one claimed the leases
+        weather_reads = query_recent_weather(locations, fresh_after)
+        misses = [location for location in locations if location.id not in weather_reads]
+        cells = group_by_cell([location for location in misses if lease_key(location) in claimed])
+        if limiter is None:
+            allowed_cells = take_weather_api_tokens(cells)
         else:
-            # If this is the first read for this location
-            Weather.objects.create(location=location, temperature=data['temp'], status=data['weather'])
+            allowed_cells = wait_for_weather_api_tokens(cells, limiter, deadline_at)
+        new_reads = request_weather_cells(
+            [location for location in misses if location.grid_key in allowed_cells],
+            workers or settings.WEATHER_FETCH_WORKERS,
+            max(0, deadline_at - time.monotonic()),
+        )
+        with transaction.atomic():
+            store_weather(new_reads)
+    finally:
+        release_leases(holder, claimed)
+    for location, data in new_reads.items():
+        weather_reads[location.id] = {'temp': data['temp'], 'weather': data['weather'], 'age': 0}
+    # Cells leased by other callers are read once they stored them
+    weather_reads.update(wait_for_weather(
+        [location for location in misses if lease_key(location) not in claimed], deadline_at, fresh_after
+    ))
+    unread = [location for location in misses if location.id not in weather_reads]
+    if unread:
+        weather_reads.update(query_recent_weather(unread, fresh_after=datetime.datetime.min))
 
-    return data
+    return weather_reads
 
 
-# Fetch weather data from weather API
-def request_weather(location):
-    url = (
-            os.getenv('WEATHER_API') + os.getenv('WEATHER_API_ONECALL') +
-            'lat=' + str(location.lat) +
-            '&lon=' + str(location.lon) +
-            '&appid=' + os.getenv('WEATHER_API_KEY') +
-            '&units=metric'
+# Key of the lease on fetching a location's read, locations in the same grid cell share the lease
+def lease_key(location):
+    return 'weather:' + location.grid_key
+
+
+# Wait for the reads of the locations stored by the callers holding their leases, until `deadline_at`
+# Stops early once none of the leases is held anymore, returns the reads stored meanwhile by location id
+def wait_for_weather(locations, deadline_at, fresh_after=None):
+    weather_reads = {}
+    while locations and time.monotonic() < deadline_at:
+        time.sleep(min(LEASE_POLL_INTERVAL, deadline_at - time.monotonic()))
+        new_reads = query_recent_weather(locations, fresh_after)
+        weather_reads.update(new_reads)
+        locations = [location for location in locations if location.id not in new_reads]
+        if locations and not held_leases({lease_key(location) for location in locations}):
+            break
+    return weather_reads
+
+
+# Take a Weather API token for each of the cells, or other calls like geocoding queries, as long as there are
+# tokens left and the circuit breaker is closed
+# Returns the cells that got a token, without waiting for any
+def take_weather_api_tokens(cells):
+    if breaker.is_open():
+        weather_api_shed.inc(len(cells), reason='circuit_open')
+        return set()
+    allowed = list(cells)[:weather_api_limiter().take(len(cells))]
+    if len(allowed) < len(cells):
+        weather_api_shed.inc(len(cells) - len(allowed), reason='rate_limit')
+    return set(allowed)
+
+
+# Take a token of the `limiter` for each of the cells, waiting for them until `deadline_at`, as long as the circuit
+# breaker is closed
+# Returns the cells that got a token in time
+def wait_for_weather_api_tokens(cells, limiter, deadline_at):
+    if breaker.is_open():
+        weather_api_shed.inc(len(cells), reason='circuit_open')
+        return set()
+    allowed = set()
+    for cell in cells:
+        wait = limiter.try_acquire()
+        while wait and time.monotonic() + wait < deadline_at:
+            limiter.sleep(wait)
+            wait = limiter.try_acquire()
+        if wait:
+            weather_api_shed.inc(len(cells) - len(allowed), reason='rate_limit')
+            break
+        allowed.add(cell)
+    return allowed
+
+
+# Rate limiter of the Weather API shared by all processes, allowing `rate` calls per minute,
+# WEATHER_API_RATE_LIMIT by default
+def weather_api_limiter(rate=None):
+    return SharedTokenBucket(
+        WEATHER_API_BUCKET, (rate or settings.WEATHER_API_RATE_LIMIT) / 60, capacity=settings.WEATHER_API_BURST
+    )
+
+
+weather_api_tokens.set_function(lambda: weather_api_limiter().tokens())
+
+
+# Hand the reads over to the callers waiting on the cells, given as a dict of locations by cell
+def resolve_flights(cells, weather_reads):
+    for cell, locations in cells.items():
+        flights.resolve(
+            cell, next((weather_reads[location.id] for location in locations if location.id in weather_reads), None)
+        )
+
+
+# Schedule refreshing the reads of the locations in the background, once the current transaction commits
+def schedule_revalidation(locations):
+    transaction.on_commit(lambda: queue_revalidation(locations))
+
+
+# Queue refreshing the reads of the locations, leaving out the grid cells already queued or being refreshed
+def queue_revalidation(locations):
+    with pending_revalidations_lock:
+        cells = {location.grid_key for location in locations} - pending_revalidations
+        pending_revalidations.update(cells)
+    if cells:
+        location_ids = [location.id for location in locations if location.grid_key in cells]
+        revalidation_executor.submit(run_in_background, revalidate_weather, location_ids, cells)
+
+
+# Run a function in a background thread, closing the thread's database connections afterwards
+def run_in_background(function, *args):
+    try:
+        function(*args)
+    except Exception:
+        logger.exception('Background weather task failed')
+    finally:
+        connections.close_all()
+
+
+# Refresh the reads of the locations, unless another caller in this process is already at it
+# The `queued` cells can be queued again afterwards, see queue_revalidation
+def revalidate_weather(location_ids, queued=()):
+    try:
+        cells = group_by_cell(Location.objects.filter(pk__in=location_ids))
+        led, waiting = flights.claim(cells)
+        new_reads = {}
+        try:
+            new_reads = refresh_weather(
+                [location for cell in led for location in cells[cell]], settings.WEATHER_FETCH_DEADLINE
+            )
+        finally:
+            resolve_flights({cell: cells[cell] for cell in led}, new_reads)
+    finally:
+        with pending_revalidations_lock:
+            pending_revalidations.difference_update(queued)
+
+
+# Fetch weather data for many locations from weather API with a single call per grid cell
+# Returns a dict of reads by location, like request_weather_many does
+def request_weather_cells(locations, workers, deadline=None, limiter=None):
+    cells = group_by_cell(locations)
+    cell_reads = request_weather_many([cell[0] for cell in cells.values()], workers, deadline, limiter)
+    return {
+        location: data
+        for first, data in cell_reads.items()
+        for location in cells[first.grid_key]
+    }
+
+
+# Fetch weather data for many locations from weather API concurrently, with at most `workers` calls at a time
+# Returns a dict of reads by location, locations whose call failed or didn't finish within `deadline` seconds are left out
+# Every call first takes a token from the `limiter` if there is one.
+# The calls count as successes or failures for the circuit breaker, no call is made while it is open.
+def request_weather_many(locations, workers, deadline=None, limiter=None):
+    allowed = []
+    for location in locations:
+        if not breaker.allow():
+            weather_api_shed.inc(len(locations) - len(allowed), reason='circuit_open')
+            break
+        allowed.append(location)
+    locations = allowed
+    if not locations:
+        return {}
+
+    # Only the API calls run in the pool, the database is touched from the calling thread alone
+    started_at = time.perf_counter()
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(workers, len(locations)),
+        thread_name_prefix='weather'
     )
+    futures = {}
+    for location in locations:
+        if limiter is not None:
+            limiter.acquire()
+        futures[executor.submit(request_weather, location)] = location
+    done, not_done = concurrent.futures.wait(futures, timeout=deadline)
+    executor.shutdown(wait=False, cancel_futures=True)
+    record_weather_calls(len(locations), time.perf_counter() - started_at)
+    weather_reads = {}
+    for future in done:
+        location = futures[future]
+        try:
+            weather_reads[location] = future.result()
+        except Exception:
+            breaker.record_failure()
+            logger.warning('Fetching weather for location %s failed', location.id, exc_info=True)
+        else:
+            breaker.record_success()
+    for future in not_done:
+        breaker.record_failure()
+        logger.warning('Fetching weather for location %s missed the deadline', futures[future].id)
+
+    return weather_reads
+
+
+# Get recent weather reads by location id, locations without a read from after `fresh_after` are left out
+# `fresh_after` defaults to WEATHER_CACHE_TTL seconds ago
+# Reads already loaded along with the locations, or held in the local or the shared cache, are used as they are,
+# the rest is looked up in a single query
+def get_recent_weather_many(locations, fresh_after=None):
+    if fresh_after is None:
+        fresh_after = datetime.datetime.now() - datetime.timedelta(seconds=settings.WEATHER_CACHE_TTL)
+    weather_reads = {}
+    not_fresh = []
+    for location in locations:
+        weather = None
+        if Location.weather.is_cached(location):
+            weather = getattr(location, 'weather', None)
+        if weather is None or weather.modified_at < fresh_after:
+            weather = local_cache.get(location.id) or weather
+        if weather is not None and weather.modified_at >= fresh_after:
+            weather_reads[location.id] = weather_data(weather)
+        else:
+            not_fresh.append(location)
+    # Reads loaded along with the locations count as found in local memory, like the ones in the local cache
+    lookups = {'local': len(weather_reads)}
+    if not not_fresh:
+        record_weather_lookups(lookups)
+        return weather_reads
+
+    shared_reads = get_shared_weather(not_fresh)
+    not_cached = []
+    for location in not_fresh:
+        weather = shared_reads.get(location.id)
+        if weather is not None and weather.modified_at >= fresh_after:
+            local_cache.set(location.id, weather)
+            weather_reads[location.id] = weather_data(weather)
+        else:
+            # Another location in the same grid cell may have a recent read
+            not_cached.append(location)
+    lookups['shared'] = len(not_fresh) - len(not_cached)
+    if not_cached:
+        database_reads = query_recent_weather(not_cached, fresh_after)
+        weather_reads.update(database_reads)
+        lookups['database'] = len(database_reads)
+        lookups['miss'] = len(not_cached) - len(database_reads)
+    record_weather_lookups(lookups)
+
+    return weather_reads
+
+
+# Look up the weather reads from after `fresh_after` for the locations in a single query, by location id
+# Any read from the location's grid cell will do, the latest one is used
+# The reads found are kept in the local and the shared cache
+def query_recent_weather(locations, fresh_after=None):
+    if fresh_after is None:
+        fresh_after = datetime.datetime.now() - datetime.timedelta(seconds=settings.WEATHER_CACHE_TTL)
+    cells = group_by_cell(locations)
+    cell_weathers = {}
+    for weather in (
+            Weather.objects
+            .filter(location__grid_key__in=cells, modified_at__gte=fresh_after)
+            .annotate(grid_key=F('location__grid_key'))
+            .order_by('modified_at')
+    ):
+        cell_weathers[weather.grid_key] = weather
+    weathers = {
+        location: cell_weathers[cell]
+        for cell, cell_locations in cells.items() if cell in cell_weathers
+        for location in cell_locations
+    }
+    cache_weather(weathers)
+
+    return {location.id: weather_data(weather) for location, weather in weathers.items()}
+
+
+# Mark the stored weather reads as expired, so they are refreshed on their next use or by the refresh worker
+# Unlike deleting them, the reads are still served meanwhile instead of every page waiting on the Weather API
+# Works through the reads `batch_size` at a time, returns the number of expired reads
+def expire_weather(batch_size):
+    expired_at = datetime.datetime.now() - datetime.timedelta(seconds=settings.WEATHER_CACHE_TTL)
+    expired = 0
+    while True:
+        # Reads already older than that are left as they are
+        locations = list(
+            Location.objects.filter(weather__modified_at__gt=expired_at).order_by('pk').only('grid_key')[:batch_size]
+        )
+        if not locations:
+            break
+        expired += Weather.objects.filter(location__in=locations).update(modified_at=expired_at)
+        # update() doesn't send post_save, so the cached copies are dropped here
+        delete_shared_weather(locations)
+    # Entries are shared between locations of a cell, so the whole local cache goes
+    local_cache.clear()
+
+    return expired
+
+
+# Store new weather reads, given as a dict of reads by location, in a single upsert
+# The reads are kept in the local and the shared cache as well
+def store_weather(weather_reads):
+    if not weather_reads:
+        return
+    weathers = Weather.objects.bulk_create(
+        [
+            Weather(location_id=location.id, temperature=data['temp'], status=data['weather'])
+            for location, data in weather_reads.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['location'],
+        update_fields=['temperature', 'status', 'modified_at'],
+    )
+    # The upsert doesn't send post_save, so the caches are updated here
+    cache_weather(dict(zip(weather_reads, weathers)))
+    weather_stored.send(sender=Weather, weather_reads=weather_reads)
+
 
-    response = requests.get(url)
-    data = json.loads(response.text)
-    temp = data['main']['temp']
-    # parse all the weather data to get what is interesting for us - how ugly is the sky and how hot it is
-    atmospheric_particles = parse_weather(data['weather'])
-    temperature = parse_temp(temp)
-    can_be_sunny = is_daytime(data)
+# Keep weather reads, given as a dict of Weather by location, in the local and the shared cache
+def cache_weather(weathers):
+    for location, weather in weathers.items():
+        local_cache.set(location.id, weather)
+    set_shared_weather(weathers)
+
+
+# Key of a location's read in the shared cache, locations in the same grid cell share the read
+def shared_cache_key(location):
+    return 'weather:' + location.grid_key
+
+
+# Get reads of the locations from the shared cache, as Weather by location id
+# An unavailable cache is treated as empty, the database still has the reads
+def get_shared_weather(locations):
+    keys = {location.id: shared_cache_key(location) for location in locations}
+    try:
+        cached = cache.get_many(set(keys.values()))
+    except Exception:
+        logger.warning('Shared weather cache is unavailable', exc_info=True)
+        return {}
+    return {
+        location_id: Weather(location_id=location_id, **cached[key])
+        for location_id, key in keys.items() if key in cached
+    }
+
+
+# Put reads, given as a dict of Weather by location, in the shared cache
+# Entries expire along with WEATHER_CACHE_HARD_TTL, past which nobody would use them
+def set_shared_weather(weathers):
+    if not weathers:
+        return
+    try:
+        cache.set_many(
+            {
+                shared_cache_key(location): {
+                    'temperature': weather.temperature,
+                    'status': weather.status,
+                    'modified_at': weather.modified_at,
+                }
+                for location, weather in weathers.items()
+            },
+            timeout=settings.WEATHER_CACHE_HARD_TTL,
+        )
+    except Exception:
+        logger.warning('Shared weather cache is unavailable', exc_info=True)
+
+
+# Drop the reads of the locations from the shared cache
+def delete_shared_weather(locations):
+    try:
+        cache.delete_many({shared_cache_key(location) for location in locations})
+    except Exception:
+        logger.warning('Shared weather cache is unavailable', exc_info=True)
+
+
+# Weather read data as served to the views, along with the age of the read in seconds
+def weather_data(weather):
+    return {
+        'temp': weather.temperature,
+        'weather': weather.status,
+        'age': int((datetime.datetime.now() - weather.modified_at).total_seconds())
+    }
+
+
+# Fetch weather data from weather API
+def request_weather(location):
+    started_at = time.perf_counter()
+    try:
+        data = get_client().current_weather(location.lat, location.lon)
+    except Exception:
+        weather_api_calls.observe(time.perf_counter() - started_at, outcome='error')
+        raise
+    weather_api_calls.observe(time.perf_counter() - started_at, outcome='ok')
+    try:
+        temp = data['main']['temp']
+        # parse all the weather data to get what is interesting for us - how ugly is the sky and how hot it is
+        atmospheric_particles = parse_weather(data['weather'])
+        temperature = parse_temp(temp)
+        can_be_sunny = is_daytime(data)
+        observed_at = datetime.datetime.fromtimestamp(data['dt'], datetime.timezone.utc).replace(tzinfo=None)
+        condition_id = max((read['id'] for read in data['weather']), key=condition_severity, default=None)
+    except (KeyError, TypeError, ValueError) as error:
+        # Error payloads, e.g. for an invalid API key, come without the weather
+        message = data.get('message') if isinstance(data, dict) else None
+        raise WeatherAPIError(message or 'Unexpected Weather API payload') from error
     result = rate_weather(atmospheric_particles, temperature, can_be_sunny)
 
     return {
         'temp': temp,
-        'weather': result
+        'weather': result,
+        # Details kept in the weather history
+        'observed_at': observed_at,
+        'condition_id': condition_id,
+        'daytime': can_be_sunny,
     }
 
 
@@ -77,11 +560,20 @@ def parse_weather(weather):
     return ('cloudy', 'clear')[clouds]
 
 
+# Severity of a weather condition id, 0 for a clear sky, 1 for clouds and 2 for rain, which trumps them all
+def condition_severity(condition_id):
+    if 200 <= condition_id < 700:
+        return 2
+    if condition_id >= 700 and condition_id != 800:
+        return 1
+    return 0
+
+
 # Parse temperature readings data
 def parse_temp(temp):
-    if temp < 17:
+    if temp < COLD_BELOW:
         return 'cold'
-    if temp < 25:
+    if temp < WARM_BELOW:
         return 'warm'
 
     return 'hot'
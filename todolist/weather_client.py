@@ -0,0 +1,94 @@
+import threading
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_client = None
+_client_lock = threading.Lock()
+
+
+# Weather API answer that isn't a weather read, e.g. an error payload like {"cod": 401, "message": "Invalid API key"}
+class WeatherAPIError(Exception):
+    pass
+
+
+# HTTP client for the Weather API
+# Keeps a pool of keep-alive connections, so consecutive calls skip the TCP and TLS handshakes,
+# bounds every call with connect and read timeouts and retries failed calls with a backoff
+class WeatherClient:
+    def __init__(
+            self, base_url, endpoint, api_key,
+            connect_timeout=3, read_timeout=5, retries=2, backoff=0.5, pool_size=10, geocoding_endpoint=''
+    ):
+        self.url = base_url + endpoint
+        self.geocoding_url = base_url + geocoding_endpoint
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('GET',),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # Fetch the current weather for the coordinates
+    def current_weather(self, lat, lon):
+        response = self.session.get(
+            self.url,
+            params={'lat': lat, 'lon': lon, 'appid': self.api_key, 'units': 'metric'},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    # Look up places matching the query, e.g. 'Paris,FR', best match first
+    def geocode(self, query, limit=1):
+        response = self.session.get(
+            self.geocoding_url,
+            params={'q': query, 'limit': limit, 'appid': self.api_key},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+# Get the Weather API client shared by all requests of this process
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = WeatherClient(
+                settings.WEATHER_API,
+                settings.WEATHER_API_ONECALL,
+                settings.WEATHER_API_KEY,
+                connect_timeout=settings.WEATHER_API_CONNECT_TIMEOUT,
+                read_timeout=settings.WEATHER_API_READ_TIMEOUT,
+                retries=settings.WEATHER_API_RETRIES,
+                backoff=settings.WEATHER_API_BACKOFF,
+                pool_size=settings.WEATHER_FETCH_WORKERS,
+                geocoding_endpoint=settings.WEATHER_API_DIRECT,
+            )
+        return _client
+
+
+# Drop the shared client when the Weather API settings change, the next call builds a new one
+@receiver(setting_changed)
+def reset_client(setting, **kwargs):
+    global _client
+    if setting.startswith('WEATHER_'):
+        with _client_lock:
+            if _client is not None:
+                _client.close()
+            _client = None
@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# Local stand-in for the Weather API, used by tests and benchmarks
+# Answers every call with the same read after a delay, the delay can be set per latitude to simulate slow spots
+# The first `failures` calls get a 503 to simulate a flaky API
+# Geocoding calls find the places given as coordinates by query, and nothing else
+class StubWeatherServer:
+    def __init__(self, delay=0, delays=None, temp=20.0, weather_id=800, failures=0, places=None):
+        self.delay = delay
+        self.delays = delays or {}
+        self.failures = failures
+        self.places = places or {}
+        self.payload = {
+            'main': {'temp': temp},
+            'weather': [{'id': weather_id}],
+            'dt': 1000,
+            'sys': {'sunrise': 0, 'sunset': 2000},
+        }
+        self.calls = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    # Base URL to use as WEATHER_API
+    @property
+    def url(self):
+        return 'http://%s:%s/' % self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Places found for a geocoding query, like the geocoding API lists them
+    def geocoding_payload(self, query):
+        if query not in self.places:
+            return []
+        lat, lon = self.places[query]
+        return [{'name': query.split(',')[0], 'lat': lat, 'lon': lon}]
+
+    # Build the request handler bound to this server
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections alive between calls like the real API does
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                lat = query.get('lat', [''])[0]
+                with stub._lock:
+                    stub.calls += 1
+                    failed = stub.calls <= stub.failures
+                time.sleep(stub.delays.get(lat, stub.delay))
+                if 'q' in query:
+                    body = json.dumps(stub.geocoding_payload(query['q'][0])).encode()
+                else:
+                    body = json.dumps(stub.payload).encode()
+                self.send_response(503 if failed else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Keep the test output clean
+            def log_message(self, format, *args):
+                pass
+
+        return Handler